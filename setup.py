@@ -24,13 +24,14 @@ setup(name='wyr',
       author_email='kc@saff.net',
       url='https://github.com/kcsaff/wyr',
       license='MIT',
-      packages=find_packages(),
+      packages=find_packages(exclude=['tests', 'tests.*']),
       package_data={
           'wyr': ['data/*']
       },
       install_requires=[
           'aitextgen>=0.2.2',
           'colorama>=0.4.3',
+          'numpy>=1.19.0',
           'requests>=2.24.0',
           'spacy>=2.3.0',
           'spacy-lookups-data>=0.3.2',
@@ -0,0 +1,114 @@
+import unittest
+
+try:
+    import torch
+    from wyr.generators.decoding import PromptCache, TerminatorStop, stopping_criteria, truncate_at_terminator
+except ImportError:  # torch is not installed
+    raise unittest.SkipTest('Decoding needs torch')
+
+
+class CharTokenizer(object):
+    """A character for each token, with the end of text as token 0."""
+    CHARACTERS = '\0 abcdefghijklmnopqrstuvwxyzW?.,\'"'
+    eos_token_id = 0
+
+    def encode(self, text):
+        return [self.CHARACTERS.index(character) for character in text]
+
+    def decode(self, ids, skip_special_tokens=False):
+        return ''.join(self.CHARACTERS[id_] for id_ in map(int, ids)
+                       if not (skip_special_tokens and id_ == self.eos_token_id))
+
+
+class TinyGpt2(object):
+    """Just enough of `aitextgen` for `PromptCache`: a small randomly initialized model, on the CPU."""
+    def __init__(self):
+        from transformers import GPT2Config, GPT2LMHeadModel
+        self.tokenizer = CharTokenizer()
+        torch.manual_seed(0)
+        config = GPT2Config(vocab_size=len(CharTokenizer.CHARACTERS), n_positions=64, n_embd=32, n_layer=2,
+                            n_head=2, bos_token_id=0, eos_token_id=0)
+        self.model = GPT2LMHeadModel(config).eval()
+
+    def get_device(self):
+        return 'cpu'
+
+
+class TruncateTest(unittest.TestCase):
+    def test_cuts_after_the_first_terminator(self):
+        self.assertEqual('Would you rather fly or swim?',
+                         truncate_at_terminator('Would you rather fly or swim? Or run. Or walk?', 'Would you', '?.'))
+        self.assertEqual('Would you rather fly.',
+                         truncate_at_terminator('Would you rather fly. Or swim?', 'Would', '?.'))
+
+    def test_keeps_closing_quotes_and_brackets(self):
+        self.assertEqual('He asked "would you rather fly?"',
+                         truncate_at_terminator('He asked "would you rather fly?" Then left.', 'He asked', '?'))
+        self.assertEqual("Would you rather (fly or swim?)')",
+                         truncate_at_terminator("Would you rather (fly or swim?)') and more", 'Would', '?'))
+
+    def test_ignores_terminators_in_the_prompt(self):
+        self.assertEqual('Why? Would you rather fly?',
+                         truncate_at_terminator('Why? Would you rather fly? Or swim?', 'Why?', '?'))
+        self.assertEqual('Why? Would you rather', truncate_at_terminator('Why? Would you rather', 'Why?', '?'))
+
+
+class TerminatorStopTest(unittest.TestCase):
+    def test_stops_once_every_sequence_has_finished(self):
+        stop = TerminatorStop({9})
+        steps = [[1, 9, 2], [9, 3, 3], [4, 4, 4], [5, 5, 9]]
+        tokens = torch.tensor([[7, 7, 7]]).T
+        stopped = []
+        for step in steps:
+            tokens = torch.cat([tokens, torch.tensor([step]).T], dim=-1)
+            stopped.append(stop(tokens, None))
+
+        # Sequences finish at steps 2, 1 and 4; each stays finished after its terminator
+        self.assertEqual([False, False, False, True], stopped)
+        self.assertEqual([True, True, True], stop.done)
+        self.assertEqual(4, stop.steps)
+
+    def test_prompt_tokens_do_not_count(self):
+        stop = TerminatorStop({9})
+        self.assertFalse(stop(torch.tensor([[9, 9, 1], [9, 9, 2]]), None))
+        self.assertTrue(stop(torch.tensor([[9, 9, 1, 9], [9, 9, 2, 9]]), None))
+
+
+class PromptCacheTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        try:
+            import transformers
+            import aitextgen.utils
+        except ImportError:
+            raise unittest.SkipTest('Sampling from a prompt needs transformers and aitextgen')
+        cls.ai = TinyGpt2()
+
+    def generate(self, prompt, n, max_length, temperature, seed, criteria=None):
+        """What `model.generate` samples, decoded the way `PromptCache` decodes it."""
+        from transformers import set_seed
+        set_seed(seed)
+        prompt_ids = torch.tensor([self.ai.tokenizer.encode(prompt)])
+        with torch.no_grad():
+            outputs = self.ai.model.generate(
+                prompt_ids, do_sample=True, max_length=max_length, temperature=temperature, top_k=PromptCache.TOP_K,
+                num_return_sequences=n, pad_token_id=0, eos_token_id=0, stopping_criteria=criteria)
+        return [self.ai.tokenizer.decode(output, skip_special_tokens=True) for output in outputs]
+
+    def test_samples_like_generate(self):
+        cache = PromptCache(self.ai)
+        for seed in [1, 2, 3]:
+            with self.subTest(seed=seed):
+                expected = self.generate('Would you rather', 4, 40, 0.7, seed)
+                self.assertEqual(expected, cache.generate('Would you rather', 4, 40, 0.7, seed=seed))
+        self.assertEqual(1, cache.misses)
+        self.assertEqual(2, cache.hits)
+
+    def test_stops_like_generate(self):
+        stop_ids = set(self.ai.tokenizer.encode('?.'))
+        cache = PromptCache(self.ai)
+        for seed in [1, 2, 3]:
+            with self.subTest(seed=seed):
+                expected = self.generate('Would you rather', 4, 60, 1.5, seed, stopping_criteria(stop_ids))
+                self.assertEqual(expected, cache.generate('Would you rather', 4, 60, 1.5, seed=seed,
+                                                          stopping_criteria=stopping_criteria(stop_ids)))
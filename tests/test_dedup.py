@@ -0,0 +1,71 @@
+from wyr.console import Console
+from wyr.dedup import DuplicateIndex
+import tempfile
+import unittest
+
+
+class Training(object):
+    """Stand-in for `TrainingData`: a named, hashed list of questions."""
+    def __init__(self, questions, source_hash, source_name='training'):
+        self.questions = questions
+        self.source_hash = source_hash
+        self.source_name = source_name
+
+    def iter_questions(self):
+        return iter(self.questions)
+
+
+class DuplicateIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.index = self.open()
+
+    def open(self):
+        quiet = Console(print=lambda *args, **kwargs: None, warn=lambda *args, **kwargs: None)
+        return DuplicateIndex(f'{self.directory.name}/questions.sqlite3', threshold=0.5, console=quiet)
+
+    def test_is_duplicate(self):
+        self.index.add('Would you rather have a pet dragon or a pet unicorn?')
+
+        self.assertTrue(self.index.is_duplicate('Would you rather have a pet dragon or a pet unicorn?'))
+        self.assertTrue(self.index.is_duplicate('would you rather have a PET DRAGON, or a pet unicorn'))
+        self.assertFalse(self.index.is_duplicate('Would you rather live under the sea or on the moon?'))
+        self.assertFalse(self.index.is_duplicate('...'))
+
+    def test_filter_drops_duplicates_and_indexes_the_rest(self):
+        self.index.add('Would you rather have a pet dragon or a pet unicorn?', source='training')
+        questions = ['Would you rather have a pet dragon or a pet unicorn?',
+                     'Would you rather live under the sea or on the moon?',
+                     'Would you rather live under the sea, or on the moon?',
+                     'Would you rather eat only soup or only salad for a year?']
+
+        self.assertEqual([questions[1], questions[3]], list(self.index.filter(questions)))
+        self.assertEqual(3, len(self.index))
+        # Indexed for later runs too
+        self.assertTrue(self.open().is_duplicate(questions[3]))
+
+    def test_unique_does_not_index(self):
+        self.index.add('Would you rather have a pet dragon or a pet unicorn?')
+        questions = ['Would you rather have a pet dragon or a pet unicorn?',
+                     'Would you rather live under the sea or on the moon?',
+                     'Would you rather live under the sea, or on the moon?',
+                     'Would you rather eat only soup or only salad for a year?']
+        selected = ['Would you rather eat only soup or only salad for a whole year?']
+
+        self.assertEqual([questions[1]], self.index.unique(questions, selected))
+        self.assertEqual(1, len(self.index))
+
+    def test_index_training_reindexes_changed_data(self):
+        first = Training(['Would you rather have a pet dragon or a pet unicorn?',
+                          'Would you rather live under the sea or on the moon?'], 'first')
+        self.assertTrue(self.index.index_training(first))
+        self.assertFalse(self.open().index_training(first))
+        self.assertEqual(2, len(self.index))
+
+        second = Training(first.questions + ['Would you rather eat only soup or only salad for a year?'], 'second')
+        self.assertTrue(self.open().index_training(second))
+        # Only the new question is added
+        self.assertEqual(3, len(self.index))
+        self.assertTrue(self.index.is_duplicate('Would you rather eat only soup or only salad for a year?'))
+        self.assertFalse(self.index.index_training(second))
@@ -0,0 +1,73 @@
+from wyr.console import Console
+from wyr.generators.inferkit import InferKitClient, retry_after
+from wyr.testing.stubs import StubInferKit
+import requests
+import tempfile
+import time
+import unittest
+
+
+class InferKitClientTest(unittest.TestCase):
+    def setUp(self):
+        token = tempfile.NamedTemporaryFile('w', suffix='.token')
+        token.write('stub-token')
+        token.flush()
+        self.addCleanup(token.close)
+        self.token = token.name
+        self.console = Console(print=lambda *args, **kwargs: None, warn=lambda *args, **kwargs: None)
+
+    def client(self, stub: StubInferKit, max_in_flight: int = 4) -> InferKitClient:
+        return InferKitClient(self.token, console=self.console, max_in_flight=max_in_flight, url=stub.url,
+                              backoff_base=0.01)
+
+    def test_retries_failed_requests(self):
+        with StubInferKit(latency=0.01, error_rate=0.3) as stub:
+            client = self.client(stub)
+            results = list(client.generate_many('Would you rather', 20, max_retries=20))
+
+        self.assertEqual(['Would you rather have a dog or a cat?'] * 20, results)
+        self.assertGreater(client.retries, 0)
+        self.assertEqual(20 + client.retries, stub.requests)
+
+    def test_skips_requests_that_keep_failing(self):
+        with StubInferKit(latency=0, error_rate=1) as stub:
+            client = self.client(stub)
+            results = list(client.generate_many('Would you rather', 5, max_retries=3))
+
+        self.assertEqual([], results)
+        self.assertEqual(5 * 3, stub.requests)
+        self.assertEqual(5 * 2, client.retries)
+
+    def test_requests_run_concurrently(self):
+        with StubInferKit(latency=0.2, error_rate=0) as stub:
+            client = self.client(stub, max_in_flight=8)
+            started = time.perf_counter()
+            results = list(client.generate_many('Would you rather', 8))
+            elapsed = time.perf_counter() - started
+
+        self.assertEqual(8, len(results))
+        self.assertLess(elapsed, 8 * 0.2 / 2)
+
+
+
+class RetryAfterTest(unittest.TestCase):
+    @staticmethod
+    def response(value=None):
+        response = requests.Response()
+        if value is not None:
+            response.headers['Retry-After'] = value
+        return response
+
+    def test_uses_the_header(self):
+        self.assertEqual(3.0, retry_after(self.response('3'), 1.0, cap=60.0))
+        self.assertEqual(0.0, retry_after(self.response('-3'), 1.0, cap=60.0))
+        self.assertEqual(0.0, retry_after(self.response('Wed, 21 Oct 2015 07:28:00 GMT'), 1.0, cap=60.0))
+
+    def test_clamps_long_waits(self):
+        self.assertEqual(60.0, retry_after(self.response('86400'), 1.0, cap=60.0))
+        self.assertEqual(60.0, retry_after(self.response('Fri, 01 Jan 9999 00:00:00 GMT'), 1.0, cap=60.0))
+
+    def test_falls_back_on_unusable_headers(self):
+        for value in [None, '', 'soon', 'nan', 'inf', '-inf']:
+            with self.subTest(value=value):
+                self.assertEqual(1.0, retry_after(self.response(value), 1.0, cap=60.0))
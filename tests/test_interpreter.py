@@ -0,0 +1,121 @@
+from collections import namedtuple
+from itertools import islice
+from unittest import mock
+import re
+import unittest
+
+try:
+    from wyr.interpreter import ChoiceInterpreter
+except ImportError:  # spaCy is not installed
+    raise unittest.SkipTest('The choice interpreter needs spaCy')
+
+Span = namedtuple('Span', ['text'])
+
+
+class CountingDoc(object):
+    def __init__(self, text: str):
+        self.sents = [Span(sentence) for sentence in re.findall(r'.*?(?:[.!?]+|$)\s*', text) if sentence]
+        self.ents = []
+
+
+class CountingNlp(object):
+    """Stands in for a spaCy pipeline, counting the texts it parses."""
+    def __init__(self):
+        self.calls = 0
+        self.piped = 0
+
+    def __call__(self, text: str) -> CountingDoc:
+        self.calls += 1
+        return CountingDoc(text)
+
+    def pipe(self, texts, batch_size: int = 1000, **kwargs):
+        # Like spaCy, read a whole batch before parsing any of it
+        texts = iter(texts)
+        while True:
+            batch = list(islice(texts, batch_size))
+            if not batch:
+                return
+            for text in batch:
+                self.piped += 1
+                yield CountingDoc(text)
+
+    @property
+    def parsed(self) -> int:
+        return self.calls + self.piped
+
+
+class CountingModels(object):
+    def __init__(self):
+        self.nlps = {1: CountingNlp(), 2: CountingNlp()}
+
+    def get_or_train(self, level: int) -> CountingNlp:
+        return self.nlps[level]
+
+
+QUESTIONS = [
+    'Would you rather fly or be invisible?',
+    'Would you rather eat cake or pie? Think carefully.',
+    'Would you rather swim, run or cycle?',
+]
+
+
+class ChoiceInterpreterTest(unittest.TestCase):
+    def setUp(self):
+        self.sentence_nlp = CountingNlp()
+        patcher = mock.patch('wyr.interpreter.spacy.load', return_value=self.sentence_nlp)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.models = CountingModels()
+        self.interpreter = ChoiceInterpreter(self.models, segmenter='full')
+
+    def parse_counts(self):
+        return {
+            'sentences': self.sentence_nlp.parsed,
+            'choices1': self.models.nlps[1].parsed,
+            'choices2': self.models.nlps[2].parsed,
+        }
+
+    def test_parses_each_question_once_per_pipeline(self):
+        results = list(self.interpreter.split_question_choices_batch(QUESTIONS))
+
+        self.assertEqual(
+            [('Would you rather fly or be invisible?', ['fly', 'be invisible']),
+             ('Would you rather eat cake or pie? Think carefully.', ['eat cake', 'pie']),
+             ('Would you rather swim, run or cycle?', ['swim, run', 'cycle'])],
+            results)
+        self.assertEqual({'sentences': 3, 'choices1': 3, 'choices2': 3}, self.parse_counts())
+        for name, info in self.interpreter.cache_info().items():
+            self.assertEqual((0, 3, 3), (info.hits, info.misses, info.currsize), name)
+
+    def test_repeated_questions_are_not_parsed_again(self):
+        list(self.interpreter.split_question_choices_batch(QUESTIONS))
+        list(self.interpreter.split_question_choices_batch(QUESTIONS))
+        self.interpreter.split_question_choices(QUESTIONS[0])
+        self.interpreter.split_sentences(QUESTIONS[1])
+
+        self.assertEqual({'sentences': 3, 'choices1': 3, 'choices2': 3}, self.parse_counts())
+        info = self.interpreter.cache_info()
+        self.assertEqual((5, 3), (info['sentences'].hits, info['sentences'].misses))
+        self.assertEqual((4, 3), (info['choices1'].hits, info['choices1'].misses))
+        self.assertEqual((4, 3), (info['choices2'].hits, info['choices2'].misses))
+
+    def test_trailing_broken_sentence_is_parsed_twice(self):
+        # Once to find the broken sentence, and once more after it is trimmed off
+        question, choices = self.interpreter.split_question_choices('Would you rather sing or dance? And then')
+
+        self.assertEqual('Would you rather sing or dance?', question)
+        self.assertEqual(['sing', 'dance'], choices)
+        self.assertEqual({'sentences': 2, 'choices1': 1, 'choices2': 1}, self.parse_counts())
+
+    def test_batch_size_bounds_how_far_ahead_questions_are_read(self):
+        read = []
+
+        def questions():
+            for i in range(10):
+                read.append(i)
+                yield f'Would you rather have {i} cats or {i} dogs?'
+
+        results = self.interpreter.split_question_choices_batch(questions(), batch_size=2)
+        self.assertEqual(('Would you rather have 0 cats or 0 dogs?', ['have 0 cats', '0 dogs']), next(results))
+        self.assertEqual(2, len(read))
+        self.assertEqual(9, len(list(results)))
@@ -0,0 +1,65 @@
+from pathlib import Path
+from wyr.console import Console
+from wyr.senders.mastodon import MastodonPoster, RetryQueue
+from wyr.testing.stubs import FakeMastodon, StubInterpreter
+import contextlib
+import io
+import tempfile
+import time
+import unittest
+
+
+class MastodonPosterTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.token = Path(tmp.name) / 'token'
+        self.token.write_text('stub-token')
+        self.queue = RetryQueue(str(Path(tmp.name) / 'queue.jsonl'))
+        self.console = Console(print=lambda *args, **kwargs: None, warn=lambda *args, **kwargs: None)
+        # The poster prints every status it posts
+        stdout = contextlib.redirect_stdout(io.StringIO())
+        stdout.__enter__()
+        self.addCleanup(stdout.__exit__, None, None, None)
+
+    def poster(self, mastodon: FakeMastodon) -> MastodonPoster:
+        return MastodonPoster(str(self.token), StubInterpreter(), api=mastodon.url, console=self.console,
+                              retry_queue=self.queue)
+
+    def post(self, poster: MastodonPoster, count: int):
+        for i in range(count):
+            poster.post_choices(f'Would you rather post number {i}?', ['yes', 'no'])
+
+    def test_waits_for_the_rate_limit_to_reset(self):
+        with FakeMastodon(limit=3, period=0.5) as mastodon:
+            started = time.perf_counter()
+            self.post(self.poster(mastodon), 7)
+            elapsed = time.perf_counter() - started
+
+        self.assertEqual(7, len(mastodon.statuses))
+        self.assertEqual(0, mastodon.rejected)
+        self.assertEqual(7, mastodon.requests)
+        self.assertEqual(0, len(self.queue))
+        # Three windows: the posts in the first two are spread out, and the last waits for its reset
+        self.assertGreaterEqual(elapsed, 2 * mastodon.period)
+
+    def test_requeues_rate_limited_posts(self):
+        with FakeMastodon(limit=2, period=0.3) as mastodon:
+            poster = self.poster(mastodon)
+            poster.rate_limiter.update = lambda headers: None  # Ignore the rate limit
+            self.post(poster, 5)
+            self.assertEqual(2, len(mastodon.statuses))
+            self.assertEqual(3, mastodon.rejected)
+            self.assertEqual(3, len(self.queue))
+
+            time.sleep(mastodon.period)
+            poster.retry_queued()
+            self.assertEqual(4, len(mastodon.statuses))
+            self.assertEqual(1, len(self.queue))
+
+            time.sleep(mastodon.period)
+            poster.retry_queued()
+
+        self.assertEqual(0, len(self.queue))
+        self.assertEqual(sorted(f'#WouldYouRather post number {i}?' for i in range(5)),
+                         sorted(status['content'] for status in mastodon.statuses.values()))
@@ -0,0 +1,20 @@
+from wyr.metrics import Metrics
+import unittest
+
+
+class MetricsTest(unittest.TestCase):
+    def test_snapshot_with_mixed_label_types(self):
+        metrics = Metrics()
+        metrics.count('requests_total', status=200)
+        metrics.count('requests_total', status='error')
+        metrics.count('requests_total', status='200')
+        metrics.observe('request_seconds', 0.5, status=500)
+        metrics.observe('request_seconds', 0.5, status='error')
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(
+            [({'status': '200'}, 2), ({'status': 'error'}, 1)],
+            [(counter['labels'], counter['value']) for counter in snapshot['counters']])
+        self.assertEqual(
+            [{'status': '500'}, {'status': 'error'}],
+            [histogram['labels'] for histogram in snapshot['histograms']])
@@ -0,0 +1,48 @@
+from wyr.generators.pool import CandidateKey, CandidatePool
+import sqlite3
+import tempfile
+import unittest
+
+KEY = CandidateKey('124M', 'Would you rather', 0.7, '', 0, 'weights')
+
+
+class CandidatePoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = CandidatePool(':memory:')
+
+    def test_serves_best_first_and_only_once(self):
+        self.pool.add(KEY, 70, [('low', 1.0, False), ('high', 3.0, False), ('banned', 5.0, True)])
+
+        self.assertEqual(2, self.pool.available(KEY))
+        self.assertEqual(['high'], self.pool.take(KEY, 1))
+        self.assertEqual(['low'], self.pool.take(KEY, 5))
+        self.assertEqual(0, self.pool.available(KEY))
+
+    def test_only_serves_candidates_for_the_same_settings(self):
+        self.pool.add(KEY, 70, [('full length', 1.0, False)])
+        self.pool.add(KEY._replace(stop_at='?'), 70, [('stopped', 1.0, False)])
+        self.pool.add(KEY._replace(quantized=1), 70, [('quantized', 1.0, False)])
+        self.pool.add(KEY._replace(scoring='other weights'), 70, [('rescored', 1.0, False)])
+
+        self.assertEqual(['stopped'], self.pool.take(KEY._replace(stop_at='?'), 5))
+        self.assertEqual(['quantized'], self.pool.take(KEY._replace(quantized=1), 5))
+        self.assertEqual(['rescored'], self.pool.take(KEY._replace(scoring='other weights'), 5))
+        self.assertEqual(['full length'], self.pool.take(KEY, 5))
+
+    def test_drops_candidates_without_settings(self):
+        with tempfile.NamedTemporaryFile(suffix='.sqlite3') as f:
+            db = sqlite3.connect(f.name)
+            db.executescript('''
+                CREATE TABLE candidates (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, model TEXT NOT NULL, prompt TEXT NOT NULL,
+                    temperature REAL NOT NULL, max_length INTEGER NOT NULL, text TEXT NOT NULL,
+                    score REAL NOT NULL, censored INTEGER NOT NULL, created REAL NOT NULL, used REAL);
+                INSERT INTO candidates (model, prompt, temperature, max_length, text, score, censored, created)
+                    VALUES ('124M', 'Would you rather', 0.7, 70, 'old', 1.0, 0, 0);
+            ''')
+            db.close()
+
+            pool = CandidatePool(f.name)
+            self.assertEqual(0, pool.available(KEY))
+            pool.add(KEY, 70, [('new', 1.0, False)])
+            self.assertEqual(['new'], pool.take(KEY, 5))
@@ -0,0 +1,45 @@
+from pathlib import Path
+from wyr.senders.mastodon import RetryQueue
+import tempfile
+import unittest
+
+
+class RetryQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.queue = RetryQueue(str(Path(self.tmp.name) / 'queue.jsonl'))
+        for i in range(3):
+            self.queue.push({'status': f'post {i}'}, f'key-{i}')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_failed_posts_are_queued_again(self):
+        sent = []
+
+        def send(payload, key):
+            sent.append(key)
+            return key != 'key-1'
+
+        self.assertEqual(3, self.queue.retry(send))
+        self.assertEqual(['key-0', 'key-1', 'key-2'], sent)
+        self.assertEqual(1, len(self.queue))
+
+    def test_crash_keeps_unresolved_posts(self):
+        sent = []
+
+        def crash_after_first(payload, key):
+            if sent:
+                raise KeyboardInterrupt
+            sent.append(key)
+            return True
+
+        with self.assertRaises(KeyboardInterrupt):
+            self.queue.retry(crash_after_first)
+
+        # What the interrupted run left is taken before anything queued since
+        self.queue.push({'status': 'post 3'}, 'key-3')
+        self.assertEqual(2, self.queue.retry(lambda payload, key: sent.append(key) or True))
+        self.assertEqual(1, self.queue.retry(lambda payload, key: sent.append(key) or True))
+        self.assertEqual(['key-0', 'key-1', 'key-2', 'key-3'], sent)
+        self.assertEqual(0, self.queue.retry(lambda payload, key: True))
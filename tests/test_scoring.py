@@ -0,0 +1,84 @@
+from wyr.generators.localgpt2 import BANNED_PHRASES, DISCOURAGED_PHRASES, is_censored, score_question
+from wyr.generators.trainingdata import TrainingData
+from wyr.scoring import CandidateScorer
+import random
+import re
+import unittest
+
+
+def regex_score(question):
+    """The original scoring, with a regular expression per phrase."""
+    score = 0
+    score += 2 * question.count(' or ')
+    score -= question.count('"')
+    score -= question.count("'")
+    qlower = question.lower()
+    for phrase in DISCOURAGED_PHRASES:
+        score -= len(list(re.findall(f'\\b{phrase}\\b', qlower)))
+    for phrase in BANNED_PHRASES:
+        score -= 1000 * len(list(re.findall(f'\\b{phrase}\\b', qlower)))
+    return score
+
+
+def regex_is_censored(text):
+    test_text = text.lower()
+    return any(re.search(f'\\b{banned_phrase}\\b', test_text) for banned_phrase in BANNED_PHRASES)
+
+
+class ScoringTest(unittest.TestCase):
+    """The phrase matcher and the vectorized scorer must agree with the original regular expressions."""
+    @classmethod
+    def setUpClass(cls):
+        rng = random.Random(0)
+        questions = TrainingData(cache_dir=None).questions
+        phrases = DISCOURAGED_PHRASES + BANNED_PHRASES
+        cls.candidates = []
+        for _ in range(1000):
+            words = rng.choice(questions).split(' ')
+            for _ in range(rng.randrange(3)):
+                words.insert(rng.randrange(len(words) + 1), rng.choice(phrases).title())
+            cls.candidates.append(' '.join(words))
+        cls.expected = [(regex_score(candidate), bool(regex_is_censored(candidate))) for candidate in cls.candidates]
+
+    def test_phrase_matcher(self):
+        matched = [(score_question(candidate), is_censored(candidate)) for candidate in self.candidates]
+        self.assertEqual(self.expected, matched)
+
+    def test_vectorized_scorer(self):
+        scores, censored = CandidateScorer().score(self.candidates)
+        self.assertEqual(self.expected, list(zip(scores.tolist(), censored.tolist())))
+
+    def test_phrases_only_match_whole_words(self):
+        phrase = BANNED_PHRASES[0]
+        self.assertTrue(is_censored(f'Would you rather {phrase.upper()}?'))
+        self.assertFalse(is_censored(f'Would you rather x{phrase}x?'))
+
+
+class FittedScorerTest(unittest.TestCase):
+    """Fitted weights should survive saving and loading, and keep using the interpreter for choices."""
+    def test_fit_save_load(self):
+        from tempfile import TemporaryDirectory
+        from wyr.scoring import FEATURES
+        from wyr.testing.stubs import StubInterpreter
+        texts = ['Would you rather fly or swim?', 'Would you rather "run"?', "Would you rather sing, dance or act?",
+                 'Would you rather be rich?', "Would you rather 'read' or 'write'?", 'Would you rather eat or sleep?',
+                 'Would you rather "walk" or "ride"?', 'Would you rather sing?']
+        # Scored by whether there are choices, and nothing else
+        targets = [10.0 if ' or ' in text else 0.0 for text in texts]
+        scorer = CandidateScorer.fit(texts, targets, interpreter=StubInterpreter())
+        self.assertTrue(scorer.needs_interpreter)
+        scores, _ = scorer.score(texts)
+        for score, target in zip(scores.tolist(), targets):
+            self.assertAlmostEqual(target, score)
+
+        with TemporaryDirectory() as directory:
+            path = f'{directory}/weights.json'
+            scorer.save(path)
+            loaded = CandidateScorer.load(path, interpreter=StubInterpreter())
+            uninterpreted = CandidateScorer.load(path)
+        self.assertEqual(scorer.weights.tolist(), loaded.weights.tolist())
+        self.assertEqual(scorer.digest, loaded.digest)
+        self.assertEqual(scores.tolist(), loaded.score(texts)[0].tolist())
+        self.assertEqual([1, 0, 1, 0, 1, 1, 1, 0], loaded.features(texts)[:, FEATURES.index('choices')].tolist())
+        # Without the interpreter the choices are not counted, so the scores change
+        self.assertNotEqual(scorer.digest, uninterpreted.digest)
@@ -0,0 +1,39 @@
+from typing import Dict
+import subprocess
+import sys
+import unittest
+
+# Modules that must never be imported just to start the command line
+HEAVY_MODULES = ['spacy', 'aitextgen', 'torch', 'transformers']
+
+
+def parse_importtime(stderr: str) -> Dict[str, int]:
+    """Map each imported module to its self import time in microseconds, from `-X importtime` output."""
+    imports = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_us, _, module = line[len('import time:'):].split('|', 2)
+        if self_us.strip().isdigit():
+            imports[module.strip()] = int(self_us)
+    return imports
+
+
+class StartupTest(unittest.TestCase):
+    """Quick subcommands run under `python -X importtime` must not import any of `HEAVY_MODULES`."""
+    def assert_light(self, *argv: str):
+        script = f'import sys; sys.argv = {["wyr", *argv]!r}; from wyr import main; main()'
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', script],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(0, result.returncode, result.stderr)
+        imports = parse_importtime(result.stderr)
+        self.assertIn('wyr.commands', imports)
+        heavy = sorted({module.split('.')[0] for module in imports} & set(HEAVY_MODULES))
+        self.assertEqual([], heavy, f'`wyr {" ".join(argv)}` imports {", ".join(heavy)}')
+
+    def test_version(self):
+        self.assert_light('--version')
+
+    def test_read(self):
+        self.assert_light('read')
@@ -0,0 +1,92 @@
+from pathlib import Path
+from unittest import mock
+import tempfile
+import unittest
+
+try:
+    from wyr.trainer import TrainedModels, example_digest
+    import wyr.trainer
+except ImportError:  # spaCy is not installed
+    raise unittest.SkipTest('Training needs spaCy')
+from wyr.constants import QUESTION_SEPARATOR
+from wyr.generators.trainingdata import TrainingData
+
+TRAINING_PARAMS = {
+    'n_iter': 2, 'patience': None, 'holdout': 0.25, 'gate_holdout': 0.25, 'max_incremental_fraction': 0.5,
+    'incremental_epochs': 1,
+}
+
+
+def question(i: int) -> str:
+    return f'Would you rather {{eat {{{i} apples}}}} or {{{{{i} pears}}}}?'
+
+
+class TrainedModelsTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+        self.model_dir = str(self.tmp / 'models')
+
+    def models(self, name: str, numbers) -> TrainedModels:
+        # A new file for each version, as training data is only read once per file
+        path = self.tmp / name
+        path.write_text(''.join(f'{question(i)}\n{QUESTION_SEPARATOR}\n' for i in numbers))
+        return TrainedModels(self.model_dir, str(path), training_params=TRAINING_PARAMS)
+
+    def split_of(self, i: int) -> str:
+        """Which split the question's example lands in, as `TrainedModels` splits them."""
+        path = self.tmp / f'question-{i}'
+        path.write_text(f'{question(i)}\n{QUESTION_SEPARATOR}\n')
+        example, = TrainingData(str(path), cache_dir=None).prepare_data(1, 'choices1')
+        position = int(example_digest(example)[:8], 16) / 0x100000000
+        if position < TRAINING_PARAMS['gate_holdout']:
+            return 'gate'
+        elif position < TRAINING_PARAMS['gate_holdout'] + TRAINING_PARAMS['holdout']:
+            return 'holdout'
+        return 'train'
+
+    def test_fine_tunes_on_new_examples_in_every_trained_split(self):
+        self.models('training', range(40)).get_or_train(1)
+
+        new = {}
+        for i in range(40, 400):
+            new.setdefault(self.split_of(i), []).append(i)
+            if all(len(new.get(split, ())) >= 2 for split in ['train', 'holdout', 'gate']):
+                break
+        added = [i for numbers in new.values() for i in numbers]
+
+        batches = []
+
+        def recording_minibatch(examples, size):
+            examples = list(examples)
+            batches.append([text for text, _ in examples])
+            return real_minibatch(examples, size)
+
+        real_minibatch = wyr.trainer.minibatch
+        models = self.models('training-added', [*range(40), *added])
+        with mock.patch('wyr.trainer.minibatch', recording_minibatch):
+            models.get_or_train(1)
+
+        self.assertTrue(models.reports[1].incremental)
+        trained = {text for texts in batches for text in texts}
+        for split, numbers in new.items():
+            for i in numbers:
+                text = f'Would you rather eat {i} apples or {i} pears?'
+                if split == 'gate':
+                    self.assertNotIn(text, trained)
+                else:
+                    self.assertIn(text, trained, split)
+        # Every example is accounted for, so none of them are fine-tuned on again
+        self.assertEqual([], models._TrainedModels__new_examples(1))
+
+    def test_trains_levels_that_both_need_it_together(self):
+        models = self.models('training', range(40))
+        models.get_or_train(1)
+
+        # Both were trained (in their own processes), so the second level is only loaded
+        self.assertEqual({1, 2}, set(models.reports))
+        self.assertTrue(models.model_manifest_path(2).exists())
+        with mock.patch.object(models, 'train') as train:
+            models.get_or_train(2)
+        train.assert_not_called()
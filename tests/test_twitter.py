@@ -0,0 +1,49 @@
+from wyr.console import Console
+from wyr.generators.twitter import TweetGrabber, TweetPool
+from wyr.testing.stubs import FakeTwitterApi
+import random
+import tempfile
+import unittest
+
+QUERY = '"Would you rather"'
+
+
+class TweetGrabberTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.pool_path = f'{tmp.name}/tweets.sqlite3'
+        self.console = Console(print=lambda *args, **kwargs: None)
+        self.rng = random.Random(0)
+
+    def grabber(self, api: FakeTwitterApi) -> TweetGrabber:
+        # A new grabber and pool each time, as each cron run is a new process
+        return TweetGrabber(None, console=self.console, pool=TweetPool(self.pool_path), api=api, rng=self.rng)
+
+    def test_serves_each_tweet_once_across_runs(self):
+        api = FakeTwitterApi(count=500)
+        served = []
+        for _ in range(5):
+            served.extend(self.grabber(api).tweets(QUERY, 40))
+            api.post(20)
+
+        self.assertEqual(5 * 40, len(served))
+        self.assertEqual(len(served), len(set(served)))
+        self.assertFalse(any('&amp;' in tweet or tweet.startswith('RT ') for tweet in served))
+        # A page per run at most, rather than a search per question
+        self.assertLessEqual(api.searches, 5)
+
+    def test_pages_back_through_older_tweets(self):
+        api = FakeTwitterApi(count=TweetGrabber.PAGE_SIZE * 3, retweet_rate=0)
+        first = self.grabber(api).tweets(QUERY, TweetGrabber.PAGE_SIZE)
+        second = self.grabber(api).tweets(QUERY, TweetGrabber.PAGE_SIZE * 2)
+
+        self.assertEqual(TweetGrabber.PAGE_SIZE * 3, len(set(first + second)))
+
+    def test_runs_out_of_tweets(self):
+        api = FakeTwitterApi(count=30, retweet_rate=0)
+        self.assertEqual(30, len(self.grabber(api).tweets(QUERY, 50)))
+        searches = api.searches
+        self.assertEqual([], self.grabber(api).tweets(QUERY, 10))
+        # Only a search for newer tweets, as the older ones are known to be exhausted
+        self.assertEqual(searches + 1, api.searches)
@@ -0,0 +1,886 @@
+"""
+Benchmark suites for the pieces of the wyr pipeline, run with `wyr bench <suite>...`.
+
+Each suite takes the parsed command line arguments and a `Console`, and returns a list of result rows
+(dicts) that are printed as a table; a suite fails the run by marking any row as `failed`.  Heavy modules are only imported by the suites that use them, so
+listing the suites stays cheap for the command line.
+
+Results can also be written as JSON (`--json`), and compared against JSON written by an earlier run
+(`--baseline`): a row is matched by its first column (and its model, if it has one), and its costs
+(times and sizes, see `is_cost`) regress if they grow by more than `--tolerance`.
+"""
+from functools import partial
+from typing import Callable, Dict, List, TYPE_CHECKING
+import json
+import platform
+import subprocess
+import sys
+import time
+
+if TYPE_CHECKING:
+    from wyr.console import Console
+
+
+clock = time.perf_counter
+
+
+BENCHMARKS: Dict[str, Callable[..., List[dict]]] = {}
+
+
+def benchmark(name: str):
+    """Register a benchmark suite under `name`."""
+    def register(suite):
+        BENCHMARKS[name] = suite
+        return suite
+    return register
+
+
+# Columns that measure a cost, where bigger is worse
+COST_COLUMNS = {'seconds'}
+COST_SUFFIXES = ('_s', '_ms', '_us', '_mb')
+COST_PREFIXES = ('us_per_', 'ms_per_')
+
+# Columns that identify a row along with its first column
+KEY_COLUMNS = ['model']
+
+
+def run_benchmark(args, console: 'Console' = None):
+    if console is None:
+        from wyr.console import Console
+        console = Console()
+    suites = sorted(BENCHMARKS) if 'all' in args.suite else list(dict.fromkeys(args.suite))
+    results = {suite: BENCHMARKS[suite](args, console) for suite in suites}
+
+    # Keep stdout for the JSON if it goes there
+    output = partial(print, file=sys.stderr if args.json == '-' else sys.stdout)
+    for suite, rows in results.items():
+        if len(results) > 1:
+            output(f'[{suite}]')
+        print_table(rows, print=output)
+    failed = any(row.get('failed') for rows in results.values() for row in rows)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['suites']
+        regressions = compare_to_baseline(baseline, results, args.tolerance)
+        output(f'[regressions over {args.tolerance:.0%} against {args.baseline}]')
+        print_table(regressions or [{'regressions': 'none'}], print=output)
+        failed = failed or bool(regressions)
+
+    if args.json:
+        document = json.dumps({
+            'created': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'limit': args.limit,
+            'suites': results,
+        }, indent=2)
+        if args.json == '-':
+            print(document)
+        else:
+            with open(args.json, 'w') as f:
+                f.write(document + '\n')
+
+    if failed:
+        sys.exit(1)
+
+
+def is_cost(column: str) -> bool:
+    return column in COST_COLUMNS or column.endswith(COST_SUFFIXES) or column.startswith(COST_PREFIXES)
+
+
+def row_key(row: dict) -> tuple:
+    return (next(iter(row.values())), *(row[column] for column in KEY_COLUMNS if column in row))
+
+
+def compare_to_baseline(baseline: Dict[str, List[dict]], results: Dict[str, List[dict]],
+                        tolerance: float) -> List[dict]:
+    """Costs in the results that are more than `tolerance` (a fraction) worse than in the baseline."""
+    regressions = []
+    for suite, rows in results.items():
+        baseline_rows = {row_key(row): row for row in baseline.get(suite, [])}
+        for row in rows:
+            before = baseline_rows.get(row_key(row))
+            if before is None:
+                continue
+            for column, value in row.items():
+                was = before.get(column)
+                if not is_cost(column) or not isinstance(value, (int, float)) or not isinstance(was, (int, float)):
+                    continue
+                if value > was * (1 + tolerance):
+                    regressions.append({
+                        'suite': suite,
+                        'row': ' '.join(str(part) for part in row_key(row)),
+                        'column': column,
+                        'baseline': float(was),
+                        'current': float(value),
+                        'change': f'{value / was - 1:+.0%}' if was else 'new',
+                    })
+    return regressions
+
+
+def print_table(rows: List[dict], print=print):
+    if not rows:
+        return
+    columns = list(rows[0])
+    cells = [[format_cell(row.get(column)) for column in columns] for row in rows]
+    widths = [max(len(column), *(len(line[i]) for line in cells)) for i, column in enumerate(columns)]
+    for line in [columns] + cells:
+        print('  '.join(cell.ljust(width) for cell, width in zip(line, widths)).rstrip())
+
+
+def format_cell(value) -> str:
+    if isinstance(value, float):
+        return f'{value:.4f}'
+    return '' if value is None else str(value)
+
+
+# Suites
+
+
+@benchmark('segmenters')
+def bench_segmenters(args, console: 'Console') -> List[dict]:
+    """
+    Compare the sentence segmentation backends over the training questions: time to load each one,
+    per-question latency, and how many questions end up with different sentences or choices than
+    with the full `en_core_web_sm` pipeline.
+    """
+    from wyr.constants import SEGMENTERS
+    from wyr.interpreter import ChoiceInterpreter
+    from wyr.trainer import TrainedModels
+
+    models = TrainedModels(args.model_dir, args.training_data, console=console)
+    questions = models.training_data.questions[:args.limit]
+    # Load the choice models up front so only the segmenter is timed
+    models.get_or_train(1)
+    models.get_or_train(2)
+
+    rows = []
+    baseline = None
+    for segmenter in ['full'] + [s for s in SEGMENTERS if s != 'full']:
+        interpreter = ChoiceInterpreter(models, segmenter=segmenter)
+        started = clock()
+        interpreter.warm_up()
+        load_time = clock() - started
+
+        started = clock()
+        sentences = [interpreter.split_sentences(question) for question in questions]
+        split_time = clock() - started
+
+        interpreter.cache_clear()
+        started = clock()
+        choices = [interpreter.split_question_choices(question) for question in questions]
+        choices_time = clock() - started
+
+        if baseline is None:
+            baseline = sentences, choices
+        rows.append({
+            'segmenter': segmenter,
+            'load_s': load_time,
+            'split_ms': 1000 * split_time / max(1, len(questions)),
+            'choices_ms': 1000 * choices_time / max(1, len(questions)),
+            'sentences_changed': sum(a != b for a, b in zip(sentences, baseline[0])),
+            'choices_changed': sum(a != b for a, b in zip(choices, baseline[1])),
+            'questions': len(questions),
+        })
+        console.okay(f'Benchmarked segmenter {segmenter}')
+    return rows
+
+
+@benchmark('scoring')
+def bench_scoring(args, console: 'Console') -> List[dict]:
+    """
+    Time candidate scoring and censoring with the single-pass `PHRASE_MATCHER`, and with the vectorized
+    `CandidateScorer` on the whole batch, against the original one-regex-per-phrase implementation, over
+    thousands of candidates built from the training questions with phrases mixed in, and count any
+    candidate where they disagree.
+    """
+    import random
+    import re
+    from wyr.generators.localgpt2 import BANNED_PHRASES, DISCOURAGED_PHRASES, is_censored, score_question
+    from wyr.generators.trainingdata import TrainingData
+    from wyr.scoring import CandidateScorer
+
+    def legacy_score(question):
+        score = 0
+        score += 2 * question.count(' or ')
+        score -= question.count('"')
+        score -= question.count("'")
+        qlower = question.lower()
+        for phrase in DISCOURAGED_PHRASES:
+            score -= len(list(re.findall(f'\\b{phrase}\\b', qlower)))
+        for phrase in BANNED_PHRASES:
+            score -= 1000 * len(list(re.findall(f'\\b{phrase}\\b', qlower)))
+        return score
+
+    def legacy_is_censored(text):
+        test_text = text.lower()
+        return any(re.search(f'\\b{banned_phrase}\\b', test_text) for banned_phrase in BANNED_PHRASES)
+
+    rng = random.Random(0)
+    questions = TrainingData(args.training_data).questions
+    phrases = DISCOURAGED_PHRASES + BANNED_PHRASES
+    candidates = []
+    for _ in range(args.limit or 5000):
+        words = rng.choice(questions).split(' ')
+        for _ in range(rng.randrange(3)):
+            words.insert(rng.randrange(len(words) + 1), rng.choice(phrases).title())
+        candidates.append(' '.join(words))
+
+    started = clock()
+    legacy = [(legacy_score(candidate), bool(legacy_is_censored(candidate))) for candidate in candidates]
+    legacy_time = clock() - started
+
+    started = clock()
+    matched = [(score_question(candidate), is_censored(candidate)) for candidate in candidates]
+    matched_time = clock() - started
+
+    started = clock()
+    scores, censored = CandidateScorer().score(candidates)
+    vectorized = list(zip(scores.tolist(), censored.tolist()))
+    vectorized_time = clock() - started
+
+    mismatches = sum(a != b for a, b in zip(legacy, matched))
+    if mismatches:
+        console.warn(f'{mismatches} candidate(s) scored differently by the phrase matcher')
+    vectorized_mismatches = sum(a != b for a, b in zip(legacy, vectorized))
+    if vectorized_mismatches:
+        console.warn(f'{vectorized_mismatches} candidate(s) scored differently by the vectorized scorer')
+    return [
+        {'scorer': 'per-phrase regex', 'candidates': len(candidates),
+         'us_per_candidate': 1e6 * legacy_time / len(candidates), 'mismatches': 0, 'failed': False},
+        {'scorer': 'phrase matcher', 'candidates': len(candidates),
+         'us_per_candidate': 1e6 * matched_time / len(candidates), 'mismatches': mismatches,
+         'failed': bool(mismatches)},
+        {'scorer': 'vectorized batch', 'candidates': len(candidates),
+         'us_per_candidate': 1e6 * vectorized_time / len(candidates), 'mismatches': vectorized_mismatches,
+         'failed': bool(vectorized_mismatches)},
+    ]
+
+
+INFERKIT_CONCURRENCY = [1, 2, 4, 8, 16]
+
+
+@benchmark('inferkit')
+def bench_inferkit(args, console: 'Console') -> List[dict]:
+    """
+    Throughput of the InferKit client at different concurrency levels, against a local stub server that
+    adds latency and injects 502 and 429 responses.
+    """
+    import tempfile
+    from wyr.generators.inferkit import InferKitClient
+    from wyr.testing.stubs import StubInferKit
+
+    count = args.limit or 40
+    rows = []
+    with tempfile.NamedTemporaryFile('w', suffix='.token') as token, StubInferKit() as stub:
+        token.write('stub-token')
+        token.flush()
+        for max_in_flight in INFERKIT_CONCURRENCY:
+            client = InferKitClient(
+                token.name, console=console, max_in_flight=max_in_flight, url=stub.url, backoff_base=0.05)
+            requests_before = stub.requests
+            started = clock()
+            results = list(client.generate_many('Would you rather', count))
+            elapsed = clock() - started
+            rows.append({
+                'max_in_flight': max_in_flight,
+                'questions': len(results),
+                'requests': stub.requests - requests_before,
+                'retries': client.retries,
+                'seconds': elapsed,
+                'per_second': len(results) / elapsed,
+            })
+    return rows
+
+
+@benchmark('mastodon')
+def bench_mastodon(args, console: 'Console') -> List[dict]:
+    """
+    Post to a local fake Mastodon that enforces a rate limit, with and without following its rate limit
+    headers, checking every post arrives exactly once (via the retry queue if need be).
+    """
+    import contextlib
+    import io
+    import tempfile
+    from pathlib import Path
+    from wyr.senders.mastodon import MastodonPoster, RetryQueue
+    from wyr.testing.stubs import FakeMastodon, StubInterpreter
+
+    count = args.limit or 12
+    rows = []
+    for follow_headers in [False, True]:
+        with tempfile.TemporaryDirectory() as tmp, FakeMastodon(limit=5, period=1.0) as mastodon:
+            token = Path(tmp) / 'token'
+            token.write_text('stub-token')
+            queue = RetryQueue(str(Path(tmp) / 'queue.jsonl'))
+            poster = MastodonPoster(str(token), StubInterpreter(), api=mastodon.url, console=console,
+                                    retry_queue=queue)
+            if not follow_headers:
+                poster.rate_limiter.update = lambda headers: None
+
+            started = clock()
+            with contextlib.redirect_stdout(io.StringIO()):
+                for i in range(count):
+                    poster.post_choices(f'Would you rather post number {i}? Or not?', ['yes', 'no'])
+                while len(queue):
+                    time.sleep(mastodon.period)
+                    poster.retry_queued()
+            elapsed = clock() - started
+            rows.append({
+                'rate_limited': follow_headers,
+                'posts': count,
+                'accepted': len(mastodon.statuses),
+                'requests': mastodon.requests,
+                'rejected_429': mastodon.rejected,
+                'seconds': elapsed,
+                'failed': len(mastodon.statuses) != count,
+            })
+    return rows
+
+
+@benchmark('tweets')
+def bench_tweets(args, console: 'Console') -> List[dict]:
+    """
+    Serve questions from tweets over several runs of `--limit` (default 50) questions each, with new
+    tweets posted between runs, against a fake search API: one search per question (the original
+    approach), and from the persisted tweet pool.  Reports the searches made and the questions served
+    more than once.
+    """
+    import html
+    import random
+    import tempfile
+    from wyr.generators.twitter import TweetGrabber, TweetPool
+    from wyr.testing.stubs import FakeTwitterApi
+
+    count = args.limit or 50
+    runs = 5
+    query = '"Would you rather"'
+
+    def search_per_question(api, rng):
+        for _ in range(count):
+            status = rng.choice(api.search(query, tweet_mode='extended'))
+            yield html.unescape(getattr(status, 'retweeted_status', status).full_text)
+
+    rows = []
+    for name in ['search per question', 'pool']:
+        api = FakeTwitterApi(count=2000)
+        rng = random.Random(0)
+        served = []
+        with tempfile.TemporaryDirectory() as tmp:
+            started = clock()
+            for _ in range(runs):
+                if name == 'pool':
+                    # A new grabber each run, as each cron run is a new process
+                    grabber = TweetGrabber(None, console=console, pool=TweetPool(f'{tmp}/tweets.sqlite3'),
+                                           api=api, rng=rng)
+                    served.extend(grabber.tweets(query, count))
+                else:
+                    served.extend(search_per_question(api, rng))
+                api.post(count // 2)
+            elapsed = clock() - started
+        repeats = len(served) - len(set(served))
+        rows.append({
+            'strategy': name,
+            'questions': len(served),
+            'searches': api.searches,
+            'repeated': repeats,
+            'seconds': elapsed,
+            'failed': name == 'pool' and (repeats > 0 or len(served) != runs * count),
+        })
+    return rows
+
+
+@benchmark('workers')
+def bench_workers(args, console: 'Console') -> List[dict]:
+    """
+    Throughput of GPT-2 generation (the default model) with one process, and sharded over 2, 4, ... up to
+    one worker per core.  Each generates `--limit` (default 32) candidates, after a warm-up that starts the
+    workers.  Reports candidates per second and the speedup over one process.
+    """
+    import os
+    from wyr.constants import DEFAULT_GPT2_MODEL
+    from wyr.generators.localgpt2 import LocalGpt2
+
+    count = args.limit or 32
+    cores = os.cpu_count() or 1
+    rows = []
+    for workers in sorted({1, cores, *(2 ** i for i in range(1, cores.bit_length()))} & set(range(1, cores + 1))):
+        client = LocalGpt2(args.model_dir, DEFAULT_GPT2_MODEL, console=console, workers=workers)
+        generate = client.workers.generate if workers > 1 else partial(client.ai.generate, return_as_list=True)
+        generate(n=workers, prompt='Would you rather', max_length=LocalGpt2.MAX_LENGTH)
+        started = clock()
+        candidates = generate(n=count, prompt='Would you rather', max_length=LocalGpt2.MAX_LENGTH)
+        elapsed = clock() - started
+        if workers > 1:
+            client.workers.close()
+        rows.append({
+            'workers': workers,
+            'candidates': len(candidates),
+            'distinct': len(set(candidates)),
+            'seconds': elapsed,
+            'per_second': len(candidates) / elapsed,
+            'speedup': None,
+            'failed': len(candidates) != count,
+        })
+    for row in rows:
+        row['speedup'] = rows[0]['seconds'] / row['seconds']
+    return rows
+
+
+QUANTIZE_SCRIPT = '''
+import json, resource, sys, time
+from wyr.console import Console
+from wyr.generators.localgpt2 import LocalGpt2
+from wyr.scoring import CandidateScorer
+model_dir, model, quantize, count = sys.argv[1:]
+client = LocalGpt2(model_dir, model, console=Console(warn=lambda *args, **kwargs: None), quantize=quantize == 'int8')
+started = time.perf_counter()
+ai = client.ai
+load_s = time.perf_counter() - started
+started = time.perf_counter()
+texts = ai.generate(n=int(count), prompt='Would you rather', max_length=LocalGpt2.MAX_LENGTH, return_as_list=True, seed=1)
+generate_s = time.perf_counter() - started
+prompt_tokens = len(ai.tokenizer.encode('Would you rather'))
+tokens = sum(len(ai.tokenizer.encode(text)) - prompt_tokens for text in texts)
+scores, censored = CandidateScorer().score(texts)
+print(json.dumps({
+    'load_s': load_s,
+    'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'tokens_per_second': tokens / generate_s,
+    'pass_rate': float(((scores > 0) & ~censored).mean()),
+}))
+'''
+
+QUANTIZE_TOLERANCE = 0.1  # Most the int8 model's pass rate may drop below the fp32 model's
+
+
+@benchmark('quantize')
+def bench_quantize(args, console: 'Console') -> List[dict]:
+    """
+    Load time, peak RSS and generation speed of the default GPT-2 model in fp32 and quantized to int8
+    (twice: the first run quantizes the model unless it is already cached under `--model-dir`), each
+    in a fresh process.  For quality, each generates `--limit` (default 24) candidates with the same
+    seed, and reports the fraction that pass scoring (positive score) and censoring.
+    """
+    import os
+    from pathlib import Path
+    from wyr.constants import DEFAULT_GPT2_MODEL
+    from wyr.generators.quantization import quantized_model_path
+
+    count = args.limit or 24
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    rows = []
+    for precision in ['fp32', 'int8', 'int8']:
+        cached = quantized_model_path(Path(args.model_dir) / DEFAULT_GPT2_MODEL).exists()
+        result = subprocess.run(
+            [sys.executable, '-c', QUANTIZE_SCRIPT, args.model_dir, DEFAULT_GPT2_MODEL, precision, str(count)],
+            capture_output=True, text=True, env=env, check=True)
+        measured = json.loads(result.stdout.strip().splitlines()[-1])
+        max_rss = measured['max_rss'] if sys.platform == 'darwin' else measured['max_rss'] * 1024
+        rows.append({
+            'precision': precision if precision == 'fp32' else f'{precision} ({"cached" if cached else "quantized now"})',
+            'load_s': measured['load_s'],
+            'peak_rss_mb': max_rss / 1e6,
+            'tokens_per_second': measured['tokens_per_second'],
+            'pass_rate': measured['pass_rate'],
+            'failed': measured['pass_rate'] < rows[0]['pass_rate'] - QUANTIZE_TOLERANCE if rows else False,
+        })
+    return rows
+
+
+@benchmark('stopping')
+def bench_stopping(args, console: 'Console') -> List[dict]:
+    """
+    Generate `--limit` (default 24) candidates from the default GPT-2 model with a fixed seed, decoding
+    to the full length and stopping each at its first '?'.  Reports the tokens decoded and the time
+    taken.  Both sample the same tokens, so the candidates must match once cut at the '?'; it also
+    reports how many of them pass scoring and censoring.
+    """
+    from transformers import StoppingCriteriaList
+    from wyr.constants import DEFAULT_GPT2_MODEL
+    from wyr.generators.decoding import TerminatorStop, truncate_at_terminator
+    from wyr.generators.localgpt2 import LocalGpt2
+    from wyr.scoring import CandidateScorer
+
+    count = args.limit or 24
+    prompt = 'Would you rather'
+    client = LocalGpt2(args.model_dir, DEFAULT_GPT2_MODEL, console=console, stop_at='?')
+    client.ai.generate(n=1, prompt=prompt, max_length=LocalGpt2.MAX_LENGTH, return_as_list=True)  # Warm up
+    rows = []
+    outputs = []
+    for name, stop_ids in [('full length', ()), ("stop at '?'", client.stop_ids)]:
+        criterion = TerminatorStop(stop_ids)
+        started = clock()
+        texts = client.ai.generate(n=count, prompt=prompt, max_length=LocalGpt2.MAX_LENGTH, return_as_list=True,
+                                   seed=1, stopping_criteria=StoppingCriteriaList([criterion]))
+        elapsed = clock() - started
+        texts = [truncate_at_terminator(text, prompt, '?') for text in texts]
+        outputs.append(texts)
+        scores, censored = CandidateScorer().score(texts)
+        rows.append({
+            'decoding': name,
+            'candidates': len(texts),
+            'tokens': criterion.steps * len(texts),
+            'seconds': elapsed,
+            'speedup': rows[0]['seconds'] / elapsed if rows else 1.0,
+            'pass_rate': float(((scores > 0) & ~censored).mean()),
+            'failed': bool(rows) and texts != outputs[0],
+        })
+    return rows
+
+
+PROMPTS = [
+    'Would you rather',
+    'Here is a question that a group of friends argued about for hours over dinner last night, and that you '
+    'will have to answer honestly. Would you rather',
+]
+
+
+@benchmark('promptcache')
+def bench_promptcache(args, console: 'Console') -> List[dict]:
+    """
+    Generate `--limit` (default 16) candidates from the default GPT-2 model for the default prompt and a
+    long one, with `aitextgen.generate` and with the prompt's keys and values cached.  Reports the time
+    per sample; sampling with the same seed must give the same candidates either way.
+    """
+    from wyr.constants import DEFAULT_GPT2_MODEL
+    from wyr.generators.localgpt2 import LocalGpt2
+
+    count = args.limit or 16
+    client = LocalGpt2(args.model_dir, DEFAULT_GPT2_MODEL, console=console)
+    rows = []
+    for prompt in PROMPTS:
+        kwargs = dict(prompt=prompt, max_length=LocalGpt2.MAX_LENGTH, temperature=1.0)
+        # Warm up, which also caches the prompt
+        client.ai.generate(n=1, return_as_list=True, **kwargs)
+        client.prompt_cache.generate(n=1, **kwargs)
+        baseline = expected = None
+        for name, generate in [('generate', partial(client.ai.generate, return_as_list=True)),
+                               ('cached prompt', client.prompt_cache.generate)]:
+            started = clock()
+            texts = generate(n=count, seed=1, **kwargs)
+            elapsed = clock() - started
+            if expected is None:
+                baseline, expected = elapsed, texts
+            rows.append({
+                'generation': name,
+                'prompt_tokens': len(client.ai.tokenizer.encode(prompt)),
+                'candidates': len(texts),
+                'ms_per_sample': 1000 * elapsed / len(texts),
+                'speedup': baseline / elapsed,
+                'identical': sum(1 for text, other in zip(texts, expected) if text == other),
+                'failed': texts != expected,
+            })
+    return rows
+
+
+@benchmark('training')
+def bench_training(args, console: 'Console') -> List[dict]:
+    """
+    Train both choice models into scratch directories two ways: one level after the other for the full
+    40 epochs (the original schedule), and in parallel with early stopping.  Reports wall-clock time and
+    the held-out F-score of each model.
+    """
+    import tempfile
+    from wyr.trainer import TrainedModels
+
+    rows = []
+    for name, params, parallel in [
+            ('serial, 40 epochs', {'patience': None}, False),
+            ('parallel, early stopping', {}, True)]:
+        with tempfile.TemporaryDirectory() as model_dir:
+            models = TrainedModels(model_dir, args.training_data, console=console, training_params=params)
+            started = clock()
+            models.retrain(parallel=parallel)
+            elapsed = clock() - started
+            for level, report in sorted(models.reports.items()):
+                rows.append({
+                    'schedule': name,
+                    'model': report.label,
+                    'epochs': report.epochs,
+                    'model_s': report.seconds,
+                    'total_s': elapsed,
+                    'f_score': report.f_score,
+                })
+    return rows
+
+
+@benchmark('incremental')
+def bench_incremental(args, console: 'Console') -> List[dict]:
+    """
+    Train both choice models on the training questions less the last `--limit` (default 40), then add
+    those questions back and compare fine-tuning the trained models on them against training new models
+    on all of the questions from scratch.  Fails if fine-tuning scores noticeably worse.
+    """
+    import tempfile
+    from pathlib import Path
+    from wyr.constants import QUESTION_SEPARATOR
+    from wyr.generators.trainingdata import TrainingData
+    from wyr.trainer import TRAINING_PARAMS, TrainedModels
+
+    questions = TrainingData(args.training_data).raw_data
+    added = args.limit or 40
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        before, after = Path(tmp) / 'before', Path(tmp) / 'after'
+        before.write_text(''.join(f'{question}\n{QUESTION_SEPARATOR}\n' for question in questions[:-added]))
+        after.write_text(''.join(f'{question}\n{QUESTION_SEPARATOR}\n' for question in questions))
+
+        TrainedModels(f'{tmp}/incremental', str(before), console=console).retrain(parallel=False)
+        runs = [
+            ('incremental', TrainedModels(f'{tmp}/incremental', str(after), console=console)),
+            ('from scratch', TrainedModels(f'{tmp}/scratch', str(after), console=console)),
+        ]
+        for name, models in runs:
+            for level in (1, 2):
+                started = clock()
+                models.get_or_train(level)
+                elapsed = clock() - started
+                report = models.reports[level]
+                rows.append({
+                    'training': name,
+                    'model': report.label,
+                    'added': added,
+                    'fine_tuned': report.incremental,
+                    'epochs': report.epochs,
+                    'total_s': elapsed,
+                    'f_score': report.f_score,
+                })
+
+    tolerance = TRAINING_PARAMS['incremental_tolerance']
+    scratch = {row['model']: row['f_score'] for row in rows if row['training'] == 'from scratch'}
+    for row in rows:
+        row['failed'] = row['f_score'] < scratch[row['model']] - tolerance
+    return rows
+
+
+@benchmark('trainingdata')
+def bench_trainingdata(args, console: 'Console') -> List[dict]:
+    """
+    Load a training file made of `--limit` (default 50) copies of the training questions three ways:
+    parsing the text, compiling it into an empty cache, and from the compiled cache.  Each load reads
+    the source hash, the questions and the prepared data for both levels, which must all agree.
+    """
+    import tempfile
+    from pathlib import Path
+    from wyr.constants import QUESTION_SEPARATOR
+    from wyr.generators.trainingdata import TrainingData
+
+    copies = args.limit or 50
+    questions = TrainingData(args.training_data).raw_data
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        source = Path(tmp) / 'training'
+        source.write_text(''.join(f'{question}\n{QUESTION_SEPARATOR}\n' for question in questions) * copies)
+
+        expected = None
+        for name, cache_dir in [('parsed', None), ('compiled', f'{tmp}/cache'), ('cached', f'{tmp}/cache')]:
+            TrainingData.__new__.cache_clear()
+            started = clock()
+            data = TrainingData(str(source), cache_dir=cache_dir)
+            loaded = (data.source_hash, data.questions, data.prepare_data(1, 'choices1'),
+                      data.prepare_data(2, 'choices2'))
+            elapsed = clock() - started
+            if expected is None:
+                expected = loaded
+            rows.append({
+                'load': name,
+                'questions': len(loaded[1]),
+                'megabytes': source.stat().st_size / 1e6,
+                'seconds': elapsed,
+                'failed': loaded != expected,
+            })
+    TrainingData.__new__.cache_clear()
+    return rows
+
+
+MEMORY_SCRIPT = '''
+import json, random, resource, sys
+from wyr.generators.trainingdata import TrainingData
+filename, cache_dir, how, count = sys.argv[1:]
+data = TrainingData(filename, cache_dir=cache_dir or None)
+if how == 'list':
+    random.sample(data.questions, int(count))
+elif how == 'sample':
+    data.sample(int(count))
+print(json.dumps(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+'''
+
+
+@benchmark('memory')
+def bench_memory(args, console: 'Console') -> List[dict]:
+    """
+    Peak RSS of sampling 10 questions from a training file made of `--limit` (default 500) copies of the
+    training questions: from the whole list of questions (as `read` used to), by reservoir sampling
+    while streaming the file, and by index from the compiled cache.  Each runs in a fresh process.
+    """
+    import json
+    import os
+    import tempfile
+    from pathlib import Path
+    from wyr.constants import QUESTION_SEPARATOR
+    from wyr.generators.trainingdata import TrainingData
+
+    copies = args.limit or 500
+    questions = TrainingData(args.training_data).raw_data
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        source = Path(tmp) / 'training'
+        with source.open('w') as f:
+            for _ in range(copies):
+                f.write(''.join(f'{question}\n{QUESTION_SEPARATOR}\n' for question in questions))
+        cache_dir = f'{tmp}/cache'
+
+        def measure(how: str, cache_dir: str) -> int:
+            env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+            result = subprocess.run(
+                [sys.executable, '-c', MEMORY_SCRIPT, str(source), cache_dir, how, '10'],
+                capture_output=True, text=True, env=env, check=True)
+            max_rss = json.loads(result.stdout.strip().splitlines()[-1])
+            return max_rss if sys.platform == 'darwin' else max_rss * 1024  # Bytes on macOS, else KiB
+
+        measure('sample', cache_dir)  # Compile the cache first
+        for name, how, cache in [
+                ('nothing', 'none', ''),
+                ('whole list', 'list', ''),
+                ('reservoir', 'sample', ''),
+                ('compiled index', 'sample', cache_dir)]:
+            started = clock()
+            max_rss = measure(how, cache)
+            rows.append({
+                'sampling': name,
+                'megabytes': source.stat().st_size / 1e6,
+                'peak_rss_mb': max_rss / 1e6,
+                'seconds': clock() - started,
+            })
+    return rows
+
+
+@benchmark('dedup')
+def bench_dedup(args, console: 'Console') -> List[dict]:
+    """
+    Index `--limit` (default 20000) synthetic questions built from the training vocabulary, then look
+    up near-duplicates of indexed questions (one word changed) and fresh questions.  Reports the time to
+    index, the lookup latency, and how many near-duplicates were caught and fresh questions rejected.
+    """
+    import random
+    import tempfile
+    from wyr.dedup import DuplicateIndex
+    from wyr.generators.trainingdata import TrainingData
+
+    count = args.limit or 20000
+    rng = random.Random(0)
+    words = sorted({word for question in TrainingData(args.training_data).questions for word in question.split()})
+
+    def question():
+        return ' '.join(['Would you rather', *rng.choices(words, k=12), 'or', *rng.choices(words, k=12)]) + '?'
+
+    def near_duplicate(text):
+        text = text.split()
+        text[rng.randrange(3, len(text))] = rng.choice(words)
+        return ' '.join(text)
+
+    indexed = [question() for _ in range(count)]
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        index = DuplicateIndex(f'{tmp}/questions.sqlite3', console=console)
+        started = clock()
+        index.add_many(indexed)
+        elapsed = clock() - started
+        rows.append({
+            'operation': 'index',
+            'entries': len(index),
+            'seconds': elapsed,
+            'per_item_ms': elapsed / count * 1000,
+            'rejected': None,
+        })
+
+        lookups = min(count, 1000)
+        for name, queries in [
+                ('near-duplicate lookup', [near_duplicate(text) for text in rng.sample(indexed, lookups)]),
+                ('fresh lookup', [question() for _ in range(lookups)])]:
+            started = clock()
+            rejected = sum(1 for query in queries if index.is_duplicate(query))
+            elapsed = clock() - started
+            rows.append({
+                'operation': name,
+                'entries': len(index),
+                'seconds': elapsed,
+                'per_item_ms': elapsed / lookups * 1000,
+                'rejected': f'{rejected}/{lookups}',
+            })
+    return rows
+
+
+@benchmark('stages')
+def bench_stages(args, console: 'Console') -> List[dict]:
+    """
+    Time each stage of the pipeline on its own, over the training questions (up to `--limit`): parsing
+    the training data, preparing it for each level, loading the models, entity recognition with each
+    model, sentence splitting, finding choices end to end, scoring and censoring, and a training epoch.
+    Generating and posting run against the local InferKit and Mastodon stubs.
+    """
+    import contextlib
+    import io
+    import tempfile
+    from pathlib import Path
+    from wyr.generators.inferkit import InferKitClient
+    from wyr.generators.trainingdata import TrainingData
+    from wyr.interpreter import ChoiceInterpreter
+    from wyr.scoring import CandidateScorer
+    from wyr.senders.mastodon import MastodonPoster
+    from wyr.testing.stubs import FakeMastodon, StubInferKit, StubInterpreter
+    from wyr.trainer import TrainedModels
+
+    rows = []
+
+    def stage(name: str, run, items: int = None):
+        """Time `run`, over the items it returns unless told how many it handles."""
+        started = clock()
+        result = run()
+        elapsed = clock() - started
+        if items is None:
+            items = len(result)
+        rows.append({'stage': name, 'items': items, 'seconds': elapsed,
+                     'per_item_ms': 1000 * elapsed / max(1, items)})
+
+    # Uncached, so the text is parsed and prepared here
+    TrainingData.__new__.cache_clear()
+    data = TrainingData(args.training_data, cache_dir=None)
+    stage('parse training data', lambda: data.raw_data)
+    for level in (1, 2):
+        stage(f'prepare data {level}', lambda: data.prepare_data(level, f'choices{level}'))
+    TrainingData.__new__.cache_clear()
+    questions = data.questions[:args.limit]
+
+    models = TrainedModels(args.model_dir, args.training_data, console=console)
+    interpreter = ChoiceInterpreter(models, batch_size=args.batch_size, n_process=args.n_process,
+                                    segmenter=args.segmenter)
+    stage('load models', interpreter.warm_up, items=1)
+    for level in (1, 2):
+        nlp = models.get_or_train(level)
+        stage(f'recognize choices{level}', lambda: list(nlp.pipe(questions, batch_size=args.batch_size)))
+    interpreter.cache_clear()
+    stage('split sentences', lambda: [interpreter.split_sentences(question) for question in questions])
+    interpreter.cache_clear()
+    stage('split question choices', lambda: list(interpreter.split_question_choices_batch(questions)))
+    stage('score and censor', lambda: CandidateScorer().score(questions)[0])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        trainer = TrainedModels(tmp, args.training_data, console=console,
+                                training_params={'n_iter': 1, 'patience': None, 'holdout': 0, 'gate_holdout': 0,
+                                                 'final_epochs': 0})
+        stage('train epoch', lambda: trainer.train(1), items=len(trainer.training_data.prepare_data(1, 'choices1')))
+
+        token = Path(tmp) / 'token'
+        token.write_text('stub-token')
+        count = min(len(questions), 20)
+        with StubInferKit(error_rate=0.0) as stub:
+            client = InferKitClient(str(token), console=console, url=stub.url)
+            stage('generate (stub)', lambda: list(client.generate_many('Would you rather', count)))
+        with FakeMastodon(limit=count, period=60.0) as mastodon, contextlib.redirect_stdout(io.StringIO()):
+            poster = MastodonPoster(str(token), StubInterpreter(), api=mastodon.url, console=console)
+            poster.rate_limiter.update = lambda headers: None  # Time posting, not waiting
+            stage('post (stub)', lambda: [poster.post_choices(question, ['yes', 'no']) for question in questions[:count]])
+    return rows
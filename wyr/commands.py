@@ -1,19 +1,17 @@
 import argparse
-import random
 import sys
-from wyr.generators.inferkit import InferKitClient
-from wyr.generators.trainingdata import TrainingData
-from wyr.interpreter import ChoiceInterpreter
-from wyr.constants import QUESTION_SEPARATOR, DEFAULT_MODEL_PATH, DEFAULT_GPT2_MODEL, GPT2_MODELS
-from wyr.senders.mastodon import MastodonPoster
-from wyr.trainer import TrainedModels
-from wyr.generators.twitter import TweetGrabber
-from wyr.generators.localgpt2 import LocalGpt2
-
-import pkg_resources
+from wyr.constants import QUESTION_SEPARATOR, DEFAULT_MODEL_PATH, DEFAULT_MASTODON_QUEUE_PATH, DEFAULT_GPT2_MODEL, GPT2_MODELS, \
+    DEFAULT_SEGMENTER, SEGMENTERS, DEFAULT_SERVER_HOST, DEFAULT_SERVER_PORT, GPT2_CHUNK_SIZE, DEFAULT_DEDUP_THRESHOLD
+from wyr.benchmarks import BENCHMARKS, run_benchmark
+from wyr.metrics import METRICS, clock
+
+# Everything else is imported by the subcommand that needs it, so `wyr --version` or `wyr read`
+# never pay for spaCy, torch or the HTTP clients.
+
+from importlib import metadata
 try:
-    VERSION = pkg_resources.require("wyr")[0].version
-except:
+    VERSION = metadata.version('wyr')
+except metadata.PackageNotFoundError:
     VERSION = 'DEV'
 
 
@@ -31,6 +29,10 @@ def build_parser():
     inferkit_parser.add_argument(
         '--prompt', '-p', type=str, default='Would you rather', help='Prompt to begin text generation'
     )
+    inferkit_parser.add_argument(
+        '--max-in-flight', type=int, default=4,
+        help='Maximum number of InferKit requests to make at once'
+    )
     inferkit_parser.set_defaults(generator=build_inferkit)
 
     read_parser = subparsers.add_parser('read', help='Read a previously fetched question from training data (for testing)')
@@ -44,6 +46,14 @@ def build_parser():
         '--prompt', '-p', type=str, default='"Would you rather"',
         help='Query to search for'
     )
+    search_parser.add_argument(
+        '--max-age', type=float, default=7.0,
+        help='Days to keep searched tweets in the pool before they expire'
+    )
+    search_parser.add_argument(
+        '--no-pool', action='store_true',
+        help='Do not keep searched tweets between runs'
+    )
     search_parser.set_defaults(generator=build_searcher)
 
     gpt2_parser = subparsers.add_parser('gpt2', help='Generate using local GPT2')
@@ -59,8 +69,82 @@ def build_parser():
         '--temperature', '-T', type=float, default=1.0,
         help='Generation temperature (1.0 = average, higher is more "creative")'
     )
+    gpt2_parser.add_argument(
+        '--refill', type=int, default=0, metavar='N',
+        help='Only top up the pool of pre-generated candidates to N, printing nothing'
+    )
+    gpt2_parser.add_argument(
+        '--no-pool', action='store_true',
+        help='Do not keep surplus candidates on disk between runs'
+    )
+    gpt2_parser.add_argument(
+        '--workers', type=int, default=1,
+        help='Number of processes to generate with, sharing one copy of the model'
+    )
+    gpt2_parser.add_argument(
+        '--quantize', action='store_true',
+        help='Generate with the model quantized to int8, which is faster on CPU (cached after the first run)'
+    )
+    gpt2_parser.add_argument(
+        '--stop-at', type=str, default=None, metavar='CHARACTERS',
+        help="Stop each candidate at the first of these characters after the prompt, e.g. '?'"
+    )
+    gpt2_parser.add_argument(
+        '--cache-prompt', action='store_true',
+        help='Run the prompt through the model once, and reuse it for every candidate'
+    )
+    gpt2_parser.add_argument(
+        '--scoring-weights', type=str, default=None, metavar='JSON',
+        help='File of weights for ranking candidates, as saved by `CandidateScorer.save`'
+    )
     gpt2_parser.set_defaults(generator=build_gpt2)
 
+    bench_parser = subparsers.add_parser('bench', help='Run a benchmark suite')
+    bench_parser.add_argument(
+        'suite', nargs='+', choices=sorted(BENCHMARKS) + ['all'],
+        help='Benchmark suites to run'
+    )
+    bench_parser.add_argument(
+        '--limit', '-l', type=int, default=None,
+        help='Maximum number of training questions to benchmark with'
+    )
+    bench_parser.add_argument(
+        '--json', type=str, default=None, metavar='PATH',
+        help='Also write the results as JSON to PATH (- for stdout), for use as a baseline'
+    )
+    bench_parser.add_argument(
+        '--baseline', type=str, default=None, metavar='PATH',
+        help='Fail if any time or size is worse than in the JSON results at PATH'
+    )
+    bench_parser.add_argument(
+        '--tolerance', type=float, default=0.25,
+        help='Fraction by which a time or size may exceed the baseline'
+    )
+    bench_parser.set_defaults(command=run_benchmark)
+
+    serve_parser = subparsers.add_parser('serve', help='Keep models loaded and answer requests from `wyr client`')
+    serve_parser.add_argument(
+        '--host', type=str, default=DEFAULT_SERVER_HOST,
+        help='Address to listen on'
+    )
+    serve_parser.add_argument(
+        '--port', type=int, default=DEFAULT_SERVER_PORT,
+        help='Port to listen on'
+    )
+    serve_parser.set_defaults(command=run_server)
+
+    client_parser = subparsers.add_parser(
+        'client', help='Forward a command line (after `--`) to a running `wyr serve`')
+    client_parser.add_argument(
+        '--server', '-s', type=str, default=f'http://{DEFAULT_SERVER_HOST}:{DEFAULT_SERVER_PORT}',
+        help='URL of the wyr server'
+    )
+    client_parser.add_argument(
+        'argv', nargs=argparse.REMAINDER,
+        help='Arguments to run on the server, e.g. `-- -c 5 -M gpt2`'
+    )
+    client_parser.set_defaults(command=run_client)
+
     parser.add_argument(
         '--count', '-c', type=int, default=1,
         help='Number of requests to fetch (helpful for model training)'
@@ -69,6 +153,23 @@ def build_parser():
         '--massage', '-M', action='store_true',
         help='Massage the question for human readability & guess choices'
     )
+    parser.add_argument(
+        '--segmenter', choices=SEGMENTERS, default=DEFAULT_SEGMENTER,
+        help='Sentence segmentation backend used when massaging questions'
+    )
+    parser.add_argument(
+        '--batch-size', type=int, default=64,
+        help='Number of questions spaCy processes at a time when massaging several questions (at most --prefetch, '
+             'when prefetching, so questions are printed as they are generated)'
+    )
+    parser.add_argument(
+        '--n-process', type=int, default=1,
+        help='Number of processes spaCy uses when massaging several questions'
+    )
+    parser.add_argument(
+        '--prefetch', type=int, default=8,
+        help='Number of questions to generate ahead while earlier ones are massaged (0 to disable)'
+    )
     parser.add_argument(
         '--retrain', '-R', action='store_true',
         help='Retrain the choice interpreter'
@@ -78,6 +179,27 @@ def build_parser():
         default='',
         help='Filename of mastodon token'
     )
+    parser.add_argument(
+        '--mastodon-queue', type=str,
+        default=DEFAULT_MASTODON_QUEUE_PATH,
+        help='File of failed posts to retry on later runs'
+    )
+    parser.add_argument(
+        '--post-window', type=float, default=0.0,
+        help='Spread posts evenly over this many seconds'
+    )
+    parser.add_argument(
+        '--dedup-threshold', type=float, default=DEFAULT_DEDUP_THRESHOLD,
+        help='Reject questions at least this similar (0-1) to a training or previously emitted question'
+    )
+    parser.add_argument(
+        '--no-dedup', action='store_true',
+        help='Do not reject near-duplicate questions'
+    )
+    parser.add_argument(
+        '--metrics', type=str, default=None,
+        help='After each run, write metrics to this file: Prometheus text if it ends in .prom, else JSON lines'
+    )
     parser.add_argument(
         '--model-dir', '-m', type=str,
         default=DEFAULT_MODEL_PATH,
@@ -95,72 +217,227 @@ def build_parser():
     return parser
 
 
-def build_inferkit(args):
-    client = InferKitClient(args.token)
+def build_inferkit(args, resources: 'Resources'):
+    from wyr.generators.inferkit import InferKitClient
+    client = InferKitClient(args.token, max_in_flight=args.max_in_flight)
 
     def generate(count):
-        return [client.generate(args.prompt) for _ in range(count)]
+        return client.generate_many(args.prompt, count)
     return generate
 
 
-def build_reader(args):
+def build_reader(args, resources: 'Resources'):
+    from wyr.generators.trainingdata import TrainingData
     client = TrainingData(args.training_data)
 
     def generate(count):
-        return random.sample(client.questions, count)
+        yield from client.sample(count)
 
     return generate
 
 
-def build_searcher(args):
-    grabber = TweetGrabber(args.keys)
+def build_searcher(args, resources: 'Resources'):
+    from wyr.generators.twitter import TweetGrabber, TweetPool
+    max_age = args.max_age * 24 * 60 * 60
+    if args.no_pool:
+        pool = TweetPool(':memory:', max_age=max_age)
+    else:
+        pool = TweetPool.in_model_dir(args.model_dir, max_age=max_age)
+    grabber = TweetGrabber(args.keys, pool=pool)
 
     def generate(count):
-        return [grabber.random_tweet(args.prompt) for _ in range(count)]
+        yield from grabber.tweets(args.prompt, count)
 
     return generate
 
 
-def build_gpt2(args):
-    client = LocalGpt2(args.model_dir, args.gpt2_model)
+def build_gpt2(args, resources: 'Resources'):
+    from wyr.generators.localgpt2 import LocalGpt2
+    from wyr.generators.pool import CandidatePool
+    if args.refill and args.no_pool:
+        raise SystemExit('--refill needs the candidate pool, so cannot be used with --no-pool')
+    pool = None if args.no_pool else CandidatePool.in_model_dir(args.model_dir)
+    scorer = None
+    if args.scoring_weights:
+        from wyr.scoring import CandidateScorer
+        scorer = CandidateScorer.load(args.scoring_weights)
+        if scorer.needs_interpreter:
+            scorer.interpreter = load_interpreter(args, resources)
+    client = LocalGpt2(args.model_dir, args.gpt2_model, pool=pool, dedup=load_dedup(args, resources), scorer=scorer,
+                       workers=args.workers, quantize=args.quantize, stop_at=args.stop_at,
+                       cache_prompts=args.cache_prompt)
 
     def generate(count):
-        return client.generate(prompt=args.prompt, temperature=args.temperature, count=count)
+        if args.refill:
+            client.refill(prompt=args.prompt, temperature=args.temperature, count=args.refill)
+            return
+        # Generate in chunks, so the first questions come out before the last are generated
+        for start in range(0, count, GPT2_CHUNK_SIZE):
+            yield from client.generate(
+                prompt=args.prompt, temperature=args.temperature, count=min(GPT2_CHUNK_SIZE, count - start))
 
     return generate
 
 
+def build_dedup(args):
+    if args.no_dedup:
+        return None
+    from wyr.dedup import DuplicateIndex
+    from wyr.generators.trainingdata import TrainingData
+    index = DuplicateIndex.in_model_dir(args.model_dir, threshold=args.dedup_threshold)
+    index.index_training(TrainingData(args.training_data))
+    return index
+
+
+def run_server(args):
+    from wyr.server import serve
+    serve(args)
+
+
+def run_client(args):
+    from wyr.server import forward
+    forward(args)
+
+
+class Resources(object):
+    """
+    Builds the generator, models and interpreter a run needs, each once, keeping them by key so that
+    everything that needs one (like the generator's scorer and the masseuse) shares it.  `wyr serve` keeps
+    the same resources for every run, so models stay loaded between requests.
+    """
+    def __init__(self):
+        self.__built = {}
+
+    def get(self, key, build):
+        if key not in self.__built:
+            self.__built[key] = build()
+        return self.__built[key]
+
+    def forget(self, kind: str):
+        """Drop everything of the given kind (the first element of its key)."""
+        for key in [key for key in self.__built if key[0] == kind]:
+            del self.__built[key]
+
+
+# Options that change from run to run without needing anything to be rebuilt
+PER_RUN_OPTIONS = {'count', 'massage', 'prefetch', 'retrain', 'mastodon_token', 'mastodon_queue', 'post_window', 'version',
+                   'metrics'}
+
+
+def load_models(args, resources: Resources) -> 'TrainedModels':
+    from wyr.trainer import TrainedModels
+    return resources.get(
+        ('models', args.model_dir, args.training_data),
+        lambda: TrainedModels(args.model_dir, args.training_data))
+
+
+def interpreter_key(args):
+    return 'interpreter', args.model_dir, args.training_data, args.batch_size, args.n_process, args.segmenter
+
+
+def load_interpreter(args, resources: Resources) -> 'ChoiceInterpreter':
+    from wyr.interpreter import ChoiceInterpreter
+    models = load_models(args, resources)
+    return resources.get(
+        interpreter_key(args),
+        lambda: ChoiceInterpreter(
+            models, batch_size=args.batch_size, n_process=args.n_process, segmenter=args.segmenter))
+
+
+def load_dedup(args, resources: Resources) -> 'DuplicateIndex':
+    return resources.get(
+        ('dedup', args.model_dir, args.training_data, args.dedup_threshold, args.no_dedup),
+        lambda: build_dedup(args))
+
+
+def generator_key(args):
+    return ('generator', *sorted((name, value) for name, value in vars(args).items()
+                                 if name not in PER_RUN_OPTIONS))
+
+
+def generator_name(args) -> str:
+    return args.generator.__name__.replace('build_', '', 1)
+
+
 # MAIN
 
 
-def main():
+def main(argv=None):
     parser = build_parser()
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     if args.version:
         print(VERSION)
         return
+    elif hasattr(args, 'command'):
+        args.command(args)
+        return
     elif not hasattr(args, 'generator'):
         parser.print_help(sys.stderr)
         exit(1)
 
+    run(args, Resources())
+
+
+def run(args, resources: Resources, print=print):
+    """Generate, massage, post and print questions as the parsed arguments ask."""
+    started = clock()
     should_massage = bool(args.massage or args.mastodon_token)
-    should_load_models = bool(should_massage or args.retrain)
 
-    generate = args.generator(args)
-    models = TrainedModels(args.model_dir, args.training_data) if should_load_models else None
-    masseuse = ChoiceInterpreter(models) if should_massage else None
+    masseuse = None
     if args.retrain:
-        models.retrain()
+        load_models(args, resources).retrain()
+        # These hold on to the old models
+        resources.forget('interpreter')
+        resources.forget('poster')
+        resources.forget('generator')
+    generate = resources.get(generator_key(args), lambda: args.generator(args, resources))
+    if should_massage:
+        masseuse = load_interpreter(args, resources)
+
+    questions = counted(generate(args.count), 'generated', generator_name(args))
+    if args.prefetch > 0:
+        from wyr.streaming import prefetch
+        questions = prefetch(questions, args.prefetch)
+    # Questions read from the training data are all duplicates by definition
+    if args.generator is not build_reader:
+        dedup = load_dedup(args, resources)
+        if dedup is not None:
+            questions = dedup.filter(questions)
+    if masseuse:
+        if args.count > 1:
+            # While prefetching, generation is what is slow, so parse in batches no bigger than the queue
+            # ahead: spaCy would otherwise hold back every question until a whole batch was generated
+            batch_size = min(args.batch_size, args.prefetch) if args.prefetch > 0 else args.batch_size
+            split_questions = masseuse.split_question_choices_batch(questions, batch_size)
+        else:
+            split_questions = map(masseuse.split_question_choices, questions)
 
-    for question in generate(args.count):
         if args.mastodon_token:
-            question = MastodonPoster(args.mastodon_token, masseuse).post(question)
-        elif masseuse:
-            question = masseuse.massage_question(question)
-        print(question)
+            from wyr.senders.mastodon import MastodonPoster, RetryQueue
+            poster = resources.get(
+                ('poster', args.mastodon_token, args.mastodon_queue, *interpreter_key(args)),
+                lambda: MastodonPoster(args.mastodon_token, masseuse, retry_queue=RetryQueue(args.mastodon_queue)))
+            poster.rate_limiter.min_interval = args.post_window / max(1, args.count)
+            poster.retry_queued()
+            questions = (poster.post_choices(question, choices) for question, choices in split_questions)
+        else:
+            questions = (masseuse.format_question(question, choices) for question, choices in split_questions)
+
+    for question in counted(questions, 'emitted', generator_name(args)):
+        print(question, flush=True)
         if args.count > 1:
             print(QUESTION_SEPARATOR, flush=True)
 
+    METRICS.observe('run_seconds', clock() - started, generator=generator_name(args))
+    if args.metrics:
+        METRICS.export(args.metrics)
+
+
+def counted(questions, stage: str, generator: str):
+    for question in questions:
+        METRICS.count('questions_total', stage=stage, generator=generator)
+        yield question
+
 
 if __name__ == '__main__':
     main()
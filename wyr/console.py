@@ -1,5 +1,6 @@
 from colorama import Fore, Style
 from contextlib import contextmanager
+from wyr.metrics import METRICS, Metrics
 import sys
 import time
 
@@ -9,13 +10,16 @@ clock = time.perf_counter
 
 class Console(object):
     """
-    Wrapper for a print statement to keep track of verbosity.
+    Wrapper for a print statement to keep track of verbosity, and of metrics (see `wyr.metrics`).
     """
-    def __init__(self, print=print, warn=None):
+    def __init__(self, print=print, warn=None, metrics: Metrics = None):
         self.__print = print
         if warn is None:
             warn = self.__default_warn
         self.__warn = warn
+        if metrics is None:
+            metrics = METRICS
+        self.metrics = metrics
 
     # Statuses, should write to stderr
     def okay(self, *args, **kwargs):
@@ -28,7 +32,8 @@ class Console(object):
         self.__color_warn(Fore.RED, *args, **kwargs)
 
     @contextmanager
-    def timed(self, start_text=None, stop_text=None):
+    def timed(self, start_text=None, stop_text=None, metric=None, **labels):
+        """Time the block, printing the elapsed time with `stop_text` and recording it to `metric`."""
         started = clock()
         if start_text:
             self.__color_warn(Fore.CYAN, start_text)
@@ -38,6 +43,15 @@ class Console(object):
         elapsed = clock() - started
         if stop_text:
             self.__color_warn(Fore.CYAN, stop_text.format(elapsed))
+        if metric:
+            self.metrics.observe(metric, elapsed, **labels)
+
+    # Metrics
+    def count(self, name: str, value: float = 1, **labels):
+        self.metrics.count(name, value, **labels)
+
+    def observe(self, name: str, value: float, **labels):
+        self.metrics.observe(name, value, **labels)
 
     # Output, should write to print
     def print(self, *args, **kwargs):
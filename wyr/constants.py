@@ -2,5 +2,13 @@ import os.path
 
 QUESTION_SEPARATOR = '----------'
 DEFAULT_MODEL_PATH = os.path.expanduser('~/.wyrbot/models')
+DEFAULT_CACHE_PATH = os.path.expanduser('~/.wyrbot/cache')
+DEFAULT_MASTODON_QUEUE_PATH = os.path.expanduser('~/.wyrbot/mastodon-queue.jsonl')
 GPT2_MODELS = ['gpt2', 'gpt2-medium', 'gpt2-large', 'gpt2-xl']
 DEFAULT_GPT2_MODEL = 'gpt2-medium'
+GPT2_CHUNK_SIZE = 10  # Questions generated per batch when streaming
+SEGMENTERS = ['full', 'parser', 'sentencizer']
+DEFAULT_SEGMENTER = 'parser'
+DEFAULT_SERVER_HOST = '127.0.0.1'
+DEFAULT_SERVER_PORT = 8765
+DEFAULT_DEDUP_THRESHOLD = 0.7  # Estimated Jaccard similarity of word shingles
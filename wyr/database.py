@@ -0,0 +1,38 @@
+"""
+The SQLite databases kept under the model directory: the candidate pool, the tweet pool and the index
+of questions already seen.
+"""
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+import sqlite3
+
+
+def connect(path: str, schema: str) -> sqlite3.Connection:
+    """
+    Open the database at `path` (or in memory for `:memory:`), creating it with the schema if need be.
+    The connection is in autocommit mode, with explicit `transaction`s, and waits out other processes'
+    write locks.  Runs may use it from a background thread (see `wyr.streaming`), one at a time.
+    """
+    if path != ':memory:':
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+    db = sqlite3.connect(path, isolation_level=None, timeout=30, check_same_thread=False)
+    db.executescript(schema)
+    return db
+
+
+@contextmanager
+def transaction(db: sqlite3.Connection, immediate: bool = False) -> Iterator[sqlite3.Connection]:
+    """
+    Run the block in a transaction, committed if it completes and rolled back otherwise.  An `immediate`
+    transaction takes the write lock up front, so that concurrent runs taking rows they have just read
+    (such as the unused items of a pool) never take the same ones.
+    """
+    db.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+    try:
+        yield db
+    except BaseException:
+        db.execute('ROLLBACK')
+        raise
+    else:
+        db.execute('COMMIT')
@@ -0,0 +1,196 @@
+"""
+Persistent index of questions, for rejecting new ones that are the same as or nearly the same as one
+already seen.
+
+Questions are compared by the Jaccard similarity of their word shingles, estimated from MinHash
+signatures.  Signatures are split into bands that are indexed in SQLite (locality-sensitive hashing),
+so a lookup only compares a question with the few indexed questions that share a band with it.
+"""
+from array import array
+from functools import cached_property
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Sequence, Set
+import hashlib
+import re
+import sqlite3
+import struct
+import time
+
+from wyr.console import Console
+from wyr.constants import DEFAULT_DEDUP_THRESHOLD
+from wyr.database import connect, transaction
+
+
+DEDUP_FILENAME = 'questions.sqlite3'
+SHINGLE_SIZE = 3  # Words per shingle
+
+WORD = re.compile(r"[a-z0-9']+")
+
+
+def shingles(text: str, size: int = SHINGLE_SIZE) -> Set[str]:
+    """Runs of `size` words in the text, ignoring case and punctuation."""
+    words = WORD.findall(text.lower())
+    if len(words) <= size:
+        return {' '.join(words)} if words else set()
+    return {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def similarity(signature: Sequence[int], other: Sequence[int]) -> float:
+    """Estimated Jaccard similarity of the shingles behind two signatures."""
+    return sum(1 for a, b in zip(signature, other) if a == b) / len(signature)
+
+
+class DuplicateIndex(object):
+    """
+    Questions that have been seen, from the training data or emitted by a run.  A question is a
+    duplicate if its estimated similarity to any of them is at least `threshold`.
+
+    Signatures have `num_perm` hashes split into `bands` bands, so pairs about as similar as
+    `(1 / bands) ** (bands / num_perm)` or more are likely to be compared at all.
+    """
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS questions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            source TEXT NOT NULL,
+            text TEXT NOT NULL,
+            signature BLOB NOT NULL,
+            created REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS bands (
+            band INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            question INTEGER NOT NULL,
+            PRIMARY KEY (band, bucket, question)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS indexed_sources (
+            name TEXT PRIMARY KEY,
+            source_hash TEXT NOT NULL
+        );
+    '''
+
+    def __init__(self, path: str, threshold: float = DEFAULT_DEDUP_THRESHOLD, num_perm: int = 64,
+                 bands: int = 16, seed: int = 1, console: Console = None):
+        if num_perm % bands:
+            raise ValueError('num_perm must be a multiple of bands')
+        self.__path = path
+        if console is None:
+            console = Console()
+        self.__console = console
+        self.threshold = threshold
+        self.__num_perm = num_perm
+        self.__bands = bands
+        self.__rows = num_perm // bands
+        self.__salt = seed.to_bytes(8, 'little')
+
+    @classmethod
+    def in_model_dir(cls, model_dir: str, **kwargs):
+        return cls(str(Path(model_dir) / DEDUP_FILENAME), **kwargs)
+
+    @cached_property
+    def db(self) -> sqlite3.Connection:
+        return connect(self.__path, self.SCHEMA)
+
+    def __len__(self):
+        (count,), = self.db.execute('SELECT COUNT(*) FROM questions')
+        return count
+
+    def signature(self, text: str) -> Optional[array]:
+        """MinHash signature of the text's shingles; None if it has no words."""
+        # One extendable-output hash per shingle gives `num_perm` independent 32-bit hashes of it
+        hashes = [memoryview(hashlib.shake_128(self.__salt + shingle.encode('utf-8')).digest(4 * self.__num_perm)).cast('I')
+                  for shingle in shingles(text)]
+        if not hashes:
+            return None
+        return array('I', map(min, *hashes)) if len(hashes) > 1 else array('I', hashes[0])
+
+    def most_similar(self, text: str, others: Iterable[str] = ()) -> float:
+        """
+        Highest estimated similarity of the text to an indexed question, or to any of `others`.
+        """
+        signature = self.signature(text)
+        if signature is None:
+            return 0.0
+        best = 0.0
+        for other in others:
+            other_signature = self.signature(other)
+            if other_signature is not None:
+                best = max(best, similarity(signature, other_signature))
+
+        buckets = self.__buckets(signature)
+        rows = self.db.execute(
+            'SELECT signature FROM questions WHERE id IN ('
+            + ' UNION '.join(['SELECT question FROM bands WHERE band = ? AND bucket = ?'] * len(buckets)) + ')',
+            [value for bucket in buckets for value in bucket])
+        for blob, in rows:
+            best = max(best, similarity(signature, array('I', blob)))
+        return best
+
+    def is_duplicate(self, text: str, others: Iterable[str] = ()) -> bool:
+        with self.__console.timed(metric='dedup_lookup_seconds'):
+            return self.most_similar(text, others) >= self.threshold
+
+    def add(self, text: str, source: str = 'emitted'):
+        self.add_many([text], source)
+
+    def add_many(self, texts: Iterable[str], source: str = 'emitted') -> int:
+        """Index the texts, in one transaction; returns how many were indexed."""
+        added = 0
+        now = time.time()
+        with transaction(self.db):
+            for text in texts:
+                signature = self.signature(text)
+                if signature is None:
+                    continue
+                cursor = self.db.execute(
+                    'INSERT INTO questions (source, text, signature, created) VALUES (?, ?, ?, ?)',
+                    (source, text, signature.tobytes(), now))
+                self.db.executemany(
+                    'INSERT OR IGNORE INTO bands (band, bucket, question) VALUES (?, ?, ?)',
+                    [(band, bucket, cursor.lastrowid) for band, bucket in self.__buckets(signature)])
+                added += 1
+        return added
+
+    def index_training(self, training_data) -> bool:
+        """
+        Index the training questions, unless this training data has already been; returns whether it
+        was indexed now.  Questions from an earlier version of the same file are kept.
+        """
+        name = f'training:{training_data.source_name}'
+        row = self.db.execute('SELECT source_hash FROM indexed_sources WHERE name = ?', (name,)).fetchone()
+        if row is not None and row[0] == training_data.source_hash:
+            return False
+        known = {text for text, in self.db.execute('SELECT text FROM questions WHERE source = ?', (name,))}
+        with self.__console.timed('Indexing the training questions', 'Indexed them in {0:.3f}s'):
+            self.add_many((question for question in training_data.iter_questions() if question not in known), name)
+        self.db.execute('INSERT OR REPLACE INTO indexed_sources (name, source_hash) VALUES (?, ?)',
+                        (name, training_data.source_hash))
+        return True
+
+    def filter(self, questions: Iterable[str], source: str = 'emitted') -> Iterator[str]:
+        """Pass on the questions that are not duplicates, indexing each one as it goes."""
+        for question in questions:
+            if self.is_duplicate(question):
+                self.__console.count('dedup_rejected_total')
+                self.__console.warn(f'Skipped a near-duplicate question: {question[:60]!r}')
+                continue
+            self.add(question, source)
+            yield question
+
+    def unique(self, questions: Iterable[str], selected: List[str]) -> List[str]:
+        """
+        The questions that are neither duplicates of an indexed question nor of each other or of those
+        already `selected`, without indexing them.
+        """
+        kept = []
+        for question in questions:
+            if not self.is_duplicate(question, selected + kept):
+                kept.append(question)
+        return kept
+
+    def __buckets(self, signature: array) -> List[tuple]:
+        buckets = []
+        for band in range(self.__bands):
+            values = signature[band * self.__rows:(band + 1) * self.__rows]
+            digest = hashlib.blake2b(struct.pack(f'<{self.__rows}I', *values), digest_size=8).digest()
+            buckets.append((band, int.from_bytes(digest, 'little', signed=True)))
+        return buckets
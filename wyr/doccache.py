@@ -0,0 +1,81 @@
+from collections import OrderedDict, namedtuple
+from itertools import tee
+from typing import Iterable, Iterator, Optional
+from wyr.metrics import METRICS, Metrics, clock
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class DocCache(object):
+    """
+    Bounded, text-keyed LRU cache of parsed spaCy Docs for a single pipeline.
+
+    Mirrors `functools.lru_cache` (including `cache_info`), but also knows how to stream
+    cache misses through `nlp.pipe` so batched and single-question parsing share one cache.
+    Hits, misses and time spent in spaCy are recorded to `metrics`, labelled with the pipeline `name`.
+    """
+    def __init__(self, nlp, maxsize: int = 1024, name: str = 'nlp', metrics: Metrics = METRICS):
+        self.__nlp = nlp
+        self.__maxsize = maxsize
+        self.__name = name
+        self.__metrics = metrics
+        self.__docs = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, text: str):
+        doc = self.__get(text)
+        if doc is None:
+            started = clock()
+            doc = self.__nlp(text)
+            self.__record_parse(clock() - started)
+            self.__put(text, doc)
+        return doc
+
+    def pipe(self, texts: Iterable[Optional[str]], **kwargs) -> Iterator:
+        """
+        Stream texts through the cache, parsing misses with `nlp.pipe`.
+
+        Docs are yielded in input order; any text that is `None` yields `None` without parsing.
+        """
+        lookups = ((text, None if text is None else self.__get(text)) for text in texts)
+        lookups, to_parse = tee(lookups)
+        docs = self.__nlp.pipe(
+            (text for text, doc in to_parse if text is not None and doc is None), **kwargs)
+        for text, doc in lookups:
+            if text is not None and doc is None:
+                # Includes parsing the rest of the batch, for the first doc of each
+                started = clock()
+                doc = next(docs)
+                self.__record_parse(clock() - started)
+                self.__put(text, doc)
+            yield doc
+
+    def cache_info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.__maxsize, len(self.__docs))
+
+    def cache_clear(self):
+        self.__docs.clear()
+        self.hits = self.misses = 0
+
+    def __get(self, text: str):
+        doc = self.__docs.get(text)
+        if doc is None:
+            self.misses += 1
+            self.__metrics.count('doc_cache_misses_total', pipeline=self.__name)
+        else:
+            self.hits += 1
+            self.__metrics.count('doc_cache_hits_total', pipeline=self.__name)
+            self.__docs.move_to_end(text)
+        return doc
+
+    def __record_parse(self, seconds: float):
+        self.__metrics.count('spacy_docs_total', pipeline=self.__name)
+        self.__metrics.count('spacy_seconds_total', seconds, pipeline=self.__name)
+
+    def __put(self, text: str, doc):
+        self.__docs[text] = doc
+        self.__docs.move_to_end(text)
+        while len(self.__docs) > self.__maxsize:
+            self.__docs.popitem(last=False)
@@ -0,0 +1,168 @@
+"""
+Helpers for decoding GPT-2 text: stopping each sample once it has finished a question, rather than
+decoding it out to the maximum length only for most of it to be cut off later; and sampling from a
+prompt whose keys and values are computed once, rather than for every sample of every generation.
+"""
+from collections import OrderedDict
+from typing import Iterable, List, Optional, Set, Tuple
+import copy
+import inspect
+
+import torch
+
+try:
+    from transformers import StoppingCriteria, StoppingCriteriaList
+except ImportError:  # transformers < 4.6, which always decodes to the maximum length
+    StoppingCriteria = object
+    StoppingCriteriaList = None
+
+CLOSING_PUNCTUATION = '\'")]}'
+
+
+def terminator_token_ids(tokenizer, terminators: str) -> Set[int]:
+    """Ids of the tokens with any of the terminator characters in them, and of the end of text token."""
+    ids = {id_ for token, id_ in tokenizer.get_vocab().items()
+           if any(terminator in tokenizer.convert_tokens_to_string([token]) for terminator in terminators)}
+    if tokenizer.eos_token_id is not None:
+        ids.add(tokenizer.eos_token_id)
+    return ids
+
+
+def truncate_at_terminator(text: str, prompt: str, terminators: str) -> str:
+    """Cut the text after the first terminator following the prompt (and any closing quotes or brackets)."""
+    ends = [i for i in (text.find(terminator, len(prompt)) for terminator in terminators) if i >= 0]
+    if not ends:
+        return text
+    end = min(ends) + 1
+    while end < len(text) and text[end] in CLOSING_PUNCTUATION:
+        end += 1
+    return text[:end]
+
+
+class TerminatorStop(StoppingCriteria):
+    """
+    Stop decoding once every sequence in the batch has produced one of the `stop_ids` tokens.  It keeps
+    track of which sequences are done, so use a new one for each call to `generate`.
+    """
+    def __init__(self, stop_ids: Iterable[int]):
+        self.stop_ids = frozenset(stop_ids)
+        self.done = None
+        self.steps = 0  # Tokens decoded for each sequence
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        self.steps += 1
+        tokens = input_ids[:, -1].tolist()
+        if self.done is None:
+            self.done = [False] * len(tokens)
+        self.done = [done or token in self.stop_ids for done, token in zip(self.done, tokens)]
+        return all(self.done)
+
+
+def stopping_criteria(stop_ids: Iterable[int]) -> Optional['StoppingCriteriaList']:
+    """Criteria to pass to `generate`, or None if this version of transformers cannot stop early."""
+    if StoppingCriteriaList is None:
+        return None
+    return StoppingCriteriaList([TerminatorStop(stop_ids)])
+
+
+def expand_past(past, n: int):
+    """Repeat the keys and values of a single sequence across a batch of `n`."""
+    if hasattr(past, 'batch_repeat_interleave'):
+        # A transformers `Cache`, which the model updates in place, so each generation needs its own
+        past = copy.deepcopy(past)
+        past.batch_repeat_interleave(n)
+        return past
+    if isinstance(past, torch.Tensor):
+        # Layers' keys and values are stacked, batch second, in transformers < 4; otherwise batch first
+        dim = 1 if past.dim() == 5 else 0
+        sizes = [-1] * past.dim()
+        sizes[dim] = n
+        return past.expand(*sizes)
+    return tuple(expand_past(item, n) for item in past)
+
+
+class PromptCache(object):
+    """
+    Samples from a GPT-2 model the way `aitextgen.generate` does (top-k sampling at a temperature), but
+    runs each prompt through the model only once, keeping its keys and values (for the `maxsize` most
+    recently used prompts) and repeating them across the batch of every later generation.
+    """
+    TOP_K = 50  # As transformers' `generate` samples by default
+
+    def __init__(self, ai, maxsize: int = 8):
+        self.__ai = ai
+        self.__maxsize = maxsize
+        self.__prompts = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def model(self):
+        return self.__ai.model
+
+    def generate(self, prompt: str, n: int = 1, max_length: int = 256, temperature: float = 0.7,
+                 seed: int = None, stopping_criteria=None) -> List[str]:
+        """Generate `n` texts, taking the same arguments as `aitextgen.generate` (returning a list)."""
+        from aitextgen.utils import reset_seed, set_seed
+        prompt_ids, past, logits = self.__prompt(prompt)
+        if seed:
+            set_seed(seed)
+        eos_token_id = self.__ai.tokenizer.eos_token_id
+        max_length = min(self.model.config.n_positions, max_length)
+
+        tokens = prompt_ids.expand(n, -1)
+        past = expand_past(past, n)
+        logits = logits.expand(n, -1)
+        unfinished = torch.ones(n, dtype=torch.bool, device=tokens.device)
+        with torch.no_grad():
+            # Like `generate`, at least one token even if the prompt is already as long as `max_length`
+            for _ in range(max(1, max_length - prompt_ids.shape[1])):
+                next_tokens = self.__sample(logits, temperature)
+                if eos_token_id is not None:
+                    next_tokens = next_tokens.masked_fill(~unfinished, eos_token_id)
+                    unfinished &= next_tokens != eos_token_id
+                tokens = torch.cat([tokens, next_tokens[:, None]], dim=-1)
+                if not unfinished.any():
+                    break
+                # Criteria give a bool, or one for each sequence in later versions of transformers
+                if stopping_criteria is not None and bool(torch.as_tensor(stopping_criteria(tokens, logits)).all()):
+                    break
+                logits, past = self.__forward(next_tokens[:, None], past)
+
+        if seed:
+            reset_seed()
+        return [self.__ai.tokenizer.decode(output, skip_special_tokens=True) for output in tokens]
+
+    def __prompt(self, prompt: str) -> Tuple[torch.Tensor, object, torch.Tensor]:
+        """The prompt's token ids, keys and values, and the logits for the token after it."""
+        if prompt in self.__prompts:
+            self.hits += 1
+            self.__prompts.move_to_end(prompt)
+            return self.__prompts[prompt]
+        self.misses += 1
+        from aitextgen.utils import encode_text
+        prompt_ids = encode_text(prompt, self.__ai.tokenizer, self.__ai.get_device())
+        with torch.no_grad():
+            logits, past = self.__forward(prompt_ids, None)
+        self.__prompts[prompt] = prompt_ids, past, logits
+        while len(self.__prompts) > self.__maxsize:
+            self.__prompts.popitem(last=False)
+        return self.__prompts[prompt]
+
+    def __forward(self, input_ids: torch.Tensor, past) -> Tuple[torch.Tensor, object]:
+        """The logits for the next token, and the keys and values including these tokens."""
+        kwargs = {} if past is None else {self.__past_argument: past}
+        outputs = self.model(input_ids, use_cache=True, **kwargs)
+        return outputs[0][:, -1, :], outputs[1]
+
+    @property
+    def __past_argument(self) -> str:
+        # Renamed in transformers 4
+        return 'past_key_values' if 'past_key_values' in inspect.signature(self.model.forward).parameters else 'past'
+
+    def __sample(self, logits: torch.Tensor, temperature: float) -> torch.Tensor:
+        logits = logits / temperature
+        top_k = min(self.TOP_K, logits.shape[-1])
+        threshold = torch.topk(logits, top_k)[0][..., -1, None]
+        logits = logits.masked_fill(logits < threshold, -float('inf'))
+        return torch.multinomial(torch.softmax(logits, dim=-1), num_samples=1).squeeze(1)
@@ -1,6 +1,15 @@
 import requests
+import requests.adapters
+import math
+import random
+import threading
 import time
-from wyr.console import Console
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from functools import cached_property
+from typing import Iterator, Optional
+from wyr.console import Console, clock
 
 
 class BearerAuth(requests.auth.AuthBase):
@@ -26,34 +35,110 @@ class BearerAuth(requests.auth.AuthBase):
         return r
 
 
+def retry_after(response, default: float, cap: float = math.inf) -> float:
+    """
+    Seconds to wait before retrying, from the response's `Retry-After` header if it has a usable one,
+    but never more than `cap`.
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return default
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            delay = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return default
+    if not math.isfinite(delay):
+        return default
+    return min(cap, max(0.0, delay))
+
+
 class InferKitClient(object):
     URL = 'https://api.inferkit.com/v1/models/standard/generate'
+    RETRY_STATUSES = {429, 502, 503, 504}
 
-    def __init__(self, token_filename, console=None):
+    def __init__(self, token_filename, console=None, max_in_flight: int = 4, url: str = URL,
+                 backoff_base: float = 2.0, backoff_cap: float = 60.0):
         self.auth = BearerAuth.load(token_filename)
         if console is None:
             console = Console()
         self.__console = console
+        self.__max_in_flight = max_in_flight
+        self.__url = url
+        self.__backoff_base = backoff_base
+        self.__backoff_cap = backoff_cap
+        self.__lock = threading.Lock()
+        self.retries = 0
 
-    def generate(self, prompt, length=280, beginning=True, max_retries=3):
-        for _ in range(max_retries):
-            response = requests.post(
-                self.URL,
-                auth=self.auth,
-                json={'prompt': {'text': prompt}, 'length': length, 'startFromBeginning': beginning})
-
-            if response.ok:
-                break
-            elif response.status_code == 502:
-                time.sleep(30)
-                continue
+    @cached_property
+    def session(self) -> requests.Session:
+        """Keep-alive session, pooling enough connections for every request in flight."""
+        session = requests.Session()
+        session.auth = self.auth
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.__max_in_flight)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def generate(self, prompt, length=280, beginning=True, max_retries=3) -> Optional[str]:
+        response = None
+        for attempt in range(max_retries):
+            started = clock()
+            try:
+                response = self.session.post(
+                    self.__url,
+                    json={'prompt': {'text': prompt}, 'length': length, 'startFromBeginning': beginning})
+            except requests.RequestException as e:
+                self.__console.warn(f'InferKit request failed: {e}')
+                self.__console.observe('inferkit_request_seconds', clock() - started, status='error')
+                response = None
             else:
-                break
+                self.__console.observe('inferkit_request_seconds', clock() - started, status=response.status_code)
+                if response.status_code not in self.RETRY_STATUSES:
+                    break
+
+            if attempt + 1 < max_retries:
+                with self.__lock:
+                    self.retries += 1
+                self.__console.count('inferkit_retries_total')
+                # Sleeping only holds up this request; the others in flight carry on
+                time.sleep(self.__backoff(attempt, response))
 
+        if response is None:
+            self.__console.count('inferkit_failures_total')
+            return None
         try:
             prompt_continuation = response.json()['data']['text']
         except:
+            self.__console.count('inferkit_failures_total')
             self.__console.warn(response)
             self.__console.warn(response.text)
         else:
             return prompt + prompt_continuation
+
+    def generate_many(self, prompt, count, **kwargs) -> Iterator[str]:
+        """
+        Generate `count` texts with up to `max_in_flight` requests at once, yielding each as it
+        arrives.  Requests that still fail after retrying are skipped.
+        """
+        with ThreadPoolExecutor(max_workers=self.__max_in_flight, thread_name_prefix='wyr-inferkit') as executor:
+            submitted = 0
+            pending = set()
+            while submitted < count or pending:
+                while submitted < count and len(pending) < self.__max_in_flight:
+                    pending.add(executor.submit(self.generate, prompt, **kwargs))
+                    submitted += 1
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    if result is not None:
+                        yield result
+
+    def __backoff(self, attempt: int, response) -> float:
+        """Jittered exponential backoff, unless the server said how long to wait."""
+        delay = random.uniform(0, min(self.__backoff_cap, self.__backoff_base * 2 ** attempt))
+        if response is not None:
+            delay = retry_after(response, delay, self.__backoff_cap)
+        return delay
@@ -2,10 +2,20 @@ from pathlib import Path
 from functools import cached_property
 from wyr.constants import DEFAULT_GPT2_MODEL, DEFAULT_MODEL_PATH
 from wyr.console import Console
-from collections import defaultdict
+from wyr.generators.pool import CandidateKey, CandidatePool
+from collections import Counter, defaultdict
+from itertools import count as counter
+from typing import Iterable, Iterator, List, Set, Tuple, TYPE_CHECKING
 import codecs
+import heapq
 import re
 
+if TYPE_CHECKING:
+    from wyr.dedup import DuplicateIndex
+    from wyr.generators.decoding import PromptCache
+    from wyr.generators.workers import GenerationWorkers
+    from wyr.scoring import CandidateScorer
+
 
 ROT13_BANNED_PHRASES = [
     "puvax",
@@ -35,72 +45,237 @@ DISCOURAGED_PHRASES = [
 ]
 
 
+class PhraseMatcher(object):
+    """
+    Counts whole-word occurrences of many phrases in a single regex pass over the lowercased text.
+
+    The regex looks ahead at every word boundary for the longest phrase starting there, so a phrase
+    inside a longer one at a different offset is still found on its own.  A phrase that is a prefix of
+    a longer one (like "sex" in "sex party") is counted along with the longer phrase.
+    """
+    def __init__(self, phrases: Iterable[str]):
+        self.phrases = list(dict.fromkeys(phrases))
+        alternatives = '|'.join(re.escape(phrase) for phrase in sorted(self.phrases, key=len, reverse=True))
+        self.__regex = re.compile(f'(?=\\b({alternatives})\\b)')
+        self.__prefixes = {
+            phrase: [prefix for prefix in self.phrases
+                     if prefix != phrase and re.match(f'{re.escape(prefix)}\\b', phrase)]
+            for phrase in self.phrases
+        }
+
+    def counts(self, text: str) -> Counter:
+        return Counter(phrase for _, phrase in self.finditer(text.lower()))
+
+    def finditer(self, lowered: str) -> Iterator[Tuple[int, str]]:
+        """`(position, phrase)` for every phrase found in the already lowercased text."""
+        for match in self.__regex.finditer(lowered):
+            phrase = match.group(1)
+            yield match.start(), phrase
+            for prefix in self.__prefixes[phrase]:
+                yield match.start(), prefix
+
+
+PHRASE_MATCHER = PhraseMatcher(DISCOURAGED_PHRASES + BANNED_PHRASES)
+
+
+def score_question(question: str, counts: Counter = None) -> int:
+    """Score how good a generated question looks; `counts` are its `PHRASE_MATCHER` counts, if known."""
+    if counts is None:
+        counts = PHRASE_MATCHER.counts(question)
+    score = 0
+    score += 2 * question.count(' or ')
+    score -= question.count('"')
+    score -= question.count("'")
+    for phrase in DISCOURAGED_PHRASES:
+        score -= counts[phrase]
+    for phrase in BANNED_PHRASES:
+        score -= 1000 * counts[phrase]
+    return score
+
+
+def is_censored(text: str, counts: Counter = None) -> bool:
+    if counts is None:
+        counts = PHRASE_MATCHER.counts(text)
+    return any(counts[phrase] for phrase in BANNED_PHRASES)
+
+
 class LocalGpt2(object):
+    MAX_LENGTH = 70  # Maximum number of words to generate
+    POOL_ATTEMPTS = 3  # Rounds of taking from the pool to make up for near-duplicates
 
     def __init__(self,
                  model_dir: str = DEFAULT_MODEL_PATH,
                  model_version: str = DEFAULT_GPT2_MODEL,
-                 console: Console = None):
+                 console: Console = None,
+                 pool: CandidatePool = None,
+                 dedup: 'DuplicateIndex' = None,
+                 scorer: 'CandidateScorer' = None,
+                 workers: int = 1,
+                 quantize: bool = False,
+                 stop_at: str = None,
+                 cache_prompts: bool = False):
         self.__model_dir = model_dir
         self.__model_version = model_version
+        self.__workers = workers
+        self.__quantize = quantize
+        self.__stop_at = stop_at
+        self.__cache_prompts = cache_prompts
+        self.__pool = pool
+        self.__dedup = dedup
+        if scorer is None:
+            from wyr.scoring import CandidateScorer  # Imports this module
+            scorer = CandidateScorer()
+        self.__scorer = scorer
 
         if console is None:
             console = Console()
         self.__console = console
+        # Scored candidates by (prompt, temperature), each a heap of (-score, sequence, question)
         self.__cache = defaultdict(list)
+        self.__sequence = counter()
+        self.__warned_no_stopping = False
 
     @cached_property
     def ai(self):
         with self.__console.timed(
                 f'Loading model {self.__model_version}',
-                'Loaded model in {0:.3f}s'):
+                'Loaded model in {0:.3f}s',
+                'model_load_seconds', model=self.__model_version):
             from aitextgen import aitextgen
-            return aitextgen(
+            ai = aitextgen(
                 model=self.__model_version,
                 cache_dir=self.model_path,
             )
+            if self.__quantize:
+                from wyr.generators.quantization import load_or_quantize
+                ai.model = load_or_quantize(ai.model, self.model_path)
+            return ai
+
+    @cached_property
+    def workers(self) -> 'GenerationWorkers':
+        """Worker processes sharing the loaded model, when generating with more than one."""
+        from wyr.generators.workers import GenerationWorkers
+        return GenerationWorkers(self.ai, self.__workers, cache_prompts=self.__cache_prompts)
+
+    @cached_property
+    def prompt_cache(self) -> 'PromptCache':
+        """Keys and values of the prompts, kept for as long as this generator (so across runs in a server)."""
+        from wyr.generators.decoding import PromptCache
+        return PromptCache(self.ai)
+
+    @cached_property
+    def stop_ids(self) -> Set[int]:
+        """Tokens that finish a candidate early, when stopping at the `stop_at` terminators."""
+        from wyr.generators.decoding import terminator_token_ids
+        return terminator_token_ids(self.ai.tokenizer, self.__stop_at)
 
     @cached_property
     def model_path(self):
         return Path(self.__model_dir) / self.__model_version
 
     def generate(self, prompt: str = 'Would you rather', temperature: float = 1.0, count=1):
-        ai = self.ai
+        if self.__pool is not None:
+            return self.__generate_from_pool(prompt, temperature, count)
+
+        self.ai  # Load the model before timing generation
         cache = self.__cache[prompt, temperature]
         with self.__console.timed(
                 f'Generating {count} text(s) based on "{prompt}"\nTemperature: {temperature}',
-                'Generated text in {0:.3f}s'):
-            cache += [
-                question for question in ai.generate(
-                    prompt=prompt,
-                    temperature=temperature,
-                    max_length=70,  # Maximum number of words to generate
-                    n=max(3, 3+3*count-len(cache)),  # Generate at least 3, up to some multiple of count
-                    return_as_list=True)
-                if not self.__is_censored(question)
-            ]
+                'Generated text in {0:.3f}s',
+                'generate_seconds', model=self.__model_version):
+            candidates = self.__generate_candidates(
+                prompt, temperature,
+                n=max(3, 3+3*count-len(cache)))  # Generate at least 3, up to some multiple of count
+            scores, censored = self.__scorer.score(candidates)
+            self.__console.count('candidates_rejected_total', int(censored.sum()), reason='censored')
+            for question, score, banned in zip(candidates, scores.tolist(), censored.tolist()):
+                if not banned:
+                    # Score once, on the way in; the sequence number keeps ties oldest first
+                    heapq.heappush(cache, (-score, next(self.__sequence), question))
             # Find least "bad" questions (need an "or" and few quotes)
-            scores = [self.__score(q) for q in cache]
-            results = []
-            for _ in range(count):
-                index_max = max(range(len(scores)), key=scores.__getitem__)
-                results.append(cache.pop(index_max))
-                scores.pop(index_max)
-            self.__cache[prompt, temperature] = cache
-            return results
-
-    def __score(self, question):
-        score = 0
-        score += 2 * question.count(' or ')
-        score -= question.count('"')
-        score -= question.count("'")
-        qlower = question.lower()
-        for phrase in DISCOURAGED_PHRASES:
-            score -= len(list(re.findall(f'\\b{phrase}\\b', qlower)))
-        for phrase in BANNED_PHRASES:
-            score -= 1000 * len(list(re.findall(f'\\b{phrase}\\b', qlower)))
-        return score
-
-    def __is_censored(self, text):
-        test_text = text.lower()
-        return any(re.search(f'\\b{banned_phrase}\\b', test_text) for banned_phrase in BANNED_PHRASES)
+            questions = []
+            while cache and len(questions) < count:
+                questions.extend(self.__unique([heapq.heappop(cache)[-1]], questions))
+            return questions
+
+    def refill(self, prompt: str = 'Would you rather', temperature: float = 1.0, count=1):
+        """Top up the candidate pool until it holds at least `count` servable candidates."""
+        if self.__pool is None:
+            raise ValueError('Refilling needs a candidate pool')
+        available = self.__pool.available(self.__pool_key(prompt, temperature))
+        while available < count:
+            self.ai
+            with self.__console.timed(
+                    f'Refilling pool with {count - available} text(s) based on "{prompt}"\n'
+                    f'Temperature: {temperature}',
+                    'Generated text in {0:.3f}s',
+                    'generate_seconds', model=self.__model_version):
+                self.__add_to_pool(prompt, temperature, max(3, count - available))
+            available = self.__pool.available(self.__pool_key(prompt, temperature))
+        self.__console.okay(f'Pool holds {available} candidate(s) for "{prompt}"')
+
+    def __generate_from_pool(self, prompt: str, temperature: float, count: int) -> List[str]:
+        questions = []
+        for _ in range(self.POOL_ATTEMPTS):
+            wanted = count - len(questions)
+            available = self.__pool.available(self.__pool_key(prompt, temperature))
+            if available < wanted:
+                self.ai
+                with self.__console.timed(
+                        f'Generating {wanted} text(s) based on "{prompt}"\nTemperature: {temperature}',
+                        'Generated text in {0:.3f}s',
+                        'generate_seconds', model=self.__model_version):
+                    self.__add_to_pool(prompt, temperature, max(3, 3+3*wanted-available))
+            taken = self.__pool.take(self.__pool_key(prompt, temperature), wanted)
+            unique = self.__unique(taken, questions)
+            questions.extend(unique)
+            # Only try again to make up for duplicates
+            if len(unique) == len(taken) or len(questions) >= count:
+                break
+        return questions
+
+    def __unique(self, questions: List[str], selected: List[str]) -> List[str]:
+        if self.__dedup is None:
+            return questions
+        unique = self.__dedup.unique(questions, selected)
+        if len(unique) < len(questions):
+            self.__console.count('candidates_rejected_total', len(questions) - len(unique), reason='duplicate')
+            self.__console.info(f'Rejected {len(questions) - len(unique)} near-duplicate candidate(s)')
+        return unique
+
+    def __add_to_pool(self, prompt: str, temperature: float, n: int):
+        candidates = self.__generate_candidates(prompt, temperature, n)
+        scores, censored = self.__scorer.score(candidates)
+        self.__console.count('candidates_rejected_total', int(censored.sum()), reason='censored')
+        self.__pool.add(self.__pool_key(prompt, temperature), self.MAX_LENGTH,
+                        zip(candidates, scores.tolist(), censored.tolist()))
+
+    def __pool_key(self, prompt: str, temperature: float) -> CandidateKey:
+        return CandidateKey(self.__model_version, prompt, temperature, self.__stop_at or '', int(self.__quantize),
+                            self.__scorer.digest)
+
+    def __generate_candidates(self, prompt: str, temperature: float, n: int) -> List[str]:
+        kwargs = dict(prompt=prompt, temperature=temperature, max_length=self.MAX_LENGTH, n=n)
+        if self.__stop_at:
+            kwargs.update(self.__stopping_kwargs())
+        if self.__workers > 1:
+            candidates = self.workers.generate(**kwargs)
+        elif self.__cache_prompts:
+            candidates = self.prompt_cache.generate(**kwargs)
+        else:
+            candidates = self.ai.generate(return_as_list=True, **kwargs)
+        if self.__stop_at:
+            from wyr.generators.decoding import truncate_at_terminator
+            candidates = [truncate_at_terminator(candidate, prompt, self.__stop_at) for candidate in candidates]
+        self.__console.count('candidates_generated_total', len(candidates), model=self.__model_version)
+        return candidates
+
+    def __stopping_kwargs(self) -> dict:
+        from wyr.generators.decoding import stopping_criteria
+        criteria = stopping_criteria(self.stop_ids)
+        if criteria is None:
+            if not self.__warned_no_stopping:
+                self.__console.warn('Stopping early needs transformers 4.6 or later; decoding to the full length')
+                self.__warned_no_stopping = True
+            return {}
+        return {'stopping_criteria': criteria}
@@ -0,0 +1,88 @@
+from collections import namedtuple
+from functools import cached_property
+from pathlib import Path
+from typing import Iterable, List, Tuple
+from wyr.database import connect, transaction
+import sqlite3
+import time
+
+
+POOL_FILENAME = 'gpt2-pool.sqlite3'
+
+# Everything that decides which candidates are generated and how they are scored: candidates are only
+# served for the same key they were added with.  `scoring` identifies the scorer's weights (see
+# `CandidateScorer.digest`), and `stop_at` is '' when decoding runs to the maximum length.
+CandidateKey = namedtuple('CandidateKey', ['model', 'prompt', 'temperature', 'stop_at', 'quantized', 'scoring'])
+KEY_CONDITION = ' AND '.join(f'{field} = ?' for field in CandidateKey._fields)
+
+
+class CandidatePool(object):
+    """
+    Persistent pool of generated candidates, with the score, censorship result and generation parameters
+    of each one.  Candidates are served best score first (oldest first among equal scores), and each is
+    served at most once, so surplus candidates from one run are used by the next.
+    """
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS candidates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            model TEXT NOT NULL,
+            prompt TEXT NOT NULL,
+            temperature REAL NOT NULL,
+            stop_at TEXT NOT NULL,
+            quantized INTEGER NOT NULL,
+            scoring TEXT NOT NULL,
+            max_length INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            score REAL NOT NULL,
+            censored INTEGER NOT NULL,
+            created REAL NOT NULL,
+            used REAL
+        );
+        CREATE INDEX IF NOT EXISTS candidates_unused
+            ON candidates (model, prompt, temperature, stop_at, quantized, scoring, score DESC, id)
+            WHERE used IS NULL AND censored = 0;
+    '''
+
+    def __init__(self, path: str):
+        self.__path = path
+
+    @classmethod
+    def in_model_dir(cls, model_dir: str):
+        return cls(str(Path(model_dir) / POOL_FILENAME))
+
+    @cached_property
+    def db(self) -> sqlite3.Connection:
+        db = connect(self.__path, '')
+        columns = {column for _, column, *_ in db.execute('PRAGMA table_info(candidates)')}
+        if columns and 'scoring' not in columns:
+            # Left from before the pool kept how candidates were generated and scored, so there is no
+            # telling which runs they would suit
+            db.execute('DROP TABLE candidates')
+        db.executescript(self.SCHEMA)
+        return db
+
+    def add(self, key: CandidateKey, max_length: int, candidates: Iterable[Tuple[str, float, bool]]):
+        """Add `(text, score, censored)` candidates generated and scored as the key says."""
+        now = time.time()
+        with transaction(self.db):
+            self.db.executemany(
+                f'INSERT INTO candidates ({", ".join(CandidateKey._fields)}, max_length, text, score, censored,'
+                ' created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(*key, max_length, text, score, int(censored), now) for text, score, censored in candidates])
+
+    def available(self, key: CandidateKey) -> int:
+        """Number of unused, uncensored candidates."""
+        (count,), = self.db.execute(
+            f'SELECT COUNT(*) FROM candidates WHERE {KEY_CONDITION} AND used IS NULL AND censored = 0', key)
+        return count
+
+    def take(self, key: CandidateKey, count: int) -> List[str]:
+        """Remove and return up to `count` of the best unused, uncensored candidates."""
+        with transaction(self.db, immediate=True):
+            rows = self.db.execute(
+                f'SELECT id, text FROM candidates WHERE {KEY_CONDITION} AND used IS NULL AND censored = 0'
+                ' ORDER BY score DESC, id LIMIT ?',
+                (*key, count)).fetchall()
+            now = time.time()
+            self.db.executemany('UPDATE candidates SET used = ? WHERE id = ?', [(now, id_) for id_, _ in rows])
+        return [text for _, text in rows]
@@ -0,0 +1,61 @@
+"""
+Int8 dynamic quantization of GPT-2, for faster CPU inference in less memory.
+
+PyTorch only quantizes `nn.Linear` layers dynamically, but GPT-2's attention and MLP layers are
+`Conv1D`s (linear layers with their weights transposed), so those are converted to `nn.Linear` first.
+The quantized model is cached with `torch.save`, as the conversion takes a while for the bigger models.
+"""
+from pathlib import Path
+import os
+
+import torch
+
+try:
+    from transformers.pytorch_utils import Conv1D
+except ImportError:  # transformers < 4.5
+    from transformers.modeling_utils import Conv1D
+
+
+def quantized_model_path(model_path: Path) -> Path:
+    """The cache is pickled modules, so it is only good for the same versions of torch and transformers."""
+    import transformers
+    return Path(model_path) / f'quantized-int8-torch{torch.__version__}-transformers{transformers.__version__}.pt'
+
+
+def linear_from_conv1d(conv: Conv1D) -> torch.nn.Linear:
+    in_features, out_features = conv.weight.shape
+    linear = torch.nn.Linear(in_features, out_features)
+    linear.weight = torch.nn.Parameter(conv.weight.detach().t().contiguous())
+    linear.bias = torch.nn.Parameter(conv.bias.detach().clone())
+    return linear
+
+
+def replace_conv1d(module: torch.nn.Module) -> torch.nn.Module:
+    """Replace every `Conv1D` in the module with the equivalent `nn.Linear`, in place."""
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            setattr(module, name, linear_from_conv1d(child))
+        else:
+            replace_conv1d(child)
+    return module
+
+
+def quantize(model: torch.nn.Module) -> torch.nn.Module:
+    model = replace_conv1d(model).eval()
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def load_or_quantize(model: torch.nn.Module, model_path: Path) -> torch.nn.Module:
+    """The quantized model, from the cache under `model_path` if it is there, or else quantized and cached."""
+    path = quantized_model_path(model_path)
+    if path.exists():
+        try:
+            return torch.load(path, weights_only=False).eval()
+        except TypeError:  # torch < 1.13, which always unpickles everything
+            return torch.load(path).eval()
+    quantized = quantize(model)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    staging_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    torch.save(quantized, staging_path)
+    os.replace(staging_path, path)
+    return quantized
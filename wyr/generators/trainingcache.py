@@ -0,0 +1,142 @@
+from array import array
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+
+
+COMPILED_LEVELS = (1, 2)
+MAGIC = b'WYRTD001'
+PREFIX = struct.Struct('<8sQ')  # Magic, then the offset of the JSON header at the end of the file
+ALIGNMENT = 8
+
+
+class CompiledTrainingData(object):
+    """
+    Training questions with their delimiters removed, and the choice spans found at each level, read
+    from a compiled file.  The file is memory-mapped, and texts and spans are only decoded as they are
+    accessed.
+    """
+    def __init__(self, buffer, header: dict):
+        self.header = header
+        self.__buffer = memoryview(buffer)
+        self.__text_offsets = self.__section('text_offsets', 'q')
+        self.__texts = self.__section('texts', 'B')
+        self.__span_offsets = {level: self.__section(f'span_offsets{level}', 'q') for level in self.levels}
+        self.__spans = {level: self.__section(f'spans{level}', 'i') for level in self.levels}
+
+    @property
+    def source_hash(self) -> str:
+        return self.header['source_hash']
+
+    @property
+    def levels(self) -> List[int]:
+        return self.header['levels']
+
+    def __len__(self):
+        return self.header['count']
+
+    def text(self, index: int) -> str:
+        """The question, with its delimiters removed but not stripped, so that the spans line up."""
+        start, end = self.__text_offsets[index], self.__text_offsets[index + 1]
+        return bytes(self.__texts[start:end]).decode('utf-8')
+
+    def spans(self, level: int, index: int) -> List[Tuple[int, int]]:
+        offsets, spans = self.__span_offsets[level], self.__spans[level]
+        return [(spans[i], spans[i + 1]) for i in range(2 * offsets[index], 2 * offsets[index + 1], 2)]
+
+    def __section(self, name: str, format: str):
+        start, length = self.header['sections'][name]
+        return self.__buffer[start:start + length].cast(format)
+
+
+class TrainingDataCache(object):
+    """
+    Directory of compiled training data, one file per training file.  A compiled file is used while the
+    training file's size and modification time are unchanged, or failing that, while its hash is.
+    """
+    def __init__(self, cache_dir: str):
+        self.__cache_dir = Path(cache_dir)
+
+    def path_for(self, source: Path) -> Path:
+        name = hashlib.sha256(str(source.resolve()).encode('utf-8')).hexdigest()[:16]
+        return self.__cache_dir / f'training-{name}.bin'
+
+    def load(self, source: Path, source_hash: Callable[[], str]) -> Optional[CompiledTrainingData]:
+        try:
+            with self.path_for(source).open('rb') as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):  # Missing, or empty
+            return None
+        try:
+            magic, header_offset = PREFIX.unpack_from(buffer)
+            if magic != MAGIC:
+                return None
+            header = json.loads(bytes(buffer[header_offset:]))
+        except (struct.error, ValueError):
+            return None
+        if header.get('byteorder') != sys.byteorder or header.get('levels') != list(COMPILED_LEVELS):
+            return None
+
+        stat = source.stat()
+        if (header['size'], header['mtime_ns']) != (stat.st_size, stat.st_mtime_ns):
+            if header['source_hash'] != source_hash():
+                return None
+        return CompiledTrainingData(buffer, header)
+
+    def save(self, source: Path, source_hash: str,
+             parsed: Iterable[Tuple[str, Dict[int, Sequence[Tuple[int, int]]]]]) -> CompiledTrainingData:
+        """
+        Compile the de-delimited text of each question, and its spans at each level, for a training file.
+        The texts are written out as they come, so only the offsets are held in memory.
+        """
+        stat = source.stat()
+        text_offsets = array('q', [0])
+        span_offsets = {level: array('q', [0]) for level in COMPILED_LEVELS}
+        spans = {level: array('i') for level in COMPILED_LEVELS}
+        header = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'source_hash': source_hash,
+            'levels': list(COMPILED_LEVELS),
+            'byteorder': sys.byteorder,
+            'sections': {},
+        }
+
+        path = self.path_for(source)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        staging_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        with staging_path.open('wb') as f:
+            f.write(bytes(PREFIX.size))
+            start = f.tell()
+            for text, level_spans in parsed:
+                encoded = text.encode('utf-8')
+                f.write(encoded)
+                text_offsets.append(text_offsets[-1] + len(encoded))
+                for level in COMPILED_LEVELS:
+                    question_spans = level_spans.get(level, ())
+                    for span in question_spans:
+                        spans[level].extend(span)
+                    span_offsets[level].append(span_offsets[level][-1] + len(question_spans))
+            header['sections']['texts'] = [start, f.tell() - start]
+            header['count'] = len(text_offsets) - 1
+
+            sections = {'text_offsets': text_offsets}
+            for level in COMPILED_LEVELS:
+                sections[f'span_offsets{level}'] = span_offsets[level]
+                sections[f'spans{level}'] = spans[level]
+            for name, data in sections.items():
+                f.write(bytes(-f.tell() % ALIGNMENT))
+                header['sections'][name] = [f.tell(), len(data) * data.itemsize]
+                data.tofile(f)
+
+            header_offset = f.tell()
+            f.write(json.dumps(header).encode('utf-8'))
+            f.seek(0)
+            f.write(PREFIX.pack(MAGIC, header_offset))
+        os.replace(staging_path, path)
+        return self.load(source, lambda: source_hash)
@@ -1,9 +1,15 @@
-from wyr.constants import QUESTION_SEPARATOR
+from wyr.constants import DEFAULT_CACHE_PATH, QUESTION_SEPARATOR
 import wyr.data
 from wyr.console import Console
-from typing import Dict, Generator, List, Tuple
+from wyr.generators.trainingcache import CompiledTrainingData, TrainingDataCache
+from typing import Dict, Generator, Iterator, List, Optional, Tuple
 from functools import cached_property, lru_cache
 from importlib import resources
+from pathlib import Path
+import hashlib
+import json
+import os.path
+import random
 
 
 class TrainingData(object):
@@ -19,44 +25,159 @@ class TrainingData(object):
        at the basic level, whereas the inner brackets indicate the logical difference between the options,
        such as a human might answer.
 
+    The parsed questions are compiled into a memory-mapped cache under `cache_dir` (see
+    `wyr.generators.trainingcache`), so they are only parsed again when the file changes.
+
     :param filename: Filename to read
+    :param cache_dir: Directory for the compiled cache; None not to cache
     :return: The structured training data readable by spacy NEP models
     """
-    def __init__(self, filename: str = None, console=None):
+    def __init__(self, filename: str = None, console=None, cache_dir: Optional[str] = DEFAULT_CACHE_PATH):
         self.__filename = filename
         if console is None:
             console = Console()
         self.__console = console
+        self.__cache_dir = cache_dir
 
     @lru_cache
-    def __new__(cls, filename: str = None):
+    def __new__(cls, filename: str = None, cache_dir: Optional[str] = DEFAULT_CACHE_PATH):
         result = object.__new__(cls)
-        cls.__init__(result, filename)
+        cls.__init__(result, filename, cache_dir=cache_dir)
         return result
 
     @cached_property
     def raw_data(self) -> List[str]:
         """Return list of uninterpreted questions (split but still with bracketed choices)."""
+        questions = list(self.iter_raw())
+        self.__console.okay(f'Loaded {len(questions)} questions from the training data')
+        return questions
+
+    def iter_raw(self) -> Iterator[str]:
+        """Iterate over the uninterpreted questions, reading the file as it goes."""
         with self.__open_data() as f:
-            questions = list(self.__split_questions(f))
-            self.__console.okay(f'Loaded {len(questions)} questions from the training data')
-            return questions
+            yield from self.__split_questions(f)
+
+    def iter_questions(self) -> Iterator[str]:
+        """Iterate over the questions without holding them all in memory."""
+        compiled = self.compiled
+        if compiled is not None:
+            # Stripping the de-delimited text is the same as `strip_question`
+            return (compiled.text(index).strip() for index in range(len(compiled)))
+        return (self.strip_question(question) for question in self.iter_raw())
 
-    def __open_data(self):
+    def sample(self, count: int, rng: random.Random = random) -> List[str]:
+        """
+        Choose `count` questions at random, like `random.sample(self.questions, count)` but in memory
+        proportional to `count`: by index from the compiled cache, or else by reservoir sampling as the
+        file is read.
+        """
+        compiled = self.compiled
+        if compiled is not None:
+            return [compiled.text(index).strip() for index in rng.sample(range(len(compiled)), count)]
+
+        reservoir = []
+        for seen, question in enumerate(self.iter_questions()):
+            if seen < count:
+                reservoir.append(question)
+            else:
+                replace = rng.randrange(seen + 1)
+                if replace < count:
+                    reservoir[replace] = question
+        if len(reservoir) < count:
+            raise ValueError('Sample larger than population')
+        rng.shuffle(reservoir)
+        return reservoir
+
+    def __open_data(self, binary: bool = False):
         if self.__filename is None:
+            if binary:
+                return resources.open_binary(wyr.data, 'training')
             return resources.open_text(wyr.data, 'training')
         else:
-            return open(self.__filename, 'r')
+            return open(self.__filename, 'rb' if binary else 'r')
+
+    @property
+    def source_name(self) -> str:
+        """Where the training data comes from, for telling sources apart."""
+        if self.__filename is None:
+            return 'wyr.data/training'
+        return os.path.abspath(self.__filename)
+
+    def __source_path(self) -> Optional[Path]:
+        if self.__filename is not None:
+            return Path(self.__filename)
+        if hasattr(resources, 'files'):
+            source = resources.files(wyr.data) / 'training'
+            return source if isinstance(source, Path) else None  # Not a plain file, e.g. in a zip
+        # Python < 3.9: `path` gives the file itself, or for a zip a temporary copy, gone on leaving it
+        with resources.path(wyr.data, 'training') as source:
+            pass
+        return source if source.exists() else None
+
+    @cached_property
+    def source_hash(self) -> str:
+        """Hash of the raw training file, from the compiled cache if the file is unchanged."""
+        if self.compiled is not None:
+            return self.compiled.source_hash
+        return self.__file_hash
+
+    @cached_property
+    def __file_hash(self) -> str:
+        """Hash of the raw training file, read in chunks."""
+        digest = hashlib.sha256()
+        with self.__open_data(binary=True) as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @cached_property
+    def compiled(self) -> Optional[CompiledTrainingData]:
+        """The parsed training data from the compiled cache, compiling it first if it is out of date."""
+        source = self.__source_path()
+        if self.__cache_dir is None or source is None:
+            return None
+        cache = TrainingDataCache(self.__cache_dir)
+        try:
+            compiled = cache.load(source, lambda: self.__file_hash)
+            if compiled is None:
+                parsed = (self.__parse_markup(question) for question in self.iter_raw())
+                compiled = cache.save(source, self.__file_hash, parsed)
+                self.__console.info(f'Compiled the training data to {cache.path_for(source)}')
+        except OSError as e:
+            self.__console.warn(f'Could not use the compiled training data: {e}')
+            return None
+        return compiled
 
     @lru_cache
     def prepare_data(self, level: int, label: str) -> List[Tuple[str, Dict[str, List[Tuple[int, int, str]]]]]:
-        return [choices
-                for choices in [self.__prepare_markup(question, level, label) for question in self.raw_data]
-                if choices]
+        return list(self.iter_prepared_data(level, label))
+
+    def iter_prepared_data(self, level: int, label: str) -> Iterator[Tuple[str, Dict[str, List[Tuple[int, int, str]]]]]:
+        compiled = self.compiled
+        if compiled is not None and level in compiled.levels:
+            for index in range(len(compiled)):
+                spans = compiled.spans(level, index)
+                if spans:
+                    yield compiled.text(index), {'entities': [(start, end, label) for start, end in spans]}
+            return
+
+        for question in self.iter_raw():
+            choices = self.__prepare_markup(question, level, label)
+            if choices:
+                yield choices
+
+    @lru_cache
+    def prepared_hash(self, level: int, label: str) -> str:
+        """Hash of the data prepared for a level, so that only edits that change it are noticed."""
+        digest = hashlib.sha256()
+        for text, annotations in self.iter_prepared_data(level, label):
+            digest.update(json.dumps([text, annotations['entities']]).encode('utf-8'))
+            digest.update(b'\n')
+        return digest.hexdigest()
 
     @cached_property
     def questions(self) -> List[str]:
-        return [self.strip_question(question) for question in self.raw_data]
+        return list(self.iter_questions())
 
     @classmethod
     def strip_question(cls, question):
@@ -69,9 +190,21 @@ class TrainingData(object):
         """
         Find choices in each question, emitting in a format suitable for spacy.
         """
+        text, spans = cls.__parse_markup(question)
+        entities = [(start, end, label) for start, end in spans.get(level, [])]
+        if entities:
+            return text, {'entities': entities}
+        else:
+            return None
 
+    @classmethod
+    def __parse_markup(cls, question: str) -> Tuple[str, Dict[int, List[Tuple[int, int]]]]:
+        """
+        Remove the delimiters from a question, returning its text and the spans of the choices found at
+        each level of brackets.
+        """
         chars = []
-        entities = []
+        spans = {}
         beginnings = []
         for c in question.strip():
             action = cls.DELIMITERS.find(c)
@@ -79,16 +212,11 @@ class TrainingData(object):
                 beginnings.append(len(chars))
             elif action == cls.END:
                 if 0 < len(beginnings):
-                    if len(beginnings) == level:
-                        entities.append((beginnings[-1], len(chars), label))
+                    spans.setdefault(len(beginnings), []).append((beginnings[-1], len(chars)))
                     beginnings.pop()
             else:
                 chars.append(c)
-
-        if entities:
-            return ''.join(chars), {'entities': entities}
-        else:
-            return None
+        return ''.join(chars), spans
 
     @staticmethod
     def __split_questions(lines) -> Generator[str, None, None]:
@@ -1,29 +1,202 @@
 import random
 import html
 from functools import cached_property
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
 from wyr.console import Console
+from wyr.database import connect, transaction
+import sqlite3
+import time
+
+
+TWEET_POOL_FILENAME = 'tweets.sqlite3'
+TWEET_MAX_AGE = 7 * 24 * 60 * 60  # Standard search only goes back about a week anyway
+
+
+class TweetPool(object):
+    """
+    Persistent pool of tweets found by each query, each served at most once.  Tweets expire `max_age`
+    seconds after they were fetched, used or not.
+
+    Alongside the tweets, the pool keeps the range of tweet ids that has been searched for each query,
+    so later searches only page through tweets that have not been seen (see `TweetGrabber.fetch`).
+    """
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS tweets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            query TEXT NOT NULL,
+            tweet_id INTEGER NOT NULL,
+            source_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            fetched REAL NOT NULL,
+            used REAL,
+            UNIQUE (query, source_id)
+        );
+        CREATE INDEX IF NOT EXISTS tweets_unused ON tweets (query, id) WHERE used IS NULL;
+        CREATE INDEX IF NOT EXISTS tweets_fetched ON tweets (fetched);
+        CREATE TABLE IF NOT EXISTS searches (
+            query TEXT PRIMARY KEY,
+            newest_id INTEGER,
+            oldest_id INTEGER,
+            exhausted INTEGER NOT NULL,
+            updated REAL NOT NULL
+        );
+    '''
+
+    def __init__(self, path: str, max_age: float = TWEET_MAX_AGE):
+        self.__path = path
+        self.max_age = max_age
+
+    @classmethod
+    def in_model_dir(cls, model_dir: str, **kwargs):
+        return cls(str(Path(model_dir) / TWEET_POOL_FILENAME), **kwargs)
+
+    @cached_property
+    def db(self) -> sqlite3.Connection:
+        return connect(self.__path, self.SCHEMA)
+
+    def expire(self):
+        self.db.execute('DELETE FROM tweets WHERE fetched < ?', (time.time() - self.max_age,))
+
+    def add(self, query: str, tweets: Iterable[Tuple[int, int, str]]) -> int:
+        """
+        Add `(tweet_id, source_id, text)` tweets found by the query, where `source_id` is the id of the
+        retweeted tweet for a retweet; returns how many were new.
+        """
+        now = time.time()
+        with transaction(self.db):
+            before = self.db.total_changes
+            self.db.executemany(
+                'INSERT OR IGNORE INTO tweets (query, tweet_id, source_id, text, fetched) VALUES (?, ?, ?, ?, ?)',
+                [(query, tweet_id, source_id, text, now) for tweet_id, source_id, text in tweets])
+            return self.db.total_changes - before
+
+    def available(self, query: str) -> int:
+        """Number of unused, unexpired tweets."""
+        (count,), = self.db.execute(
+            'SELECT COUNT(*) FROM tweets WHERE query = ? AND used IS NULL AND fetched >= ?',
+            (query, time.time() - self.max_age))
+        return count
+
+    def take(self, query: str, count: int, rng: random.Random = random) -> List[str]:
+        """Remove and return up to `count` unused tweets, chosen at random."""
+        with transaction(self.db, immediate=True):
+            rows = self.db.execute(
+                'SELECT id, text FROM tweets WHERE query = ? AND used IS NULL AND fetched >= ?',
+                (query, time.time() - self.max_age)).fetchall()
+            rows = rng.sample(rows, min(count, len(rows)))
+            now = time.time()
+            self.db.executemany('UPDATE tweets SET used = ? WHERE id = ?', [(now, id_) for id_, _ in rows])
+        return [text for _, text in rows]
+
+    def cursor(self, query: str) -> Tuple[Optional[int], Optional[int], bool]:
+        """The newest and oldest tweet ids searched for the query, and whether there are no older ones."""
+        row = self.db.execute(
+            'SELECT newest_id, oldest_id, exhausted FROM searches WHERE query = ?', (query,)).fetchone()
+        if row is None:
+            return None, None, False
+        newest_id, oldest_id, exhausted = row
+        return newest_id, oldest_id, bool(exhausted)
+
+    def set_cursor(self, query: str, newest_id: Optional[int], oldest_id: Optional[int], exhausted: bool):
+        self.db.execute(
+            'INSERT OR REPLACE INTO searches (query, newest_id, oldest_id, exhausted, updated) VALUES (?, ?, ?, ?, ?)',
+            (query, newest_id, oldest_id, int(exhausted), time.time()))
 
 
 class TweetGrabber(object):
-    def __init__(self, keys, console=None):
+    PAGE_SIZE = 100  # Most tweets standard search returns at once
+    MAX_PAGES = 5  # Most searches made to refill the pool at once
+
+    def __init__(self, keys, console=None, pool: TweetPool = None, api=None, rng: random.Random = random):
         self.__keys = keys
         if console is None:
             console = Console()
         self.__console = console
+        if pool is None:
+            pool = TweetPool(':memory:')
+        self.__pool = pool
+        if api is not None:
+            self.api = api
+        self.__rng = rng
+        self.searches = 0
 
     def random_tweet(self, query):
-        results = self.client.api.search(query, tweet_mode='extended')
-        if results:
-            self.__console.okay(f'Found {len(results)} tweets matching {query}')
-        rc = random.choice(results)
-        if hasattr(rc, 'retweeted_status'):
-            return html.unescape(rc.retweeted_status.full_text)
-        else:
-            return html.unescape(rc.full_text)
+        tweets = self.tweets(query, 1)
+        if not tweets:
+            raise IndexError(f'No tweets found matching {query}')
+        return tweets[0]
+
+    def tweets(self, query: str, count: int) -> List[str]:
+        """Up to `count` tweets matching the query, none of them served before."""
+        self.__pool.expire()
+        available = self.__pool.available(query)
+        if available < count:
+            self.fetch(query, count - available)
+        return self.__pool.take(query, count, self.__rng)
+
+    def fetch(self, query: str, wanted: int) -> int:
+        """
+        Search for at least `wanted` more tweets, if there are that many; returns how many were added.
+
+        Searches page newest first, first through tweets newer than any seen before and then, if there
+        were not enough, through ones older than any seen.  If more than `MAX_PAGES` pages of tweets
+        have been posted since the last search, the rest of them are skipped.
+        """
+        newest_id, oldest_id, exhausted = self.__pool.cursor(query)
+        added, top_id, bottom_id, reached_end = self.__search(query, wanted, since_id=newest_id)
+        if newest_id is None:
+            # The first search, so it doubles as a search of the older tweets
+            oldest_id, exhausted = bottom_id, reached_end
+        newest_id = top_id or newest_id
+        if added < wanted and oldest_id is not None and not exhausted:
+            older, _, bottom_id, exhausted = self.__search(query, wanted - added, max_id=oldest_id - 1)
+            added += older
+            oldest_id = bottom_id or oldest_id
+        self.__pool.set_cursor(query, newest_id, oldest_id, exhausted)
+        if added:
+            self.__console.okay(f'Found {added} new tweets matching {query}')
+        return added
+
+    @cached_property
+    def api(self):
+        return self.client.api
 
     @cached_property
     def client(self):
         from tweebot import TwitterClient
         return TwitterClient(self.__keys)
 
+    def __search(self, query: str, wanted: int, since_id: int = None,
+                 max_id: int = None) -> Tuple[int, Optional[int], Optional[int], bool]:
+        """
+        Page back from `max_id` (or the newest tweet) to `since_id` (or as far as search goes), until
+        `wanted` tweets are added.  Returns how many were added, the newest and oldest ids seen, and
+        whether it paged all the way back.
+        """
+        added = 0
+        top_id = bottom_id = None
+        for _ in range(self.MAX_PAGES):
+            kwargs = {name: value for name, value in [('since_id', since_id), ('max_id', max_id)] if value is not None}
+            results = self.api.search(query, count=self.PAGE_SIZE, tweet_mode='extended', **kwargs)
+            self.searches += 1
+            self.__console.count('tweet_searches_total')
+            if not results:
+                return added, top_id, bottom_id, True
+            ids = [status.id for status in results]
+            top_id = max(top_id or 0, *ids)
+            bottom_id = min(bottom_id or top_id, *ids)
+            added += self.__pool.add(query, map(self.__tweet, results))
+            max_id = bottom_id - 1
+            if len(results) < self.PAGE_SIZE:
+                return added, top_id, bottom_id, True
+            if added >= wanted:
+                break
+        return added, top_id, bottom_id, False
 
+    @staticmethod
+    def __tweet(status) -> Tuple[int, int, str]:
+        if hasattr(status, 'retweeted_status'):
+            return status.id, status.retweeted_status.id, html.unescape(status.retweeted_status.full_text)
+        else:
+            return status.id, status.id, html.unescape(status.full_text)
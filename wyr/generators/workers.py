@@ -0,0 +1,83 @@
+"""
+Sharded text generation over a pool of forked worker processes.
+
+The model is loaded once, in the parent, before the workers are forked, so every worker shares its
+weights copy-on-write rather than loading its own copy.  Each request for `n` texts is split into one
+shard per worker, each with its own seed, and the results are merged back in shard order.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from functools import cached_property
+from itertools import count as counter
+from typing import List
+import multiprocessing
+import os
+import random
+
+
+# The loaded model, inherited by the workers when they are forked
+_WORKER_AI = None
+# Each worker's own `PromptCache`, if it caches prompts
+_WORKER_PROMPT_CACHE = None
+
+
+def _init_worker(threads: int):
+    import torch
+    # Otherwise every worker starts a thread per core, and they fight over the cores
+    torch.set_num_threads(threads)
+
+
+def _generate_in_worker(kwargs: dict, cache_prompts: bool) -> List[str]:
+    global _WORKER_PROMPT_CACHE
+    if cache_prompts:
+        if _WORKER_PROMPT_CACHE is None:
+            from wyr.generators.decoding import PromptCache
+            _WORKER_PROMPT_CACHE = PromptCache(_WORKER_AI)
+        return _WORKER_PROMPT_CACHE.generate(**kwargs)
+    return _WORKER_AI.generate(return_as_list=True, **kwargs)
+
+
+class GenerationWorkers(object):
+    """
+    Generate with `workers` processes, each given `threads` torch threads (by default, an even share
+    of the cores).  Without a `seed`, the seeds are random.  If `cache_prompts`, each worker keeps a
+    `PromptCache`.
+    """
+    def __init__(self, ai, workers: int, threads: int = None, seed: int = None, cache_prompts: bool = False):
+        self.__ai = ai
+        self.workers = workers
+        self.__cache_prompts = cache_prompts
+        self.__threads = threads or max(1, (os.cpu_count() or 1) // workers)
+        if seed is None:
+            seed = random.SystemRandom().randrange(2 ** 31)
+        self.__seed = seed
+        self.__calls = counter()
+
+    @cached_property
+    def executor(self) -> ProcessPoolExecutor:
+        global _WORKER_AI
+        _WORKER_AI = self.__ai
+        # Forking is what shares the loaded weights; spawned workers would each load the model again
+        return ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context('fork'),
+            initializer=_init_worker, initargs=(self.__threads,))
+
+    def generate(self, n: int, **kwargs) -> List[str]:
+        """Generate `n` texts, taking the same arguments as `aitextgen.generate`."""
+        # Forked workers start with the same random state, so they need different seeds to generate
+        # different texts; seeds start at 1, as aitextgen ignores a seed of 0
+        call = next(self.__calls)
+        shards = [n // self.workers + (i < n % self.workers) for i in range(self.workers)]
+        futures = [
+            self.executor.submit(
+                _generate_in_worker, dict(kwargs, n=shard, seed=self.__seed_for(call, i)), self.__cache_prompts)
+            for i, shard in enumerate(shards) if shard
+        ]
+        return [text for future in futures for text in future.result()]
+
+    def close(self):
+        if 'executor' in self.__dict__:
+            self.executor.shutdown()
+            del self.executor
+
+    def __seed_for(self, call: int, shard: int) -> int:
+        return 1 + (self.__seed + call * self.workers + shard) % (2 ** 31 - 1)
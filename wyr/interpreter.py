@@ -1,6 +1,10 @@
 from collections import defaultdict
 from functools import cached_property
-from typing import List
+from itertools import tee
+from typing import Dict, Iterable, Iterator, List, Tuple
+from wyr.constants import DEFAULT_SEGMENTER
+from wyr.doccache import CacheInfo, DocCache
+from wyr.metrics import METRICS
 from wyr.trainer import TrainedModels
 import spacy
 
@@ -10,46 +14,151 @@ POSSIBLE_SENTENCE_ENDERS = '\'")]}'
 
 class ChoiceInterpreter(object):
     BASE_MODEL = 'en_core_web_sm'
+    # Components of `BASE_MODEL` that play no part in setting sentence boundaries
+    NON_SEGMENTING_PIPES = ('tagger', 'ner')
 
     """
     Attempt to interpret choices out of a string starting with "Would you rather".
     """
-    def __init__(self, models: TrainedModels, cut_length: int = 280, max_choice_count: int = 4):
+    def __init__(self, models: TrainedModels, cut_length: int = 280, max_choice_count: int = 4,
+                 batch_size: int = 64, n_process: int = 1, cache_size: int = 1024,
+                 segmenter: str = DEFAULT_SEGMENTER):
         self.__models = models
         self.__cut_length = cut_length
         self.__max_choice_count = max_choice_count
+        self.__batch_size = batch_size
+        self.__n_process = n_process
+        self.__cache_size = cache_size
+        self.__segmenter = segmenter
+
+    @cached_property
+    def __sentence_docs(self) -> DocCache:
+        return DocCache(self.__nlp, self.__cache_size, name='sentences')
+
+    @cached_property
+    def __outer_docs(self) -> DocCache:
+        return DocCache(self.__models.get_or_train(1), self.__cache_size, name='choices1')
+
+    @cached_property
+    def __inner_docs(self) -> DocCache:
+        return DocCache(self.__models.get_or_train(2), self.__cache_size, name='choices2')
+
+    def cache_info(self) -> Dict[str, CacheInfo]:
+        """Hit/miss counters of the parsed document caches, by pipeline."""
+        return {
+            'sentences': self.__sentence_docs.cache_info(),
+            'choices1': self.__outer_docs.cache_info(),
+            'choices2': self.__inner_docs.cache_info(),
+        }
+
+    def cache_clear(self):
+        for cache in [self.__sentence_docs, self.__outer_docs, self.__inner_docs]:
+            cache.cache_clear()
+
+    def warm_up(self):
+        """Load every pipeline now, rather than on the first question."""
+        self.__models.get_or_train(1)
+        self.__models.get_or_train(2)
+        return self.__nlp
 
     @cached_property
     def __nlp(self):
-        try:
-            return spacy.load(self.BASE_MODEL)
-        except IOError as _:
-            from spacy.cli import download
-            download(self.BASE_MODEL)
-            return spacy.load(self.BASE_MODEL)
+        """
+        Sentence segmentation pipeline, depending on the segmenter:
+
+         * `full`: all of `BASE_MODEL`
+         * `parser`: `BASE_MODEL` with only the dependency parser, which sets the sentence boundaries
+         * `sentencizer`: spaCy's rule-based sentencizer; no statistical model at all
+        """
+        if self.__segmenter == 'sentencizer':
+            nlp = spacy.blank('en')
+            nlp.add_pipe(nlp.create_pipe('sentencizer'))
+            return nlp
+        elif self.__segmenter == 'parser':
+            disable = self.NON_SEGMENTING_PIPES
+        elif self.__segmenter == 'full':
+            disable = ()
+        else:
+            raise ValueError(f'Unknown segmenter {self.__segmenter!r}')
+
+        with METRICS.timer('model_load_seconds', model=self.BASE_MODEL):
+            try:
+                return spacy.load(self.BASE_MODEL, disable=disable)
+            except IOError as _:
+                from spacy.cli import download
+                download(self.BASE_MODEL)
+                return spacy.load(self.BASE_MODEL, disable=disable)
             # TODO: auto-load on failure with `python -m spacy download en_core_web_sm` ?
 
     def split_question_choices(self, question):
-        question = self.__remove_trailing_broken_sentence(question[:self.__cut_length])
-        choices = self.__find_best_choices(question)
-        if len(choices) > self.__max_choice_count:
-            choices = choices[:self.__max_choice_count]
-        if len(choices) == 0:
-            choices = ['yes', 'no']
-        elif len(choices) == 1:
-            choices = [choices[0], 'no']
-        return question.strip(), choices
+        return next(self.split_question_choices_batch([question]))
+
+    def split_question_choices_batch(self, questions: Iterable[str],
+                                     batch_size: int = None) -> Iterator[Tuple[str, List[str]]]:
+        """
+        Stream many questions through the interpreter, yielding `(question, choices)` in input order.
+        Questions with fewer than two choices found are given yes/no choices.
+        """
+        for question, choices in self.find_choices_batch(questions, batch_size):
+            if len(choices) == 0:
+                choices = ['yes', 'no']
+            elif len(choices) == 1:
+                choices = [choices[0], 'no']
+            yield question, choices
+
+    def find_choices_batch(self, questions: Iterable[str],
+                           batch_size: int = None) -> Iterator[Tuple[str, List[str]]]:
+        """
+        Stream many questions through the interpreter, yielding `(question, choices)` in input order,
+        with only the choices actually found.
+
+        Each of the three pipelines (sentence splitting, `choices1` and `choices2`) sees the questions
+        through `nlp.pipe`, so spaCy can batch them (and optionally spread them over processes).  spaCy
+        reads a whole batch before parsing any of it, so nothing is yielded until `batch_size` (by
+        default, the interpreter's) questions have arrived: bigger batches parse faster, smaller ones
+        yield sooner when the questions are slow to come.
+        """
+        pipe_kwargs = dict(batch_size=batch_size or self.__batch_size, n_process=self.__n_process)
+
+        # First pass: cut the question down and drop any trailing broken sentence
+        cut_questions = (question[:self.__cut_length].strip() for question in questions)
+        cut_questions, to_split = tee(cut_questions)
+        split_docs = self.__sentence_docs.pipe(
+            (None if self.__may_be_sentence_end(question) else question for question in to_split),
+            **pipe_kwargs)
+        trimmed = (self.__remove_trailing_broken_sentence(question, doc)
+                   for question, doc in zip(cut_questions, split_docs))
+
+        # Second pass: parse the final question with each pipeline
+        trimmed, for_sents, for_outer, for_inner = tee(trimmed, 4)
+        sentence_docs = self.__sentence_docs.pipe(for_sents, **pipe_kwargs)
+        outer_docs = self.__outer_docs.pipe(for_outer, **pipe_kwargs)
+        inner_docs = self.__inner_docs.pipe(for_inner, **pipe_kwargs)
+
+        for question, sentence_doc, outer_doc, inner_doc in zip(trimmed, sentence_docs, outer_docs, inner_docs):
+            sentences = [sentence.text for sentence in sentence_doc.sents]
+            choices = self.__find_best_choices(question, sentences, outer_doc, inner_doc)
+            if len(choices) > self.__max_choice_count:
+                choices = choices[:self.__max_choice_count]
+            yield question.strip(), choices
 
     def massage_question(self, question: str) -> str:
-        question, choices = self.split_question_choices(question)
+        return self.format_question(*self.split_question_choices(question))
+
+    def massage_questions(self, questions: Iterable[str]) -> Iterator[str]:
+        for question, choices in self.split_question_choices_batch(questions):
+            yield self.format_question(question, choices)
+
+    @staticmethod
+    def format_question(question: str, choices: List[str]) -> str:
         return question + ''.join(f'\n* {choice}' for choice in choices)
 
-    def __find_best_choices(self, question: str) -> List[str]:
-        outer_choices = self.__find_model_choices(question, 1, filtered=True)
-        inner_choices = self.__find_model_choices(question, 2, filtered=True)
+    def __find_best_choices(self, question: str, sentences: List[str], outer_doc, inner_doc) -> List[str]:
+        outer_choices = self.__find_model_choices(question, sentences, outer_doc, filtered=True)
+        inner_choices = self.__find_model_choices(question, sentences, inner_doc, filtered=True)
 
         if len(outer_choices) < 2:
-            simple_choices = self.__find_simple_choices(question)
+            simple_choices = self.__find_simple_choices(sentences)
             if len(simple_choices) >= 2:
                 outer_choices = simple_choices
 
@@ -66,15 +175,15 @@ class ChoiceInterpreter(object):
         choices.extend(outer_choices[len(choices):])
         return choices
 
-    def __find_model_choices(self, question: str, level: int, *, filtered: bool = False) -> List[str]:
-        doc = self.__models.get_or_train(level)(question)
+    def __find_model_choices(self, question: str, sentences: List[str], doc, *,
+                             filtered: bool = False) -> List[str]:
         choices = [ent.text for ent in doc.ents]
         if filtered:
-            choices = list(self.__filter_choices(question, choices))
+            choices = list(self.__filter_choices(question, sentences, choices))
         return choices
 
-    def __find_simple_choices(self, question):
-        first_sentence = self.split_sentences(question)[0]
+    def __find_simple_choices(self, sentences: List[str]):
+        first_sentence = sentences[0]
         if not first_sentence.startswith('Would you rather'):
             return []
         if ' or ' in first_sentence:
@@ -90,10 +199,10 @@ class ChoiceInterpreter(object):
             return choices
         return []
 
-    def __remove_trailing_broken_sentence(self, question: str, choices: List[str] = ()) -> str:
-        question = question.strip()
-        if not self.__may_be_sentence_end(question):
-            sentences = self.split_sentences(question)
+    def __remove_trailing_broken_sentence(self, question: str, doc=None, choices: List[str] = ()) -> str:
+        """Trim the last sentence off an already stripped question; `doc` is its parse, if it needed one."""
+        if doc is not None:
+            sentences = [sentence.text for sentence in doc.sents]
             if len(sentences) > 1:
                 last_sentence = sentences[-1]
                 possible_question = question.rstrip()[:-len(last_sentence.rstrip())].rstrip()
@@ -102,12 +211,10 @@ class ChoiceInterpreter(object):
         return question
 
     def split_sentences(self, question) -> List[str]:
-        # TODO: cache?
-        return [sentence.text for sentence in self.__nlp(question).sents]
+        return [sentence.text for sentence in self.__sentence_docs(question).sents]
 
-    def __filter_choices(self, question, choices):
+    def __filter_choices(self, question, sentences, choices):
         skipped_sentences = defaultdict(list)
-        sentences = self.split_sentences(question)
         choices = list(choices)
         # Combine choices if adjacent ones are in question
         last_choice = ''
@@ -139,5 +246,3 @@ class ChoiceInterpreter(object):
             pos = len(text) - 1
         return (text[pos] in SENTENCE_ENDERS) or (
                 pos and text[pos] in POSSIBLE_SENTENCE_ENDERS and text[pos-1] in SENTENCE_ENDERS)
-
-
@@ -0,0 +1,152 @@
+"""
+Counters and histograms for the hot paths, kept for the life of the process and exported at the end
+of each run (see `--metrics`).
+
+Every `Console` records to the shared `METRICS` registry unless given another, so anything with a
+console can be instrumented through it.  Metrics are named like Prometheus metrics: counters end in
+`_total`, and timers are histograms of seconds ending in `_seconds`.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Sequence, Tuple
+import json
+import os
+import threading
+import time
+
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+clock = time.perf_counter
+
+
+class Histogram(object):
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)  # The last is for values over every bucket
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.bucket_counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': dict(zip([*map(str, self.buckets), '+Inf'], self.bucket_counts)),
+        }
+
+
+class Metrics(object):
+    """Thread-safe registry of counters and histograms, each identified by its name and labels."""
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.__buckets = buckets
+        self.__lock = threading.Lock()
+        self.__started = time.time()
+        self.__counters: Dict[Tuple[str, tuple], float] = {}
+        self.__histograms: Dict[Tuple[str, tuple], Histogram] = {}
+
+    def count(self, name: str, value: float = 1, **labels):
+        key = self.__key(name, labels)
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = self.__key(name, labels)
+        with self.__lock:
+            if key not in self.__histograms:
+                self.__histograms[key] = Histogram(self.__buckets)
+            self.__histograms[key].observe(value)
+
+    @staticmethod
+    def __key(name: str, labels: dict) -> Tuple[str, tuple]:
+        # Label values are strings once exported anyway, and a mix of types (like an HTTP status that is
+        # either a number or 'error') could not be sorted
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        started = clock()
+        try:
+            yield
+        finally:
+            self.observe(name, clock() - started, **labels)
+
+    def clear(self):
+        with self.__lock:
+            self.__counters.clear()
+            self.__histograms.clear()
+
+    def snapshot(self) -> dict:
+        with self.__lock:
+            return {
+                'time': time.time(),
+                'started': self.__started,
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in sorted(self.__counters.items())],
+                'histograms': [{'name': name, 'labels': dict(labels), **histogram.to_dict()}
+                               for (name, labels), histogram in sorted(self.__histograms.items())],
+            }
+
+    def export(self, path: str, **labels):
+        """
+        Write the metrics to `path`: as a Prometheus text file (for the node exporter's textfile
+        collector) if it ends in `.prom`, or else appended as a line of JSON.  `labels` are added to
+        every metric, to tell runs apart.
+        """
+        if path.endswith('.prom'):
+            self.write_prometheus(path, **labels)
+        else:
+            self.write_jsonl(path, **labels)
+
+    def write_jsonl(self, path: str, **labels):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'a') as f:
+            f.write(json.dumps(dict(self.snapshot(), labels=labels)) + '\n')
+
+    def write_prometheus(self, path: str, **labels):
+        snapshot = self.snapshot()
+        lines = []
+        for kind, metrics in [('counter', snapshot['counters']), ('histogram', snapshot['histograms'])]:
+            for name in sorted({metric['name'] for metric in metrics}):
+                lines.append(f'# TYPE wyr_{name} {kind}')
+                for metric in metrics:
+                    if metric['name'] != name:
+                        continue
+                    metric_labels = {**labels, **metric['labels']}
+                    if kind == 'counter':
+                        lines.append(self.__prometheus_line(name, metric_labels, metric['value']))
+                        continue
+                    cumulative = 0
+                    for bound, bucket_count in metric['buckets'].items():
+                        cumulative += bucket_count
+                        lines.append(self.__prometheus_line(f'{name}_bucket', dict(metric_labels, le=bound), cumulative))
+                    lines.append(self.__prometheus_line(f'{name}_sum', metric_labels, metric['sum']))
+                    lines.append(self.__prometheus_line(f'{name}_count', metric_labels, metric['count']))
+        lines.append('# TYPE wyr_last_export_timestamp_seconds gauge')
+        lines.append(self.__prometheus_line('last_export_timestamp_seconds', labels, snapshot['time']))
+
+        # Swap the whole file in, so the collector never reads half of it
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        staging_path = f'{path}.{os.getpid()}.tmp'
+        with open(staging_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(staging_path, path)
+
+    @classmethod
+    def __prometheus_line(cls, name: str, labels: dict, value) -> str:
+        if not labels:
+            return f'wyr_{name} {value}'
+        label_text = ','.join(f'{key}="{cls.__escape(label)}"' for key, label in sorted(labels.items()))
+        return f'wyr_{name}{{{label_text}}} {value}'
+
+    @staticmethod
+    def __escape(value) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+METRICS = Metrics()
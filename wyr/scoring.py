@@ -0,0 +1,124 @@
+"""
+Scoring of generated candidates, a whole batch at a time.
+
+Each candidate is described by a row of features, computed for the batch at once with NumPy (and a
+single `PHRASE_MATCHER` pass over all of the candidates), and scored as a weighted sum of them.  The
+default weights give the same scores as `score_question`; other weights can be loaded from JSON, or
+fitted to scores from elsewhere (like how well questions did once posted).
+"""
+from pathlib import Path
+from typing import Dict, Iterable, List, Sequence, Tuple
+import hashlib
+import json
+
+import numpy as np
+
+from wyr.generators.localgpt2 import BANNED_PHRASES, DISCOURAGED_PHRASES, PHRASE_MATCHER, PhraseMatcher
+
+
+FEATURES = [
+    'or',  # Occurrences of ' or '
+    'double_quotes',
+    'single_quotes',
+    'discouraged',  # Occurrences of discouraged phrases
+    'banned',  # Occurrences of banned phrases
+    'length',  # Characters
+    'choices',  # 1 if the choice interpreter finds at least two choices, else 0
+]
+
+DEFAULT_WEIGHTS = {
+    'or': 2.0,
+    'double_quotes': -1.0,
+    'single_quotes': -1.0,
+    'discouraged': -1.0,
+    'banned': -1000.0,
+    'length': 0.0,
+    'choices': 0.0,
+}
+
+
+class CandidateScorer(object):
+    """
+    Linear model over the candidate features.  The `choices` feature needs a `ChoiceInterpreter`, and is
+    only computed when it has a weight.
+    """
+    def __init__(self, weights: Dict[str, float] = None, interpreter=None, matcher: PhraseMatcher = PHRASE_MATCHER):
+        weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        unknown = set(weights) - set(FEATURES)
+        if unknown:
+            raise ValueError(f'Unknown scoring features: {", ".join(sorted(unknown))}')
+        self.weights = np.array([weights[feature] for feature in FEATURES], dtype=float)
+        self.interpreter = interpreter
+        self.__matcher = matcher
+        self.__columns = {phrase: column for column, phrase in enumerate(matcher.phrases)}
+        self.__discouraged = [self.__columns[phrase] for phrase in DISCOURAGED_PHRASES]
+        self.__banned = [self.__columns[phrase] for phrase in BANNED_PHRASES]
+
+    @classmethod
+    def load(cls, path: str, **kwargs):
+        """Load weights saved by `save`, as `{"weights": {feature: weight}}`."""
+        return cls(json.loads(Path(path).read_text())['weights'], **kwargs)
+
+    def save(self, path: str):
+        Path(path).write_text(json.dumps({'weights': dict(zip(FEATURES, self.weights.tolist()))}, indent=2))
+
+    @property
+    def digest(self) -> str:
+        """Short digest of what the scores depend on: the weights, and whether choices are counted."""
+        counts_choices = self.interpreter is not None and self.needs_interpreter
+        key = json.dumps([self.weights.tolist(), counts_choices])
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+    @property
+    def needs_interpreter(self) -> bool:
+        return bool(self.weights[FEATURES.index('choices')])
+
+    def features(self, texts: Sequence[str]) -> np.ndarray:
+        """A row of `FEATURES` for each text."""
+        texts = list(texts)
+        features = np.zeros((len(texts), len(FEATURES)))
+        if not texts:
+            return features
+        array = np.array(texts, dtype=str)
+        features[:, FEATURES.index('or')] = np.char.count(array, ' or ')
+        features[:, FEATURES.index('double_quotes')] = np.char.count(array, '"')
+        features[:, FEATURES.index('single_quotes')] = np.char.count(array, "'")
+        features[:, FEATURES.index('length')] = np.char.str_len(array)
+
+        hits = self.__phrase_hits(texts)
+        features[:, FEATURES.index('discouraged')] = hits[:, self.__discouraged].sum(axis=1)
+        features[:, FEATURES.index('banned')] = hits[:, self.__banned].sum(axis=1)
+
+        if self.interpreter is not None and self.needs_interpreter:
+            features[:, FEATURES.index('choices')] = [
+                len(choices) >= 2 for _, choices in self.interpreter.find_choices_batch(texts)]
+        return features
+
+    def score(self, texts: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """The score of each text, and whether it is censored (has any banned phrase)."""
+        features = self.features(texts)
+        return features @ self.weights, features[:, FEATURES.index('banned')] > 0
+
+    @classmethod
+    def fit(cls, texts: Sequence[str], targets: Iterable[float], interpreter=None, **kwargs):
+        """Fit the weights to target scores for the texts, by least squares."""
+        scorer = cls(interpreter=interpreter, **kwargs)
+        # Any nonzero weight, so the interpreter is used if there is one
+        scorer.weights[FEATURES.index('choices')] = 0.0 if interpreter is None else 1.0
+        features = scorer.features(texts)
+        weights, *_ = np.linalg.lstsq(features, np.asarray(list(targets), dtype=float), rcond=None)
+        scorer.weights = weights
+        return scorer
+
+    def __phrase_hits(self, texts: List[str]) -> np.ndarray:
+        """Occurrences of each phrase in each text, from one matcher pass over all of the texts."""
+        lowered = [text.lower() for text in texts]
+        starts = np.cumsum([0] + [len(text) + 1 for text in lowered[:-1]])
+        found = list(self.__matcher.finditer('\n'.join(lowered)))
+        hits = np.zeros((len(texts), len(self.__matcher.phrases)))
+        if found:
+            positions, phrases = zip(*found)
+            rows = np.searchsorted(starts, positions, side='right') - 1
+            columns = [self.__columns[phrase] for phrase in phrases]
+            np.add.at(hits, (rows, columns), 1)
+        return hits
@@ -1,4 +1,12 @@
+from datetime import datetime
+from functools import cached_property
+from pathlib import Path
+from typing import Callable, List, Optional
 from uuid import uuid4
+from wyr.console import Console, clock
+import json
+import os
+import time
 
 import requests
 
@@ -6,16 +14,118 @@ WOULD_YOU_RATHER_TEXT = 'Would you rather '
 WOULD_YOU_RATHER_TAG = '#WouldYouRather '
 
 
+class RateLimiter(object):
+    """
+    Token bucket for posting, filled from Mastodon's `X-RateLimit-Remaining` and `X-RateLimit-Reset`
+    response headers.  The remaining posts are spread evenly until the limit resets (and never closer
+    together than `min_interval`); once none remain, posting waits for the reset.
+    """
+    def __init__(self, min_interval: float = 0.0, clock=time.time, sleep=time.sleep):
+        self.min_interval = min_interval
+        self.__clock = clock
+        self.__sleep = sleep
+        self.__remaining: Optional[int] = None
+        self.__reset: Optional[float] = None
+        self.__last: Optional[float] = None
+
+    def wait(self):
+        now = self.__clock()
+        interval = self.min_interval
+        if self.__remaining is not None and self.__reset is not None and self.__reset > now:
+            if self.__remaining <= 0:
+                self.__sleep(self.__reset - now)
+                return
+            interval = max(interval, (self.__reset - now) / self.__remaining)
+        if self.__last is not None and self.__last + interval > now:
+            self.__sleep(self.__last + interval - now)
+
+    def update(self, headers):
+        self.__last = self.__clock()
+        try:
+            self.__remaining = int(headers['X-RateLimit-Remaining'])
+            reset = headers['X-RateLimit-Reset'].replace('Z', '+00:00')
+            self.__reset = datetime.fromisoformat(reset).timestamp()
+        except (KeyError, ValueError):
+            pass
+
+
+class RetryQueue(object):
+    """
+    Durable queue of posts that failed, as a JSON-lines file.  Each entry keeps its idempotency key,
+    so a post that did reach the server is not duplicated when retried.
+    """
+    def __init__(self, path: str):
+        self.__path = Path(path)
+
+    def push(self, payload: dict, key: str):
+        self.__path.parent.mkdir(parents=True, exist_ok=True)
+        with self.__path.open('a') as f:
+            f.write(json.dumps({'payload': payload, 'key': key, 'queued': time.time()}) + '\n')
+
+    def retry(self, send: Callable[[dict, str], bool]) -> int:
+        """
+        Pass every queued post to `send(payload, key)`, which returns whether the post is done with;
+        any that are not go back in the queue.  Returns how many posts were tried.
+        """
+        # Move the file aside first, so posts queued meanwhile are not tried twice; one left over from an
+        # interrupted run is taken again before anything newer
+        taken = self.__path.with_name(self.__path.name + '.taken')
+        if not taken.exists():
+            if not self.__path.exists():
+                return 0
+            os.replace(self.__path, taken)
+        with taken.open() as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+        for i, entry in enumerate(entries):
+            if not send(entry['payload'], entry['key']):
+                self.push(entry['payload'], entry['key'])
+            # Only drop each entry once it is resolved, so a crash cannot lose posts; at worst one is
+            # sent again, and its idempotency key stops it being posted twice
+            self.__write(taken, entries[i + 1:])
+        taken.unlink()
+        return len(entries)
+
+    @staticmethod
+    def __write(path: Path, entries: List[dict]):
+        staging_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        with staging_path.open('w') as f:
+            f.writelines(json.dumps(entry) + '\n' for entry in entries)
+        os.replace(staging_path, path)
+
+    def __len__(self):
+        if not self.__path.exists():
+            return 0
+        with self.__path.open() as f:
+            return sum(1 for line in f if line.strip())
+
+
 class MastodonPoster:
     MAX_CHOICE_LENGTH = 50
-    def __init__(self, token_file, interpreter, api='https://botsin.space'):
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, token_file, interpreter, api='https://botsin.space', console: Console = None,
+                 retry_queue: RetryQueue = None, min_interval: float = 0.0):
         self.__api = api.strip().rstrip('/')
         self.__interpreter = interpreter
         with open(token_file, 'r') as f:
             self.__token = f.read().strip()
+        if console is None:
+            console = Console()
+        self.__console = console
+        self.__retry_queue = retry_queue
+        self.rate_limiter = RateLimiter(min_interval)
+
+    @cached_property
+    def session(self) -> requests.Session:
+        session = requests.Session()
+        session.headers['Authorization'] = f'Bearer {self.__token}'
+        return session
 
     def post(self, toot):
-        toot, choices = self.__interpreter.split_question_choices(toot)
+        return self.post_choices(*self.__interpreter.split_question_choices(toot))
+
+    def post_choices(self, toot, choices):
+        """Post a question whose choices have already been split out by the interpreter."""
         ret_values = []
         j = {
             'status': self.__add_tag(toot),
@@ -35,18 +145,50 @@ class MastodonPoster:
                 'expires_in': 24 * 60 * 60,
             }
             ret_values.extend(f'* {choice}' for choice in j['poll']['options'])
-        resp = requests.post(
-            f'{self.__api}/api/v1/statuses',
-            json=j,
-            headers={
-                'Authorization': f'Bearer {self.__token}',
-                'Idempotency-Key': str(uuid4()),
-            },
-        )
-
-        print(resp.json())
+
+        key = str(uuid4())
+        if not self.__send(j, key) and self.__retry_queue is not None:
+            self.__retry_queue.push(j, key)
+            self.__console.warn('Queued the post to retry later')
         return '\n'.join(ret_values)
 
+    def retry_queued(self):
+        """Try again to send every post in the retry queue; any that fail again go back in it."""
+        if self.__retry_queue is None:
+            return
+        retried = self.__retry_queue.retry(self.__send)
+        if retried:
+            self.__console.info(f'Retried {retried} queued post(s)')
+        self.__console.count('mastodon_retries_total', retried)
+
+    def __send(self, payload: dict, key: str) -> bool:
+        """Post a status, returning whether it is done with (posted, or rejected for good)."""
+        with self.__console.timed(metric='mastodon_wait_seconds'):
+            self.rate_limiter.wait()
+        started = clock()
+        try:
+            resp = self.session.post(
+                f'{self.__api}/api/v1/statuses',
+                json=payload,
+                headers={'Idempotency-Key': key},
+            )
+        except requests.RequestException as e:
+            self.__console.observe('mastodon_post_seconds', clock() - started, status='error')
+            self.__console.count('mastodon_posts_total', outcome='failed')
+            self.__console.warn(f'Could not post to {self.__api}: {e}')
+            return False
+
+        self.__console.observe('mastodon_post_seconds', clock() - started, status=resp.status_code)
+        self.rate_limiter.update(resp.headers)
+        if resp.ok:
+            self.__console.count('mastodon_posts_total', outcome='posted')
+            print(resp.json())
+            return True
+        self.__console.warn(f'Posting failed with {resp.status_code}: {resp.text}')
+        done = resp.status_code not in self.RETRY_STATUSES
+        self.__console.count('mastodon_posts_total', outcome='rejected' if done else 'failed')
+        return done
+
     def __add_tag(self, toot: str):
         if toot.startswith(WOULD_YOU_RATHER_TEXT):
             return WOULD_YOU_RATHER_TAG + toot[len(WOULD_YOU_RATHER_TEXT):]
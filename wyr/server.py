@@ -0,0 +1,149 @@
+"""
+A long-lived `wyr serve` process that keeps generators and models loaded between runs, and the thin
+`wyr client` that forwards ordinary command lines to it.
+"""
+from contextlib import redirect_stderr
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import StringIO
+from wyr.console import Console
+import json
+import sys
+import traceback
+import urllib.error
+import urllib.request
+
+
+class WyrServer(HTTPServer):
+    """
+    Answers `POST /run` requests, whose JSON body is `{"argv": [...]}` -- the same arguments the `wyr`
+    command line takes -- by streaming back what that command would print.  Generators, trained models
+    and the choice interpreter are kept between requests, so only the first request pays to load them.
+
+    Requests are handled one at a time, since none of the models are safe to share between threads.
+    """
+    def __init__(self, address, console: Console = None):
+        super().__init__(address, WyrRequestHandler)
+        from wyr.commands import Resources
+        self.resources = Resources()
+        if console is None:
+            console = Console()
+        self.console = console
+
+
+class WyrRequestHandler(BaseHTTPRequestHandler):
+    server: WyrServer
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.__reply(200, 'OK\n')
+        else:
+            self.__reply(404, 'Not found\n')
+
+    def do_POST(self):
+        if self.path != '/run':
+            self.__reply(404, 'Not found\n')
+            return
+
+        # A browser can POST text/plain across sites without asking first, but not JSON, and it always
+        # says where the request came from; the client is never a browser
+        if self.headers.get('Origin') is not None:
+            self.__reply(403, 'Cross-origin requests are not allowed\n')
+            return
+        if self.headers.get_content_type() != 'application/json':
+            self.__reply(415, 'Expected a Content-Type of application/json\n')
+            return
+
+        from wyr.commands import build_parser, run
+        errors = StringIO()
+        try:
+            argv = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))['argv']
+            with redirect_stderr(errors):
+                args = build_parser().parse_args(argv)
+        except SystemExit:
+            self.__reply(400, errors.getvalue() or 'Invalid arguments\n')
+            return
+        except (ValueError, KeyError, TypeError) as e:
+            self.__reply(400, f'Invalid request: {e}\n')
+            return
+        if not hasattr(args, 'generator'):
+            self.__reply(400, 'Expected a generator subcommand\n')
+            return
+
+        # The status is only sent with the first output, so arguments that turn out to be bad while the
+        # generator is built (which exits, as it would on the command line) can still get a 400
+        started = False
+
+        def write(*values, sep=' ', end='\n', flush=False, **_):
+            nonlocal started
+            if not started:
+                started = True
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; charset=utf-8')
+                self.end_headers()
+            self.wfile.write((sep.join(map(str, values)) + end).encode('utf-8'))
+            if flush:
+                self.wfile.flush()
+
+        console = self.server.console
+        with console.timed(f'Running {" ".join(argv)}', 'Answered request in {0:.3f}s',
+                           'server_request_seconds'):
+            try:
+                run(args, self.server.resources, print=write)
+            except SystemExit as e:
+                message = f'{e.code}\n' if isinstance(e.code, str) else 'Invalid arguments\n'
+                if started:
+                    write(f'Error: {message}', end='', flush=True)
+                else:
+                    self.__reply(400, message)
+            except Exception:
+                console.warn(traceback.format_exc())
+                write('Error: the server failed to complete this request', flush=True)
+            else:
+                if not started:
+                    write(end='')
+
+    def log_message(self, format, *args):
+        self.server.console.info(format % args)
+
+    def __reply(self, status: int, text: str):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(args):
+    console = Console()
+    server = WyrServer((args.host, args.port), console)
+    console.okay(f'Serving wyr on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def forward(args):
+    """Send a command line to a running `wyr serve`, printing its output as it arrives."""
+    argv = list(args.argv)
+    if argv[:1] == ['--']:
+        argv = argv[1:]
+    request = urllib.request.Request(
+        args.server.rstrip('/') + '/run',
+        data=json.dumps({'argv': argv}).encode('utf-8'),
+        headers={'Content-Type': 'application/json'},
+    )
+    try:
+        with urllib.request.urlopen(request) as response:
+            for line in response:
+                sys.stdout.write(line.decode('utf-8'))
+                sys.stdout.flush()
+    except urllib.error.HTTPError as e:
+        sys.stderr.write(e.read().decode('utf-8'))
+        sys.exit(1)
+    except urllib.error.URLError as e:
+        Console().warn(f'Could not reach wyr server at {args.server}: {e.reason}')
+        sys.exit(1)
@@ -0,0 +1,3 @@
+"""
+Stand-ins for what wyr depends on, shared by the tests and the benchmark suites.
+"""
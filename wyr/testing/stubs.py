@@ -0,0 +1,199 @@
+"""
+Local stand-ins for the web services wyr talks to, for testing and benchmarking without the network.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from types import SimpleNamespace
+import json
+import math
+import random
+import re
+import time
+import uuid
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    HTTP server on a free local port, run in a background thread while used as a context manager.
+    Subclasses provide the request handler and keep count of the requests they see.
+    """
+    daemon_threads = True
+    handler = BaseHTTPRequestHandler
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), self.handler)
+        self.lock = Lock()
+        self.requests = 0
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def count_request(self) -> int:
+        with self.lock:
+            self.requests += 1
+            return self.requests
+
+    def __enter__(self):
+        Thread(target=self.serve_forever, name='wyr-stub', daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+class QuietHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def reply_json(self, status: int, body, headers=()):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_json(self):
+        return json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'null')
+
+
+class StubInferKitHandler(QuietHandler):
+    server: 'StubInferKit'
+
+    def do_POST(self):
+        self.server.count_request()
+        self.read_json()
+        time.sleep(self.server.latency)
+        roll = self.server.random()
+        if roll < self.server.error_rate / 2:
+            self.reply_json(502, {'error': 'Bad gateway'})
+        elif roll < self.server.error_rate:
+            self.reply_json(429, {'error': 'Too many requests'}, [('Retry-After', '0')])
+        else:
+            self.reply_json(200, {'data': {'text': ' have a dog or a cat?', 'isCompleted': True}})
+
+
+class StubInferKit(StubServer):
+    """
+    Stand-in for the InferKit generation API, answering after `latency` seconds, and failing with
+    502 or 429 (with a `Retry-After`) for `error_rate` of requests.
+    """
+    handler = StubInferKitHandler
+
+    def __init__(self, latency: float = 0.05, error_rate: float = 0.2, seed: int = 0):
+        super().__init__()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.__random = random.Random(seed)
+
+    def random(self) -> float:
+        with self.lock:
+            return self.__random.random()
+
+
+class FakeMastodonHandler(QuietHandler):
+    server: 'FakeMastodon'
+
+    def do_POST(self):
+        if self.path != '/api/v1/statuses':
+            self.reply_json(404, {'error': 'Record not found'})
+            return
+        self.server.count_request()
+        payload = self.read_json()
+        status, body, headers = self.server.accept(payload, self.headers.get('Idempotency-Key'))
+        self.reply_json(status, body, headers)
+
+
+class FakeMastodon(StubServer):
+    """
+    Stand-in for a Mastodon instance's status API that enforces a rate limit of `limit` posts every
+    `period` seconds, reporting it in `X-RateLimit-*` headers and answering 429 once it is used up.
+    Posts repeated with the same `Idempotency-Key` are only counted once.
+    """
+    handler = FakeMastodonHandler
+
+    def __init__(self, limit: int = 5, period: float = 1.0):
+        super().__init__()
+        self.limit = limit
+        self.period = period
+        self.statuses = {}
+        self.rejected = 0
+        self.__window_start = time.time()
+        self.__used = 0
+
+    def accept(self, payload, key):
+        with self.lock:
+            now = time.time()
+            if now >= self.__window_start + self.period:
+                self.__window_start = now
+                self.__used = 0
+            # Rounded up, so clients that wait until the reset never retry before it
+            reset_ms = math.ceil((self.__window_start + self.period) * 1000)
+            reset = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(reset_ms // 1000)) + f'.{reset_ms % 1000:03d}Z'
+
+            if key is not None and key in self.statuses:
+                status, body = 200, self.statuses[key]
+            elif self.__used >= self.limit:
+                self.rejected += 1
+                status, body = 429, {'error': 'Too many requests'}
+            else:
+                self.__used += 1
+                body = {'id': str(len(self.statuses) + 1), 'content': payload.get('status')}
+                self.statuses[key or str(uuid.uuid4())] = body
+                status = 200
+            headers = [
+                ('X-RateLimit-Limit', str(self.limit)),
+                ('X-RateLimit-Remaining', str(self.limit - self.__used)),
+                ('X-RateLimit-Reset', reset),
+            ]
+            return status, body, headers
+
+
+class StubInterpreter(object):
+    """Splits sentences on end punctuation and choices on ` or `, standing in for `ChoiceInterpreter`."""
+    def split_sentences(self, text):
+        return re.findall(r'.+?(?:[.!?]+\s*|$)', text, flags=re.DOTALL) or [text]
+
+    def split_question_choices(self, text):
+        return text, ['yes', 'no']
+
+    def find_choices_batch(self, questions, batch_size=None):
+        """Take whatever is either side of each ` or ` as the choices."""
+        for question in questions:
+            choices = question.rstrip('?').split(' or ')
+            yield question, choices if len(choices) >= 2 else []
+
+
+class FakeTwitterApi(object):
+    """
+    Stand-in for tweepy's `API.search`, over `count` tweets with increasing ids (`retweet_rate` of them
+    retweets of an earlier tweet), counting the searches made.  `post` adds newer tweets.
+    """
+    def __init__(self, count: int = 1000, retweet_rate: float = 0.2, seed: int = 0):
+        self.statuses = []
+        self.searches = 0
+        self.__random = random.Random(seed)
+        self.__retweet_rate = retweet_rate
+        self.post(count)
+
+    def post(self, count: int):
+        for _ in range(count):
+            id_ = 1000 + 7 * len(self.statuses)
+            originals = [status for status in self.statuses if not hasattr(status, 'retweeted_status')]
+            if originals and self.__random.random() < self.__retweet_rate:
+                status = SimpleNamespace(id=id_, retweeted_status=self.__random.choice(originals))
+                status.full_text = f'RT {status.retweeted_status.full_text}'
+            else:
+                status = SimpleNamespace(id=id_, full_text=f'Would you rather tweet number {id_} &amp; more?')
+            self.statuses.append(status)
+
+    def search(self, q, count=15, since_id=None, max_id=None, tweet_mode=None):
+        self.searches += 1
+        found = [status for status in reversed(self.statuses)
+                 if (since_id is None or status.id > since_id) and (max_id is None or status.id <= max_id)]
+        return found[:count]
@@ -1,113 +1,325 @@
 from wyr.generators.trainingdata import TrainingData
 from wyr.constants import DEFAULT_MODEL_PATH
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import os
 import os.path
+import shutil
 import spacy
+import spacy.about
 from spacy.util import minibatch, compounding
 import random
 import warnings
 from pathlib import Path
 from functools import lru_cache
-from wyr.console import Console
+from typing import Dict, List, Optional, Tuple
+from wyr.console import Console, clock
+
+
+TRAINING_PARAMS = {
+    'n_iter': 40,  # Maximum number of epochs
+    'dropout': 0.35,
+    'batch_sizes': (1.0, 4.0, 1.001),  # Compounding minibatch sizes: start, stop, compound
+    'holdout': 0.1,  # Fraction of examples held out to choose the best epoch by its entity F-score
+    # Fraction of examples never trained on, not even by the final epochs, to check fine-tuning against
+    'gate_holdout': 0.05,
+    'patience': 5,  # Stop after this many epochs without a better F-score; None to always run n_iter
+    'checkpoint_every': 5,  # Epochs between checkpoints
+    # Epochs over every example, the held-out ones included, once the best epoch is chosen
+    'final_epochs': 1,
+    'seed': 0,
+    # Fine-tuning a trained model on examples added since, rather than training from scratch
+    'incremental': True,
+    'incremental_epochs': 10,
+    'replay_ratio': 2.0,  # Old examples replayed per new one, so the model does not forget them
+    'max_incremental_fraction': 0.25,  # Train from scratch when more of the examples than this are new
+    'incremental_tolerance': 0.02,  # Train from scratch when the F-score drops more than this
+}
+
+LEVELS = (1, 2)
+
+# Parameters that only affect fine-tuning, so changing them does not invalidate a trained model
+INCREMENTAL_PARAMS = {
+    'incremental', 'incremental_epochs', 'replay_ratio', 'max_incremental_fraction', 'incremental_tolerance'}
+
+TrainingReport = namedtuple('TrainingReport', ['level', 'label', 'epochs', 'seconds', 'f_score', 'resumed_from',
+                                               'incremental'], defaults=[False])
+
+
+def example_digest(example) -> str:
+    """Short stable digest of a prepared `(text, annotations)` example."""
+    text, annotations = example
+    return hashlib.sha1(json.dumps([text, annotations['entities']]).encode('utf-8')).hexdigest()[:16]
+
+
+def entity_f_score(nlp, examples, label: str) -> float:
+    """F-score of the entities `nlp` finds in the examples, against their annotations."""
+    true_positives = false_positives = false_negatives = 0
+    texts = [text for text, _ in examples]
+    for doc, (_, annotations) in zip(nlp.pipe(texts), examples):
+        gold = {(start, end) for start, end, _ in annotations['entities']}
+        found = {(ent.start_char, ent.end_char) for ent in doc.ents if ent.label_ == label}
+        true_positives += len(gold & found)
+        false_positives += len(found - gold)
+        false_negatives += len(gold - found)
+    if not true_positives:
+        return 0.0
+    precision = true_positives / (true_positives + false_positives)
+    recall = true_positives / (true_positives + false_negatives)
+    return 2 * precision * recall / (precision + recall)
+
+
+def _train_in_worker(model_dir: str, training_data: str, level: int, training_params: dict) -> TrainingReport:
+    models = TrainedModels(model_dir, training_data, training_params=training_params)
+    models.train(level)
+    return models.reports[level]
 
 
 class TrainedModels(object):
     def __init__(self, model_dir: str = DEFAULT_MODEL_PATH,
-                 training_data: str = None, console: Console = None):
+                 training_data: str = None, console: Console = None, training_params: dict = None):
         self.training_data = TrainingData(training_data)
+        self.__training_data_filename = training_data
         self.model_dir = model_dir
         if console is None:
             console = Console()
         self.__console = console
+        self.training_params = dict(TRAINING_PARAMS, **(training_params or {}))
+        self.reports: Dict[int, TrainingReport] = {}
 
     @lru_cache
     def get_or_train(self, level: int):
+        self.__recover(level)
         if self.__needs_training(level):
+            new_examples = self.__new_examples(level) if self.training_params['incremental'] else None
+            if new_examples:
+                self.__console.info(f'Fine-tuning {self.label(level)} on {len(new_examples)} new example(s)...')
+                return self.update(level, new_examples)
             self.__console.info(f'Need to train {self.label(level)}...')
-            return self.__train(level)
+            # Any other level that needs training from scratch is trained alongside, in parallel
+            others = [other for other in LEVELS if other != level and self.__needs_full_training(other)]
+            if not others:
+                return self.train(level)
+            self.__train_in_parallel([level, *others])
 
         try:
-            return spacy.load(self.model_path(level))
+            with self.__console.timed(metric='model_load_seconds', model=self.label(level)):
+                return spacy.load(self.model_path(level))
         except:  # Need to train :/
             self.__console.warn(f'Model {self.label(level)} not found.  Building it...')
-            return self.__train(level)
+            return self.train(level)
+
+    def __needs_full_training(self, level: int) -> bool:
+        """Whether the level needs training from scratch, rather than loading or fine-tuning."""
+        self.__recover(level)
+        if not self.__needs_training(level):
+            return False
+        return not (self.training_params['incremental'] and self.__new_examples(level))
 
     def __needs_training(self, level: int):
         # Needs training if does not exist
-        if not self.model_qsize_path(level).exists():
+        try:
+            manifest = json.loads(self.model_manifest_path(level).read_text())
+        except (OSError, ValueError):
             return True
 
-        # Needs training if more questions exist now
-        try:
-            qsize = int(self.model_qsize_path(level).read_text().strip())
-        except:
+        # Needs training if anything that went into the model has changed since
+        expected = self.manifest(level, prepared_hash=False)
+        if any(manifest.get(key) != value for key, value in expected.items()):
+            return True
+
+        # The raw file is unchanged, so the prepared data must be too; otherwise check whether the edits
+        # touched this level's examples at all
+        if manifest.get('source_hash') == self.training_data.source_hash:
+            return False
+        if manifest.get('data_hash') != self.training_data.prepared_hash(level, self.label(level)):
             return True
-        else:
-            if qsize < len(self.training_data.questions):
-                return True
 
         # Does not need retrained
         return False
 
+    def __new_examples(self, level: int) -> Optional[list]:
+        """
+        The examples added since the model for a level was trained, if it can be fine-tuned on them: only
+        the data has changed, nothing was edited or removed, and not too much was added.
+        """
+        try:
+            manifest = json.loads(self.model_manifest_path(level).read_text())
+            known = set(self.model_examples_path(level).read_text().split())
+        except (OSError, ValueError):
+            return None
+        expected = self.manifest(level, prepared_hash=False)
+        if any(manifest.get(key) != value for key, value in expected.items()) or 'f_score' not in manifest:
+            return None
+
+        prepared_data = self.training_data.prepare_data(level, self.label(level))
+        digests = [example_digest(example) for example in prepared_data]
+        if not known.issubset(digests):
+            return None
+        new_examples = [example for example, digest in zip(prepared_data, digests) if digest not in known]
+        if len(new_examples) > self.training_params['max_incremental_fraction'] * len(prepared_data):
+            return None
+        return new_examples
+
+    def manifest(self, level: int, prepared_hash: bool = True) -> dict:
+        """
+        Everything a trained model depends on: the training data, the spaCy version and the training
+        parameters.  Models are retrained exactly when this changes.
+        """
+        manifest = {
+            'spacy_version': spacy.about.__version__,
+            'training_params': json.loads(json.dumps(
+                {key: value for key, value in self.training_params.items() if key not in INCREMENTAL_PARAMS})),
+        }
+        if prepared_hash:
+            manifest['source_hash'] = self.training_data.source_hash
+            manifest['data_hash'] = self.training_data.prepared_hash(level, self.label(level))
+        return manifest
+
     def model_path(self, level: int) -> Path:
         return Path(f'{self.model_dir}/{self.label(level)}')
 
-    def model_qsize_path(self, level: int) -> Path:
-        return self.model_path(level) / 'qsize'
+    def model_manifest_path(self, level: int) -> Path:
+        return self.model_path(level) / 'manifest.json'
+
+    def model_examples_path(self, level: int) -> Path:
+        """Digests of the examples the model was trained on, one per line."""
+        return self.model_path(level) / 'examples.txt'
+
+    def checkpoint_path(self, level: int) -> Path:
+        return Path(f'{self.model_dir}/{self.label(level)}.checkpoint')
 
     def label(self, level: int) -> str:
         return f'choices{level}'
 
-    def retrain(self):
+    def retrain(self, levels: List[int] = LEVELS, parallel: bool = True):
+        """
+        Retrain the given levels, each in its own process unless `parallel` is off.  A checkpoint left by
+        an interrupted training run is carried on from, rather than starting over.
+        """
         self.get_or_train.cache_clear()
-        for level in [1, 2]:
-            self.__console.info(f'Retraining {self.label(level)}...')
-            self.__train(level)
+        with self.__console.timed(f'Retraining {len(levels)} model(s)', 'Retrained in {0:.3f}s'):
+            if not parallel or len(levels) < 2:
+                for level in levels:
+                    self.__console.info(f'Retraining {self.label(level)}...')
+                    self.train(level)
+                return
+            self.__train_in_parallel(levels)
+
+    def __train_in_parallel(self, levels: List[int]):
+        """Train each of the levels in its own process, saving the models for loading from disk."""
+        with ProcessPoolExecutor(max_workers=len(levels)) as executor:
+            futures = [
+                executor.submit(_train_in_worker, self.model_dir, self.__training_data_filename, level,
+                                self.training_params)
+                for level in levels
+            ]
+            for future in futures:
+                report = future.result()
+                self.reports[report.level] = report
+                self.__report(report)
 
-    def __train(self, level: int, n_iter=40):
+    def train(self, level: int, resume: bool = True):
+        """
+        Train the model for a level, checkpointing under the model directory as it goes, and keeping
+        whichever epoch scores best on the held-out examples.  If `resume`, carry on from the last
+        checkpoint left by an interrupted run.
+        """
+        params = self.training_params
         label = self.label(level)
-        prepared_data = self.training_data.prepare_data(level, label)
+        train_data, holdout_data, gate_data = self.__split_data(level)
         model_path = self.model_path(level)
+        checkpoint_path = self.checkpoint_path(level)
 
-        # Setup model path, verify access
-        model_path.mkdir(parents=True, exist_ok=True)
+        # Setup model directory, verify access
+        Path(self.model_dir).mkdir(parents=True, exist_ok=True)
+        if not resume:
+            self.__clear_checkpoint(level)
 
-        random.seed(0)
-        nlp = spacy.blank('en')
-        self.__console.info('Created blank model')
-
-        # Add entity recognizer to model if it's not in the pipeline
-        # nlp.create_pipe works for built-ins that are registered with spaCy
-        if 'ner' not in nlp.pipe_names:
-            ner = nlp.create_pipe('ner')
-            nlp.add_pipe(ner)
-        # otherwise, get it, so we can add labels to it
-        else:
+        random.seed(params['seed'])
+        manifest = self.manifest(level)
+        state = self.__load_checkpoint_state(level, manifest) if resume else None
+        if state is not None:
+            nlp = spacy.load(checkpoint_path / 'last')
+            optimizer = nlp.resume_training()
             ner = nlp.get_pipe('ner')
+            self.__console.info(f'Resuming {label} from epoch {state["epoch"]}')
+        else:
+            state = {'epoch': 0, 'best_f_score': -1.0, 'stale_epochs': 0, 'manifest': manifest}
+            nlp = spacy.blank('en')
+            self.__console.info('Created blank model')
+
+            # Add entity recognizer to model if it's not in the pipeline
+            # nlp.create_pipe works for built-ins that are registered with spaCy
+            if 'ner' not in nlp.pipe_names:
+                ner = nlp.create_pipe('ner')
+                nlp.add_pipe(ner)
+            # otherwise, get it, so we can add labels to it
+            else:
+                ner = nlp.get_pipe('ner')
 
-        ner.add_label(label)
+            ner.add_label(label)
 
-        optimizer = nlp.begin_training()
+            optimizer = nlp.begin_training()
+        resumed_from = state['epoch']
 
         move_names = list(ner.move_names)
         # get names of other pipes to disable them during training
         pipe_exceptions = ["ner", "trf_wordpiecer", "trf_tok2vec"]
         other_pipes = [pipe for pipe in nlp.pipe_names if pipe not in pipe_exceptions]
         # only train NER
+        started = clock()
         with nlp.disable_pipes(*other_pipes) and warnings.catch_warnings():
             # show warnings for misaligned entity spans once
             warnings.filterwarnings("once", category=UserWarning, module='spacy')
 
-            sizes = compounding(1.0, 4.0, 1.001)
+            sizes = compounding(*params['batch_sizes'])
             # batch up the examples using spaCy's minibatch
-            with self.__console.timed(f'Training model {label}', 'Trained model in {0:.3f}s'):
-                for itn in range(n_iter):
-                    random.shuffle(prepared_data)
-                    batches = minibatch(prepared_data, size=sizes)
-                    losses = {}
-                    for batch in batches:
-                        texts, annotations = zip(*batch)
-                        nlp.update(texts, annotations, sgd=optimizer, drop=0.35, losses=losses)
-                    self.__console.info("Losses", losses)
+            with self.__console.timed(f'Training model {label}', 'Trained model in {0:.3f}s',
+                                      'training_seconds', model=label, mode='full'):
+                while state['epoch'] < params['n_iter']:
+                    # Shuffle by epoch, so a resumed run sees the same batches it would have
+                    epoch_data = list(train_data)
+                    random.Random(params['seed'] + state['epoch']).shuffle(epoch_data)
+                    losses = self.__train_epoch(nlp, optimizer, epoch_data, sizes)
+                    state['epoch'] += 1
+                    self.__console.count('training_epochs_total', model=label, mode='full')
+
+                    f_score = entity_f_score(nlp, holdout_data, label) if holdout_data else 0.0
+                    self.__console.info("Epoch", state['epoch'], "Losses", losses, f"F-score {f_score:.3f}")
+                    if f_score > state['best_f_score'] or not holdout_data:
+                        state['best_f_score'] = f_score
+                        state['stale_epochs'] = 0
+                        nlp.to_disk(checkpoint_path / 'best')
+                        (checkpoint_path / 'best.json').write_text(json.dumps({'f_score': f_score}))
+                    else:
+                        state['stale_epochs'] += 1
+
+                    stopping = params['patience'] is not None and state['stale_epochs'] >= params['patience']
+                    if stopping or state['epoch'] % params['checkpoint_every'] == 0:
+                        nlp.to_disk(checkpoint_path / 'last')
+                        (checkpoint_path / 'state.json').write_text(json.dumps(state))
+                    if stopping:
+                        self.__console.info(f'No better F-score for {state["stale_epochs"]} epochs; stopping')
+                        break
+
+            # Keep the best epoch
+            nlp = spacy.load(checkpoint_path / 'best')
+            if holdout_data and params['final_epochs']:
+                # The held-out examples only chose the epoch, so train on them too rather than leave them out
+                # of the saved model; only the gate examples are never trained on
+                optimizer = nlp.resume_training()
+                with self.__console.timed(f'Training model {label} on every example', 'Trained model in {0:.3f}s',
+                                          'training_seconds', model=label, mode='final'):
+                    for epoch in range(params['final_epochs']):
+                        epoch_data = train_data + holdout_data
+                        random.Random(params['seed'] - 1 - epoch).shuffle(epoch_data)
+                        losses = self.__train_epoch(nlp, optimizer, epoch_data, sizes)
+                        self.__console.count('training_epochs_total', model=label, mode='final')
+                        self.__console.info("Final epoch", epoch + 1, "Losses", losses)
+        elapsed = clock() - started
 
         # test the trained model
         test_text = random.choice(self.training_data.questions)
@@ -116,10 +328,10 @@ class TrainedModels(object):
         for ent in doc.ents:
             self.__console.info(ent.label_, ent.text)
 
-        # save model to output directory
-        nlp.meta["name"] = label
-        nlp.to_disk(model_path)
-        self.__console.okay("Saved model to", model_path)
+        # save model to output directory, noting the F-score on the gate examples for fine-tuning to be
+        # checked against
+        f_score = entity_f_score(nlp, gate_data, label) if gate_data else state['best_f_score']
+        self.__save(nlp, level, dict(manifest, f_score=f_score, updates=0))
 
         # test the saved model
         self.__console.info("Loading from", model_path)
@@ -130,5 +342,148 @@ class TrainedModels(object):
         for ent in doc2.ents:
             self.__console.info(ent.label_, ent.text)
 
-        self.model_qsize_path(level).write_text(str(len(self.training_data.questions)))
+        self.__clear_checkpoint(level)
+
+        report = TrainingReport(level, label, state['epoch'], elapsed, f_score, resumed_from)
+        self.reports[level] = report
+        self.__report(report)
+        return nlp
+
+    def update(self, level: int, new_examples: list):
+        """
+        Fine-tune the saved model for a level on examples added since it was trained, mixed with a replay
+        sample of the examples it was trained on.  If the F-score on the gate examples drops too far below
+        the one the model was fully trained to, train from scratch instead.
+        """
+        params = self.training_params
+        label = self.label(level)
+        train_data, holdout_data, gate_data = self.__split_data(level)
+        # Training from scratch trains on the held-out examples too (see `final_epochs`), but never on
+        # the gate examples
+        trained_data = train_data + holdout_data if params['final_epochs'] else train_data
+        new_digests = {example_digest(example) for example in new_examples}
+        new_train = [example for example in trained_data if example_digest(example) in new_digests]
+        old_train = [example for example in trained_data if example_digest(example) not in new_digests]
+        manifest = json.loads(self.model_manifest_path(level).read_text())
+
+        rng = random.Random(params['seed'])
+        replay = rng.sample(old_train, min(len(old_train), int(len(new_train) * params['replay_ratio'])))
+        epochs = params['incremental_epochs'] if new_train else 0
+
+        nlp = spacy.load(self.model_path(level))
+        optimizer = nlp.resume_training()
+        other_pipes = [pipe for pipe in nlp.pipe_names if pipe != 'ner']
+        started = clock()
+        with nlp.disable_pipes(*other_pipes) and warnings.catch_warnings():
+            warnings.filterwarnings("once", category=UserWarning, module='spacy')
+            with self.__console.timed(f'Fine-tuning model {label}', 'Fine-tuned model in {0:.3f}s',
+                                      'training_seconds', model=label, mode='fine-tune'):
+                for epoch in range(epochs):
+                    epoch_data = new_train + replay
+                    rng.shuffle(epoch_data)
+                    losses = self.__train_epoch(nlp, optimizer, epoch_data, compounding(*params['batch_sizes']))
+                    self.__console.count('training_epochs_total', model=label, mode='fine-tune')
+                    self.__console.info("Epoch", epoch + 1, "Losses", losses)
+        elapsed = clock() - started
+
+        f_score = entity_f_score(nlp, gate_data, label) if gate_data else 0.0
+        if gate_data and f_score < manifest['f_score'] - params['incremental_tolerance']:
+            self.__console.warn(f'Fine-tuned F-score {f_score:.3f} is below {manifest["f_score"]:.3f}; '
+                                f'training {label} from scratch')
+            return self.train(level)
+
+        # Keep the F-score of the full training, so that repeated fine-tuning cannot drift away from it
+        self.__save(nlp, level, dict(self.manifest(level), f_score=manifest['f_score'],
+                                     updates=manifest.get('updates', 0) + 1))
+
+        report = TrainingReport(level, label, epochs, elapsed, f_score, None, True)
+        self.reports[level] = report
+        self.__report(report)
         return nlp
+
+    def __train_epoch(self, nlp, optimizer, examples: list, sizes) -> dict:
+        """Update the model on each minibatch of the examples, returning the losses."""
+        losses = {}
+        for batch in minibatch(examples, size=sizes):
+            texts, annotations = zip(*batch)
+            nlp.update(texts, annotations, sgd=optimizer, drop=self.training_params['dropout'], losses=losses)
+        return losses
+
+    def __save(self, nlp, level: int, manifest: dict):
+        """
+        Save a model with its manifest and example digests into a staging directory, then swap it in, so
+        that an interrupted save never leaves a half-written model behind.
+        """
+        model_path = self.model_path(level)
+        staging_path = model_path.with_name(model_path.name + '.new')
+        old_path = model_path.with_name(model_path.name + '.old')
+        shutil.rmtree(staging_path, ignore_errors=True)
+
+        nlp.meta["name"] = self.label(level)
+        nlp.to_disk(staging_path)
+        digests = [example_digest(example) for example in self.training_data.prepare_data(level, self.label(level))]
+        (staging_path / 'examples.txt').write_text(''.join(f'{digest}\n' for digest in digests))
+        # The manifest goes last: a model without one is retrained
+        (staging_path / 'manifest.json').write_text(json.dumps(manifest, indent=2))
+
+        shutil.rmtree(old_path, ignore_errors=True)
+        if model_path.exists():
+            os.replace(model_path, old_path)
+        os.replace(staging_path, model_path)
+        shutil.rmtree(old_path, ignore_errors=True)
+        self.__console.okay("Saved model to", model_path)
+
+    def __recover(self, level: int):
+        """Put back the previous model if a save was interrupted while swapping it out."""
+        model_path = self.model_path(level)
+        old_path = model_path.with_name(model_path.name + '.old')
+        if not model_path.exists() and old_path.exists():
+            os.replace(old_path, model_path)
+
+    def __split_data(self, level: int) -> Tuple[list, list, list]:
+        """
+        Split the prepared examples into training, held-out and gate sets by their digests, so that each
+        example stays on the same side as more are added.
+        """
+        prepared_data = self.training_data.prepare_data(level, self.label(level))
+        gate_cutoff = int(self.training_params['gate_holdout'] * 0x100000000)
+        cutoff = gate_cutoff + int(self.training_params['holdout'] * 0x100000000)
+        train_data, holdout_data, gate_data = [], [], []
+        for example in prepared_data:
+            position = int(example_digest(example)[:8], 16)
+            if position < gate_cutoff:
+                gate_data.append(example)
+            elif position < cutoff:
+                holdout_data.append(example)
+            else:
+                train_data.append(example)
+        if not train_data or not holdout_data:
+            return list(prepared_data), [], []
+        return train_data, holdout_data, gate_data
+
+    def __load_checkpoint_state(self, level: int, manifest: dict):
+        state_path = self.checkpoint_path(level) / 'state.json'
+        try:
+            state = json.loads(state_path.read_text())
+        except (OSError, ValueError):
+            return None
+        if state.get('manifest') != manifest or not (self.checkpoint_path(level) / 'best').exists():
+            self.__console.warn(f'Ignoring stale checkpoint for {self.label(level)}')
+            return None
+        # The best model may have been saved after the last checkpoint
+        try:
+            best = json.loads((self.checkpoint_path(level) / 'best.json').read_text())
+            state['best_f_score'] = max(state['best_f_score'], best['f_score'])
+        except (OSError, ValueError, KeyError):
+            pass
+        return state
+
+    def __clear_checkpoint(self, level: int):
+        shutil.rmtree(self.checkpoint_path(level), ignore_errors=True)
+
+    def __report(self, report: TrainingReport):
+        resumed = f', resumed from epoch {report.resumed_from}' if report.resumed_from else ''
+        verb = 'Fine-tuned' if report.incremental else 'Trained'
+        self.__console.okay(
+            f'{verb} {report.label} for {report.epochs} epochs in {report.seconds:.3f}s{resumed}; '
+            f'held-out F-score {report.f_score:.3f}')